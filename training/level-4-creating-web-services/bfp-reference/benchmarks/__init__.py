@@ -0,0 +1,11 @@
+"""
+This package provides benchmarks for the bfp_friends_api package.
+
+Run them from the `bfp-reference` directory, e.g.:
+
+    python -m benchmarks.point_lookups
+
+benchmarks.load_test drives every route with a mixed workload and
+reports throughput and latency percentiles as JSON, for comparing
+revisions.
+"""
@@ -0,0 +1,188 @@
+"""
+Compare the throughput and latency of the Friends API served over WSGI
+(werkzeug's threaded server, a thread per connection) and over ASGI
+(uvicorn running bfp_friends_api.asgi, with handlers offloaded to a
+bounded executor).
+
+Each server is started in a subprocess against its own seeded scratch
+datastore.  The client runs `--connections` concurrent clients, each
+issuing a mix of single friend lookups and collection reads for
+`--duration` seconds over a keep-alive connection.  werkzeug closes the
+connection after every response, so against it the clients reconnect
+as needed -- part of what a thread per connection costs.
+
+    python -m benchmarks.asgi_vs_wsgi --connections 50 200 --duration 10
+
+The ASGI run is skipped if uvicorn isn't installed.
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.load_test import latency_summary
+from benchmarks.seed import seed_datastore
+from benchmarks.server import serve
+
+
+async def read_response(reader: asyncio.StreamReader) -> tuple:
+    """
+    Read one HTTP/1.1 response.
+
+    Returns:
+        A (status code, keep alive) tuple, where keep alive is False if
+        the server is about to close the connection.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("The server closed the connection.")
+
+    content_length = 0
+    chunked = False
+    keep_alive = True
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            content_length = int(value)
+        elif name == 'transfer-encoding' and 'chunked' in value.lower():
+            chunked = True
+        elif name == 'connection' and 'close' in value.lower():
+            keep_alive = False
+
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(content_length)
+
+    return int(status_line.split()[1]), keep_alive
+
+
+async def client(port: int, paths: list, stop_at: float,
+                 latencies: list, errors: list):
+    """
+    Issue GET requests for random `paths` until `stop_at`, recording the
+    latency of each.  The connection is kept alive unless the server
+    closes it, in which case connecting again counts towards the latency
+    of the next request.
+    """
+    writer = None
+    try:
+        while time.monotonic() < stop_at:
+            request = ("GET {} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".format(
+                random.choice(paths))).encode('latin-1')
+            started = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port)
+            writer.write(request)
+            await writer.drain()
+            status, keep_alive = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors.append(status)
+            if not keep_alive:
+                writer.close()
+                writer = None
+    except (OSError, ConnectionError, asyncio.IncompleteReadError) as error:
+        errors.append(error)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def load(port: int, connections: int, duration: float,
+               paths: list) -> dict:
+    """Drive `connections` concurrent clients and summarize the results."""
+    latencies = list()
+    errors = list()
+    stop_at = time.monotonic() + duration
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(port, paths, stop_at, latencies, errors)
+                           for _ in range(connections)))
+    elapsed = time.perf_counter() - started
+
+    result = latency_summary(latencies, len(errors), elapsed)
+    result["connections"] = connections
+    return result
+
+
+def run(connection_counts: list, duration: float, rows: int,
+        collection_share: float) -> list:
+    """
+    Benchmark both servers at each connection count and return a list of
+    result dicts.
+    """
+    servers = ["wsgi"]
+    if importlib.util.find_spec("uvicorn") is not None:
+        servers.append("asgi")
+    else:
+        print("uvicorn is not installed; skipping the ASGI server.")
+
+    # Roughly `collection_share` of the requests read a page of the
+    # collection; the rest look up single friends.
+    lookups = ["/api/v1/friends/Friend-{}".format(random.randrange(rows))
+               for _ in range(1000)]
+    pages = ["/api/v1/friends?limit=100"]
+    page_count = max(int(len(lookups) * collection_share), 1)
+    paths = lookups + pages * page_count
+
+    results = list()
+    for server in servers:
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, "friends.db")
+            seed_datastore(database, rows)
+            with serve(server, database) as port:
+                # Warm up the pool, the migrations check and the caches.
+                asyncio.run(load(port, 4, 1.0, paths))
+                for connections in connection_counts:
+                    result = asyncio.run(
+                        load(port, connections, duration, paths))
+                    result["server"] = server
+                    results.append(result)
+
+    return results
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the benchmark's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Compare the API's throughput under WSGI and ASGI.")
+    parser.add_argument(
+        "--connections", nargs="+", type=int, default=[10, 100, 500],
+        help="Concurrent keep-alive connections to benchmark with.")
+    parser.add_argument(
+        "--duration", type=float, default=10.0,
+        help="Seconds to run each connection count for.")
+    parser.add_argument(
+        "--rows", type=int, default=10000,
+        help="Friends to seed each datastore with.")
+    parser.add_argument(
+        "--collection-share", type=float, default=0.1,
+        help="Share of requests that read a page of the collection.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    print("{:<6} {:>11} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        "server", "connections", "requests", "errors", "req/s",
+        "p50 ms", "p95 ms", "p99 ms"))
+    for result in run(arguments.connections, arguments.duration,
+                      arguments.rows, arguments.collection_share):
+        print("{server:<6} {connections:>11} {requests:>9} {errors:>7} "
+              "{requests_per_second:>9.1f} {p50_ms:>9.2f} {p95_ms:>9.2f} "
+              "{p99_ms:>9.2f}".format(**result))
@@ -0,0 +1,495 @@
+"""
+Load test the Friends API with a mixed read/write workload and report
+throughput and latency as JSON.
+
+The datastore is seeded (see benchmarks.seed), then `--concurrency`
+workers each issue `--requests` requests drawn from a weighted mix of
+operations covering every route, while `--listeners` clients follow
+the change feed.  Each worker draws from its own seeded random
+generator, so a run is reproducible: the same options replay the same
+requests against the same data.
+
+The API runs either in this process, driven through Flask's test client
+(no network, so it isolates the cost of the application itself), or on
+a local WSGI or ASGI server (see benchmarks.server).
+
+    python -m benchmarks.load_test --rows 10000 --concurrency 8 \\
+        --requests 500 --server wsgi --output before.json
+
+The report holds the overall and per operation request counts, errors,
+requests per second and p50/p95/p99 latencies and the events the listeners
+received, along with the settings
+and the git revision, so reports from two revisions can be compared.
+"""
+
+import argparse
+import http.client
+import json
+import platform
+import random
+import socket
+import subprocess
+import threading
+import time
+
+from benchmarks.seed import friend_rows
+from benchmarks.seed import seed_datastore
+from benchmarks.server import SERVERS
+from benchmarks.server import serve
+
+# The relative weight of each operation in each workload.
+WORKLOADS = {
+    "read-heavy": {
+        "list_friends": 1, "page_friends": 10, "page_fields": 4,
+        "get_friend": 40, "get_friend_fields": 5, "get_friends_by_id": 4,
+        "lookup_friends": 2, "sync_friends": 4, "search_friends": 10,
+        "suggest_friends": 15, "create_friend": 4, "create_friends": 1,
+        "update_friend": 6, "patch_friends": 2, "delete_friend": 4},
+    "mixed": {
+        "list_friends": 1, "page_friends": 8, "page_fields": 3,
+        "get_friend": 25, "get_friend_fields": 4, "get_friends_by_id": 3,
+        "lookup_friends": 2, "sync_friends": 4, "search_friends": 8,
+        "suggest_friends": 10, "create_friend": 12, "create_friends": 2,
+        "update_friend": 15, "patch_friends": 4, "delete_friend": 12},
+    "write-heavy": {
+        "list_friends": 1, "page_friends": 4, "page_fields": 1,
+        "get_friend": 10, "get_friend_fields": 2, "get_friends_by_id": 1,
+        "lookup_friends": 1, "sync_friends": 3, "search_friends": 3,
+        "suggest_friends": 4, "create_friend": 25, "create_friends": 5,
+        "update_friend": 25, "patch_friends": 8, "delete_friend": 20},
+}
+
+
+def friend_payload(id: str, generator: random.Random) -> dict:
+    """Return a friend representation as the API receives it."""
+    return {"id": id,
+            "firstName": "Load",
+            "lastName": "Tester",
+            "telephone": "555-{:04d}".format(generator.randrange(10000)),
+            "email": "{}@example.com".format(id.lower()),
+            "notes": "Created by the load test."}
+
+
+class Worker:
+    """
+    Generates one worker's reproducible sequence of requests.
+
+    Friends the worker creates get ids of its own (Load-<worker>-<n>),
+    and it only deletes friends it created, so workers never conflict
+    and the datastore stays about the size it was seeded at.
+
+    Args:
+        number (int): The worker's number, which also seeds its requests.
+        rows (int): The number of seeded friends.
+        names (list): (first_name, last_name) tuples of seeded friends,
+            to search and suggest from.
+        seed (int): The seed of the whole run.
+    """
+
+    def __init__(self, number: int, rows: int, names: list, seed: int):
+        self.number = number
+        self.rows = rows
+        self.names = names
+        self.generator = random.Random(seed * 1000 + number)
+        self.created = list()
+        self.created_count = 0
+
+    def next_request(self, workload: dict) -> tuple:
+        """
+        Return the next (operation, method, path, payload) to send.
+        `payload` is None or a JSON ready object.
+        """
+        operation = self.generator.choices(
+            list(workload), weights=list(workload.values()))[0]
+        if operation == "delete_friend" and not self.created:
+            operation = "create_friend"
+        return (operation,) + getattr(self, operation)()
+
+    def seeded_id(self) -> str:
+        return "Friend-{}".format(self.generator.randrange(self.rows))
+
+    def new_id(self) -> str:
+        self.created_count += 1
+        return "Load-{}-{}".format(self.number, self.created_count)
+
+    def list_friends(self):
+        return 'GET', '/api/v1/friends', None
+
+    def page_friends(self):
+        return 'GET', '/api/v1/friends?limit=50', None
+
+    def page_fields(self):
+        return ('GET', '/api/v1/friends?limit=100&fields=firstName,lastName',
+                None)
+
+    def get_friend(self):
+        return 'GET', '/api/v1/friends/' + self.seeded_id(), None
+
+    def get_friend_fields(self):
+        return ('GET', '/api/v1/friends/{}?fields=email'.format(
+            self.seeded_id()), None)
+
+    def get_friends_by_id(self):
+        return ('GET', '/api/v1/friends?ids=' + ','.join(
+            self.seeded_id() for _ in range(20)), None)
+
+    def lookup_friends(self):
+        return ('POST', '/api/v1/friends:lookup',
+                [self.seeded_id() for _ in range(100)])
+
+    def sync_friends(self):
+        # The seeded datastore is at version `rows`, so this fetches the
+        # first page of the changes made during the run, as a client
+        # catching up would.
+        return ('GET', '/api/v1/friends?since={}&limit=100'.format(
+            self.rows), None)
+
+    def search_friends(self):
+        first_name, last_name = self.generator.choice(self.names)
+        return ('GET', '/api/v1/friends/search?q={}+{}'.format(
+            first_name[:4], last_name[:3]), None)
+
+    def suggest_friends(self):
+        first_name, _ = self.generator.choice(self.names)
+        return ('GET', '/api/v1/friends/suggest?prefix={}'.format(
+            first_name[:self.generator.randint(1, 3)]), None)
+
+    def create_friend(self):
+        id = self.new_id()
+        self.created.append(id)
+        return 'POST', '/api/v1/friends', friend_payload(id, self.generator)
+
+    def create_friends(self):
+        ids = [self.new_id() for _ in range(10)]
+        self.created.extend(ids)
+        return ('POST', '/api/v1/friends:batch',
+                [friend_payload(id, self.generator) for id in ids])
+
+    def update_friend(self):
+        id = self.seeded_id()
+        return ('PUT', '/api/v1/friends/' + id,
+                friend_payload(id, self.generator))
+
+    def patch_friends(self):
+        return ('PATCH', '/api/v1/friends',
+                [{"id": self.seeded_id(),
+                  "telephone": "555-{:04d}".format(
+                      self.generator.randrange(10000))}
+                 for _ in range(10)])
+
+    def delete_friend(self):
+        id = self.created.pop(self.generator.randrange(len(self.created)))
+        return 'DELETE', '/api/v1/friends/' + id, None
+
+
+class InProcessClient:
+    """Sends requests to the app through Flask's test client."""
+
+    def __init__(self, app):
+        self.test_client = app.test_client()
+
+    def request(self, method: str, path: str, payload) -> int:
+        response = self.test_client.open(path, method=method, json=payload)
+        response.get_data()
+        return response.status_code
+
+    def stream(self, path: str) -> tuple:
+        """
+        Start a GET of a streamed response and return its status and an
+        iterator over the lines of its body.
+        """
+        response = self.test_client.get(path, buffered=False)
+        return response.status_code, self._lines(response)
+
+    @staticmethod
+    def _lines(response):
+        try:
+            for chunk in response.response:
+                yield from chunk.splitlines()
+        finally:
+            response.close()
+
+    def interrupt(self):
+        # A test client stream can only be ended by the thread reading
+        # it, once its next line arrives.
+        pass
+
+
+class HttpClient:
+    """Sends requests to a local server over a keep-alive connection."""
+
+    def __init__(self, port: int):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                     timeout=60)
+
+    def request(self, method: str, path: str, payload) -> int:
+        headers = dict()
+        body = None
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+    def stream(self, path: str) -> tuple:
+        """
+        Start a GET of a streamed response and return its status and an
+        iterator over the lines of its body.
+        """
+        self.connection.request('GET', path)
+        response = self.connection.getresponse()
+        return response.status, self._lines(response)
+
+    def _lines(self, response):
+        try:
+            yield from iter(response.readline, b'')
+        finally:
+            self.connection.close()
+
+    def interrupt(self):
+        """
+        End a stream being read on another thread by shutting down the
+        connection's socket.  The reading thread closes the connection.
+        """
+        connection_socket = self.connection.sock
+        if connection_socket is not None:
+            try:
+                connection_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # The stream already ended.
+                pass
+
+
+class EventListener:
+    """
+    Follows the change feed (GET /api/v1/friends/events) on a thread of
+    its own for the whole run, as a client keeping up with changes
+    would, and counts the events it receives.
+
+    Args:
+        client: An InProcessClient or HttpClient for the listener's
+            exclusive use.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.status, self.lines = client.stream('/api/v1/friends/events')
+        self.received = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._listen)
+        self._thread.start()
+
+    def _listen(self):
+        try:
+            for line in self.lines:
+                if self._stopping.is_set():
+                    break
+                if line.startswith(b'event: '):
+                    self.received += 1
+        except (OSError, http.client.HTTPException):
+            pass
+        finally:
+            self.lines.close()
+
+    def stop(self):
+        """Stop listening and wait for the listener's thread to end."""
+        self._stopping.set()
+        self.client.interrupt()
+        self._thread.join()
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    """Return the value at `fraction` through an already sorted list."""
+    if not ordered:
+        return float('nan')
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def latency_summary(latencies: list, errors: int, elapsed: float) -> dict:
+    """
+    Summarize request latencies, in seconds, as a JSON ready dictionary
+    of counts, throughput and millisecond percentiles.
+    """
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "requests_per_second": len(ordered) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(ordered, 0.50) * 1000,
+        "p95_ms": percentile(ordered, 0.95) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000}
+
+
+def drive(make_client, workers: list, requests: int, workload: dict,
+          listeners: int=0) -> dict:
+    """
+    Run every worker on its own thread with its own client, with
+    `listeners` EventListeners following the change feed meanwhile, and
+    return the latency summaries of the run.
+    """
+    # operation -> list of (latency, succeeded)
+    outcomes = dict()
+    outcomes_lock = threading.Lock()
+    start = threading.Barrier(len(workers) + 1)
+
+    def work(worker):
+        client = make_client()
+        planned = [worker.next_request(workload) for _ in range(requests)]
+        measured = list()
+
+        start.wait()
+        for operation, method, path, payload in planned:
+            started = time.perf_counter()
+            try:
+                status = client.request(method, path, payload)
+            except (OSError, http.client.HTTPException):
+                status = None
+            measured.append((operation, time.perf_counter() - started,
+                             status is not None and status < 400))
+
+        with outcomes_lock:
+            for operation, latency, succeeded in measured:
+                outcomes.setdefault(operation, list()).append(
+                    (latency, succeeded))
+
+    event_listeners = [EventListener(make_client())
+                       for _ in range(listeners)]
+    threads = [threading.Thread(target=work, args=(worker,))
+               for worker in workers]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    for event_listener in event_listeners:
+        event_listener.stop()
+
+    def summary(results):
+        return latency_summary(
+            [latency for latency, _ in results],
+            sum(1 for _, succeeded in results if not succeeded),
+            elapsed)
+
+    return {
+        "elapsed_seconds": elapsed,
+        "total": summary([result for results in outcomes.values()
+                          for result in results]),
+        "operations": {operation: summary(results)
+                       for operation, results in sorted(outcomes.items())},
+        "events": {
+            "listeners": listeners,
+            "subscribed": sum(1 for event_listener in event_listeners
+                              if event_listener.status == 200),
+            "received": sum(event_listener.received
+                            for event_listener in event_listeners)}}
+
+
+def git_revision() -> str:
+    """Return the checked out git revision, or None outside a checkout."""
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(rows: int, concurrency: int, requests: int, workload: str,
+        server: str, profile: str, database: str, seed: int,
+        listeners: int=0) -> dict:
+    """
+    Seed the datastore, run the load test and return its report.
+    """
+    seed_datastore(database, rows, seed)
+    names = [(first_name, last_name) for _, first_name, last_name, _, _, _
+             in friend_rows(min(rows, 1000), seed)]
+    workers = [Worker(number, rows, names, seed)
+               for number in range(concurrency)]
+
+    if server == "in-process":
+        from bfp_friends_api import api
+        api.app.config['DATASTORE_PATH'] = database
+        api.app.config['DATASTORE_PROFILE'] = profile
+        # Listeners notice the end of the run at their next line, so
+        # keep the wait for a keep-alive short.
+        api.app.config['EVENTS_HEARTBEAT_INTERVAL'] = 1.0
+
+        def make_client():
+            return InProcessClient(api.app)
+
+        InProcessClient(api.app).request('GET', '/api/v1/friends', None)
+        results = drive(make_client, workers, requests, WORKLOADS[workload],
+                        listeners)
+    else:
+        with serve(server, database, profile) as port:
+            def make_client():
+                return HttpClient(port)
+
+            HttpClient(port).request('GET', '/api/v1/friends', None)
+            results = drive(make_client, workers, requests,
+                            WORKLOADS[workload], listeners)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "settings": {
+            "rows": rows, "concurrency": concurrency, "requests": requests,
+            "workload": workload, "server": server, "profile": profile,
+            "seed": seed, "listeners": listeners}}
+    report.update(results)
+    return report
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the load test's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Load test the Friends API and report as JSON.")
+    parser.add_argument(
+        "--rows", type=int, default=10000,
+        help="Friends to seed the datastore with.")
+    parser.add_argument(
+        "--concurrency", type=int, default=8,
+        help="Concurrent workers, each with its own connection.")
+    parser.add_argument(
+        "--requests", type=int, default=500,
+        help="Requests per worker.")
+    parser.add_argument(
+        "--listeners", type=int, default=2,
+        help="Clients following the change feed for the whole run.")
+    parser.add_argument(
+        "--workload", choices=sorted(WORKLOADS), default="mixed",
+        help="The mix of operations to send.")
+    parser.add_argument(
+        "--server", choices=["in-process"] + SERVERS, default="in-process",
+        help="How to run the API.")
+    parser.add_argument(
+        "--profile", default="default",
+        help="The DATASTORE_PROFILE to run the API with.")
+    parser.add_argument(
+        "--database", default="/tmp/friends.db",
+        help="Path of the datastore to seed and load test.")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed of the data and of the requests.")
+    parser.add_argument(
+        "--output",
+        help="Write the report to this file instead of printing it.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    report = run(arguments.rows, arguments.concurrency, arguments.requests,
+                 arguments.workload, arguments.server, arguments.profile,
+                 arguments.database, arguments.seed, arguments.listeners)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
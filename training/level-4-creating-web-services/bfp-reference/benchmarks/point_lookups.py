@@ -0,0 +1,128 @@
+"""
+Measure single friend lookups with and without the case-insensitive
+index on friends.id.
+
+For each table size a scratch datastore is seeded, then random ids are
+looked up first with the old `lower(id) = ?` predicate against the
+unmigrated schema and then with datastore.get_friend() after the
+migrations have been applied.  Without the index the cost of a lookup
+grows with the table; with it the cost stays (logarithmically) flat.
+
+    python -m benchmarks.point_lookups --sizes 10000 100000 1000000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from bfp_friends_api import datastore
+from bfp_friends_api import migrations
+
+LEGACY_LOOKUP = ('select id, first_name, last_name, telephone, email, notes '
+                 'from friends where lower(id) = ?')
+INDEXED_LOOKUP = ('select id, first_name, last_name, telephone, email, notes '
+                  'from friends where id = ? collate nocase')
+
+
+def seed_friends(ds_connection: sqlite3.Connection, row_count: int):
+    """
+    Create the unindexed friends table and fill it with `row_count` rows.
+    """
+    version, _, statements = migrations.MIGRATIONS[0]
+    for statement in statements:
+        ds_connection.execute(statement)
+    ds_connection.execute('pragma user_version = {:d}'.format(version))
+
+    ds_connection.executemany(
+        'insert into friends (id, first_name, last_name, telephone, email, '
+        'notes) values (?, ?, ?, ?, ?, ?)',
+        (("Friend-{}".format(number), "First", "Last", "555-0100",
+          "friend{}@example.com".format(number), "Seeded.")
+         for number in range(row_count)))
+    ds_connection.commit()
+
+
+def time_lookups(lookup, ids: list) -> float:
+    """Return the mean number of microseconds taken by lookup(id)."""
+    started = time.perf_counter()
+    for id in ids:
+        if lookup(id) is None:
+            raise AssertionError("Seeded friend {} was not found.".format(id))
+    return (time.perf_counter() - started) / len(ids) * 1000000
+
+
+def query_plan(ds_connection: sqlite3.Connection, sql: str) -> str:
+    """Return SQLite's one line query plan for `sql`."""
+    rows = ds_connection.execute('explain query plan ' + sql, ['x'])
+    return "; ".join(row[-1] for row in rows)
+
+
+def run(sizes: list, lookups: int, legacy_lookups: int) -> list:
+    """
+    Benchmark every table size and return a list of result dicts.
+    """
+    results = list()
+
+    # Measure the index, not the cache in front of it.
+    datastore.friend_cache.max_size = 0
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            ds_connection = sqlite3.connect(
+                os.path.join(directory, "friends.db"))
+            seed_friends(ds_connection, size)
+
+            def legacy_lookup(id):
+                return ds_connection.execute(
+                    LEGACY_LOOKUP, [id.lower()]).fetchone()
+
+            def indexed_lookup(id):
+                return datastore.get_friend(ds_connection, id)
+
+            # Mixed case proves the lookups are still case-insensitive.
+            ids = ["FRIEND-{}".format(random.randrange(size))
+                   for _ in range(lookups)]
+
+            legacy_us = time_lookups(legacy_lookup, ids[:legacy_lookups])
+            migrations.migrate(ds_connection)
+            indexed_us = time_lookups(indexed_lookup, ids)
+
+            results.append({
+                "rows": size,
+                "legacy_us": legacy_us,
+                "indexed_us": indexed_us,
+                "plan": query_plan(ds_connection, INDEXED_LOOKUP)})
+            ds_connection.close()
+
+    return results
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the benchmark's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark friend lookups by id at several table sizes.")
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, metavar="ROWS",
+        default=[10000, 100000, 1000000],
+        help="Table sizes to benchmark.")
+    parser.add_argument(
+        "--lookups", type=int, default=10000,
+        help="Indexed lookups to time per table size.")
+    parser.add_argument(
+        "--legacy-lookups", type=int, default=20,
+        help="Unindexed (full scan) lookups to time per table size.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    print("{:>10} {:>14} {:>14}  {}".format(
+        "rows", "lower(id) us", "nocase us", "plan"))
+    for result in run(arguments.sizes, arguments.lookups,
+                      arguments.legacy_lookups):
+        print("{rows:>10} {legacy_us:>14.1f} {indexed_us:>14.1f}  "
+              "{plan}".format(**result))
@@ -0,0 +1,169 @@
+"""
+Compare read throughput from the datastore file with read throughput
+from the in-memory read snapshot, at several thread counts, while a
+writer keeps committing.
+
+    python -m benchmarks.read_snapshot --rows 100000 --threads 1 2 4 8
+
+Each reader thread checks a connection out of a ConnectionPool (the
+"file" tier) or a ReadSnapshot (the "snapshot" tier) and looks up
+random friends by id, as GET /api/v1/friends/<id> does, with the friend
+cache disabled so every lookup is a query.  Meanwhile a writer thread
+updates a random friend every --write-interval seconds and notifies the
+snapshot, as the API does after each write.
+"""
+
+import argparse
+import random
+import sqlite3
+import threading
+import time
+
+from benchmarks.seed import seed_datastore
+from bfp_friends_api import datastore
+from bfp_friends_api import writer
+from bfp_friends_api.pool import ConnectionPool
+from bfp_friends_api.snapshot import ReadSnapshot
+
+TIERS = ["file", "snapshot"]
+
+
+def write_continuously(database: str, rows: int, interval: float,
+                       stop: threading.Event, settings: dict,
+                       read_snapshot: ReadSnapshot=None) -> int:
+    """Update a random friend every `interval` seconds until stopped."""
+    ds_connection = sqlite3.connect(database)
+    writer.apply_pragmas(ds_connection, settings)
+    generator = random.Random(1)
+    writes = 0
+    while not stop.is_set():
+        ds_connection.execute(
+            'update friends set notes = ? where id = ?',
+            ["Updated {}.".format(writes),
+             "Friend-{}".format(generator.randrange(rows))])
+        ds_connection.commit()
+        writes += 1
+        if read_snapshot is not None:
+            read_snapshot.notify()
+        stop.wait(interval)
+    ds_connection.close()
+    return writes
+
+
+def measure(source, rows: int, threads: int, seconds: float) -> int:
+    """
+    Return the number of lookups `threads` readers complete in
+    `seconds` with connections from `source`.
+    """
+    counts = [0] * threads
+    stop = threading.Event()
+    start = threading.Barrier(threads + 1)
+
+    def read(number):
+        generator = random.Random(number)
+        start.wait()
+        while not stop.is_set():
+            ds_connection = source.acquire()
+            try:
+                datastore.get_friend(
+                    ds_connection,
+                    "Friend-{}".format(generator.randrange(rows)))
+            finally:
+                source.release(ds_connection)
+            counts[number] += 1
+
+    readers = [threading.Thread(target=read, args=(number,))
+               for number in range(threads)]
+    for reader in readers:
+        reader.start()
+    start.wait()
+    time.sleep(seconds)
+    stop.set()
+    for reader in readers:
+        reader.join()
+    return sum(counts)
+
+
+def run(rows: int, thread_counts: list, seconds: float,
+        write_interval: float, profile: str, database: str) -> list:
+    """Benchmark every tier and thread count and return result dicts."""
+    seed_datastore(database, rows)
+    settings = writer.profile_settings(profile)
+    datastore.friend_cache.max_size = 0
+
+    def configure_connection(ds_connection):
+        writer.apply_pragmas(ds_connection, settings)
+
+    results = list()
+    for tier in TIERS:
+        for threads in thread_counts:
+            read_snapshot = None
+            if tier == "snapshot":
+                source = read_snapshot = ReadSnapshot(
+                    database, max_size=threads, max_staleness=1.0,
+                    on_connect=configure_connection)
+                read_snapshot.start()
+            else:
+                source = ConnectionPool(database, max_size=threads,
+                                        on_connect=configure_connection)
+
+            stop = threading.Event()
+            writes = list()
+            writing = threading.Thread(target=lambda: writes.append(
+                write_continuously(database, rows, write_interval, stop,
+                                   settings, read_snapshot)))
+            writing.start()
+            try:
+                lookups = measure(source, rows, threads, seconds)
+            finally:
+                stop.set()
+                writing.join()
+                source.close()
+
+            result = {"tier": tier, "threads": threads,
+                      "lookups_per_second": lookups / seconds,
+                      "writes_per_second": writes[0] / seconds}
+            if read_snapshot is not None:
+                result["refreshes"] = read_snapshot.stats()["refreshes"]
+            results.append(result)
+
+    return results
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the benchmark's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Compare reads from the datastore file and from the "
+                    "in-memory read snapshot.")
+    parser.add_argument(
+        "--rows", type=int, default=100000,
+        help="Friends to seed the datastore with.")
+    parser.add_argument(
+        "--threads", nargs="+", type=int, default=[1, 2, 4, 8],
+        help="Reader thread counts to benchmark.")
+    parser.add_argument(
+        "--seconds", type=float, default=3.0,
+        help="How long to read for at each thread count.")
+    parser.add_argument(
+        "--write-interval", type=float, default=0.25,
+        help="Seconds between the writer's updates.")
+    parser.add_argument(
+        "--profile", default="default",
+        help="The DATASTORE_PROFILE to configure connections with.")
+    parser.add_argument(
+        "--database", default="/tmp/friends-snapshot.db",
+        help="Path of the datastore to seed.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    print("{:<9} {:>8} {:>10} {:>9} {:>10}".format(
+        "tier", "threads", "lookups/s", "writes/s", "refreshes"))
+    for result in run(arguments.rows, arguments.threads, arguments.seconds,
+                      arguments.write_interval, arguments.profile,
+                      arguments.database):
+        print("{tier:<9} {threads:>8} {lookups_per_second:>10.0f} "
+              "{writes_per_second:>9.0f} {refreshes:>10}".format(
+                  **dict({"refreshes": ""}, **result)))
@@ -0,0 +1,124 @@
+"""
+Compare ways of encoding the friends collection as JSON.
+
+    "jsonify"      get_friends() builds a dict per row, then the whole
+                   list is dumped at once, as jsonify() does.
+    "dict stream"  iter_friends() builds a dict per row, and each is
+                   dumped on its own (the old streaming/caching path).
+    "row encoder"  iter_encoded_friends() encodes each row tuple into a
+                   precompiled template, with no dicts at all.
+
+Each variant is timed (best of --repeat) and then run once more under
+tracemalloc to record the peak memory it allocated.
+
+    python -m benchmarks.row_encoding --rows 100000
+"""
+
+import argparse
+import json
+import sqlite3
+import time
+import tracemalloc
+
+from bfp_friends_api import datastore
+from bfp_friends_api import migrations
+
+
+def seed_friends(ds_connection: sqlite3.Connection, row_count: int):
+    """Fill a migrated datastore with `row_count` friends."""
+    ds_connection.executemany(
+        'insert into friends (id, first_name, last_name, telephone, email, '
+        'notes) values (?, ?, ?, ?, ?, ?)',
+        (("Friend-{}".format(number), "First", "Last", "555-0100",
+          "friend{}@example.com".format(number),
+          "Met at the café in {}.".format(1990 + number % 30))
+         for number in range(row_count)))
+    ds_connection.commit()
+
+
+def encode_with_jsonify(ds_connection: sqlite3.Connection) -> bytes:
+    """Encode the collection the way jsonify() would."""
+    # jsonify() sorts keys and uses compact separators outside debug mode.
+    return json.dumps({"friends": datastore.get_friends(ds_connection)},
+                      sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def encode_dict_stream(ds_connection: sqlite3.Connection) -> bytes:
+    """Encode the collection one representation dict at a time."""
+    return ('{"friends": [' + ', '.join(
+        json.dumps(friend, sort_keys=True)
+        for friend in datastore.iter_friends(ds_connection)) +
+        ']}').encode('utf-8')
+
+
+def encode_rows(ds_connection: sqlite3.Connection) -> bytes:
+    """Encode the collection with the row encoder."""
+    return ('{"friends": [' + ', '.join(
+        datastore.iter_encoded_friends(ds_connection)) +
+        ']}').encode('utf-8')
+
+
+VARIANTS = [("jsonify", encode_with_jsonify),
+            ("dict stream", encode_dict_stream),
+            ("row encoder", encode_rows)]
+
+
+def measure(encode, ds_connection: sqlite3.Connection, repeat: int) -> dict:
+    """Time `encode` and record the peak memory it allocates."""
+    timings = list()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = encode(ds_connection)
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    encode(ds_connection)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"ms": min(timings) * 1000,
+            "peak_mb": peak / 1024 / 1024,
+            "body_bytes": len(body)}
+
+
+def run(rows: int, repeat: int) -> list:
+    """Benchmark every variant and return a list of result dicts."""
+    ds_connection = sqlite3.connect(':memory:')
+    migrations.migrate(ds_connection)
+    seed_friends(ds_connection, rows)
+
+    if encode_dict_stream(ds_connection) != encode_rows(ds_connection):
+        raise AssertionError("The row encoder's output differs from "
+                             "json.dumps().")
+
+    results = list()
+    for name, encode in VARIANTS:
+        result = measure(encode, ds_connection, repeat)
+        result["variant"] = name
+        results.append(result)
+
+    ds_connection.close()
+    return results
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the benchmark's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Compare ways of encoding the friends collection.")
+    parser.add_argument(
+        "--rows", type=int, default=100000,
+        help="Friends in the collection.")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="Timed runs per variant; the best is reported.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    print("{:<12} {:>9} {:>13} {:>12}".format(
+        "variant", "ms", "peak MB", "body bytes"))
+    for result in run(arguments.rows, arguments.repeat):
+        print("{variant:<12} {ms:>9.1f} {peak_mb:>13.1f} "
+              "{body_bytes:>12}".format(**result))
@@ -0,0 +1,140 @@
+"""
+Measure full-text searches of the friends_search index at several table
+sizes.
+
+For each size a scratch datastore is migrated and seeded with friends
+whose names are drawn from a few thousand generated names, then a page
+of the best matches is fetched for random one and two word prefix
+queries, the same way GET /api/v1/friends/search does.
+
+    python -m benchmarks.search --sizes 10000 100000 1000000
+
+Queries are ranked, so every match is scored before the best page is
+returned: the cost depends on how many friends match rather than on the
+size of the table.  The "matches" column shows the average match count.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import string
+import tempfile
+import time
+
+from benchmarks.seed import generated_names
+from bfp_friends_api import api_helpers
+from bfp_friends_api import datastore
+from bfp_friends_api import migrations
+
+
+def seed_friends(ds_connection: sqlite3.Connection, row_count: int,
+                 first_names: list, last_names: list):
+    """Fill a migrated datastore with `row_count` friends."""
+    generator = random.Random(row_count)
+    words = ["".join(generator.choice(string.ascii_lowercase)
+                     for _ in range(generator.randint(3, 9)))
+             for _ in range(5000)]
+
+    def friend_rows():
+        for number in range(row_count):
+            first_name = generator.choice(first_names)
+            last_name = generator.choice(last_names)
+            yield ("Friend-{}".format(number), first_name, last_name,
+                   "555-0100",
+                   "{}.{}@example.com".format(first_name, last_name).lower(),
+                   " ".join(generator.choice(words) for _ in range(12)))
+
+    ds_connection.executemany(
+        'insert into friends (id, first_name, last_name, telephone, email, '
+        'notes) values (?, ?, ?, ?, ?, ?)', friend_rows())
+    ds_connection.commit()
+
+
+def time_searches(ds_connection: sqlite3.Connection, queries: list,
+                  limit: int) -> tuple:
+    """
+    Return the mean microseconds taken to fetch a page of results for
+    each query, and the mean number of friends each query matched.
+    """
+    started = time.perf_counter()
+    for query in queries:
+        datastore.search_friends(ds_connection, query, limit)
+    elapsed = time.perf_counter() - started
+
+    matches = sum(
+        ds_connection.execute(
+            'select count(*) from friends_search where friends_search '
+            'match ?', [query]).fetchone()[0]
+        for query in queries)
+
+    return elapsed / len(queries) * 1000000, matches / len(queries)
+
+
+def run(sizes: list, searches: int, limit: int) -> list:
+    """
+    Benchmark every table size and return a list of result dicts.
+    """
+    first_names = generated_names(2000, seed=1)
+    last_names = generated_names(5000, seed=2)
+    generator = random.Random(0)
+
+    results = list()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            ds_connection = sqlite3.connect(
+                os.path.join(directory, "friends.db"))
+            migrations.migrate(ds_connection)
+            seed_friends(ds_connection, size, first_names, last_names)
+
+            # Prefixes of seeded friends' names, as typed into a search
+            # box.
+            names = [ds_connection.execute(
+                'select first_name, last_name from friends where rowid = ?',
+                [generator.randint(1, size)]).fetchone()
+                for _ in range(searches)]
+            workloads = {
+                "first name": [api_helpers.search_query(first_name[:5])
+                               for first_name, _ in names],
+                "first + last": [api_helpers.search_query(
+                    "{} {}".format(first_name[:4], last_name[:4]))
+                    for first_name, last_name in names],
+            }
+
+            for workload, queries in workloads.items():
+                search_us, matches = time_searches(ds_connection, queries,
+                                                   limit)
+                results.append({"rows": size,
+                                "workload": workload,
+                                "search_us": search_us,
+                                "matches": matches})
+            ds_connection.close()
+
+    return results
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the benchmark's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark full-text searches at several table sizes.")
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, metavar="ROWS",
+        default=[10000, 100000, 1000000],
+        help="Table sizes to benchmark.")
+    parser.add_argument(
+        "--searches", type=int, default=1000,
+        help="Searches to time per table size and workload.")
+    parser.add_argument(
+        "--limit", type=int, default=20,
+        help="Results to fetch per search.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    print("{:>10} {:<14} {:>11} {:>10}".format(
+        "rows", "workload", "search us", "matches"))
+    for result in run(arguments.sizes, arguments.searches, arguments.limit):
+        print("{rows:>10} {workload:<14} {search_us:>11.1f} "
+              "{matches:>10.1f}".format(**result))
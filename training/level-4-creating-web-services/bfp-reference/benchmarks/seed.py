@@ -0,0 +1,91 @@
+"""
+Seed a datastore with a reproducible set of friends for benchmarking.
+
+The same row count and seed always produce the same friends, so runs
+against different revisions of the API start from identical data.
+
+    python -m benchmarks.seed --rows 100000 --database /tmp/friends.db
+
+Any existing datastore at the given path is replaced.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+
+from bfp_friends_api import migrations
+
+
+def generated_names(count: int, seed: int) -> list:
+    """Return `count` distinct pronounceable, capitalized names."""
+    generator = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        names.add("".join(
+            generator.choice("bcdfghjklmnprstvwz") + generator.choice("aeiou")
+            for _ in range(generator.randint(2, 4))).capitalize())
+    return sorted(names)
+
+
+def friend_rows(row_count: int, seed: int=0):
+    """
+    Yield (id, first_name, last_name, telephone, email, notes) tuples
+    for `row_count` friends with ids Friend-0, Friend-1, ...
+    """
+    first_names = generated_names(2000, seed=seed + 1)
+    last_names = generated_names(5000, seed=seed + 2)
+    generator = random.Random(seed)
+
+    for number in range(row_count):
+        first_name = generator.choice(first_names)
+        last_name = generator.choice(last_names)
+        yield ("Friend-{}".format(number), first_name, last_name,
+               "555-{:04d}".format(generator.randrange(10000)),
+               "{}.{}@example.com".format(first_name, last_name).lower(),
+               "Met {} at the {} in {}.".format(
+                   first_name,
+                   generator.choice(["office", "gym", "park", "library"]),
+                   generator.randrange(1990, 2020)))
+
+
+def seed_datastore(database: str, row_count: int, seed: int=0):
+    """
+    Create a migrated datastore at `database` holding `row_count`
+    friends, replacing any datastore already there.
+    """
+    for path in [database, database + '-wal', database + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+
+    ds_connection = sqlite3.connect(database)
+    migrations.migrate(ds_connection)
+    ds_connection.executemany(
+        'insert into friends (id, first_name, last_name, telephone, email, '
+        'notes) values (?, ?, ?, ?, ?, ?)',
+        friend_rows(row_count, seed))
+    ds_connection.commit()
+    ds_connection.close()
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the seeder's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Seed a datastore with reproducible friends.")
+    parser.add_argument(
+        "--rows", type=int, default=10000,
+        help="Friends to create.")
+    parser.add_argument(
+        "--database", default="/tmp/friends.db",
+        help="Path of the datastore to (re)create.")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed of the generated data.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+    seed_datastore(arguments.database, arguments.rows, arguments.seed)
+    print("Seeded {} with {} friends.".format(arguments.database,
+                                              arguments.rows))
@@ -0,0 +1,84 @@
+"""
+Run the Friends API on a local server in a subprocess, for benchmarks
+that drive it over HTTP.
+"""
+
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# The body of the server subprocess.  The datastore settings come from
+# the environment so the app's configuration is set before the first
+# request.
+SERVER_SCRIPT = """
+import os
+import sys
+
+from bfp_friends_api import api
+
+api.app.config['DATASTORE_PATH'] = os.environ['BENCHMARK_DATASTORE_PATH']
+api.app.config['DATASTORE_PROFILE'] = os.environ['BENCHMARK_DATASTORE_PROFILE']
+server, port = sys.argv[1], int(sys.argv[2])
+
+if server == 'wsgi':
+    from werkzeug.serving import run_simple
+    run_simple('127.0.0.1', port, api.app, threaded=True)
+else:
+    import uvicorn
+    uvicorn.run('bfp_friends_api.asgi:app', host='127.0.0.1', port=port,
+                log_level='warning', access_log=False)
+"""
+
+SERVERS = ["wsgi", "asgi"]
+
+
+def free_port() -> int:
+    """Return a TCP port that is currently unused on localhost."""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float=15.0):
+    """Block until something accepts connections on `port`."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError("Nothing is listening on port {}.".format(port))
+
+
+@contextlib.contextmanager
+def serve(server: str, database: str, profile: str="default"):
+    """
+    Run the API under `server` ("wsgi" for werkzeug's threaded server or
+    "asgi" for uvicorn) in a subprocess and yield the port it listens on.
+
+    Args:
+        server (str): One of SERVERS.
+        database (str): The datastore path the API should use.
+        profile (str): The DATASTORE_PROFILE the API should use.
+    """
+    if server not in SERVERS:
+        raise ValueError("Unknown server {!r}.  Choose one of: {}".format(
+            server, SERVERS))
+
+    port = free_port()
+    environment = dict(os.environ,
+                       BENCHMARK_DATASTORE_PATH=database,
+                       BENCHMARK_DATASTORE_PROFILE=profile)
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVER_SCRIPT, server, str(port)],
+        env=environment, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        yield port
+    finally:
+        process.terminate()
+        process.wait()
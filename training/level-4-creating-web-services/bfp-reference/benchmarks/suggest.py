@@ -0,0 +1,86 @@
+"""
+Measure name suggestions from the in-memory prefix index at several
+index sizes, along with the memory the index holds.
+
+    python -m benchmarks.suggest --sizes 10000 100000 1000000
+
+"add us" is the cost of indexing one more friend (including shifting
+the tail of the sorted lists), which every write to a friend pays.
+"""
+
+import argparse
+import random
+import time
+
+from benchmarks.seed import generated_names
+from bfp_friends_api.prefix_index import PrefixIndex
+
+
+def time_calls(call, arguments: list) -> float:
+    """Return the mean number of microseconds taken by call(argument)."""
+    started = time.perf_counter()
+    for argument in arguments:
+        call(*argument)
+    return (time.perf_counter() - started) / len(arguments) * 1000000
+
+
+def run(sizes: list, suggestions: int, limit: int) -> list:
+    """
+    Benchmark every index size and return a list of result dicts.
+    """
+    first_names = generated_names(2000, seed=1)
+    last_names = generated_names(5000, seed=2)
+    generator = random.Random(0)
+
+    results = list()
+    for size in sizes:
+        index = PrefixIndex()
+        friends = [{"id": "Friend-{}".format(number),
+                    "first_name": generator.choice(first_names),
+                    "last_name": generator.choice(last_names)}
+                   for number in range(size)]
+        index.load(friends)
+
+        # One to four letters of a name, as typed into a search box.
+        prefixes = [(generator.choice(first_names + last_names)[
+            :generator.randint(1, 4)], limit) for _ in range(suggestions)]
+        additions = [("New-{}".format(number),
+                      generator.choice(first_names),
+                      generator.choice(last_names))
+                     for number in range(min(suggestions, 1000))]
+
+        results.append({
+            "friends": size,
+            "suggest_us": time_calls(index.suggest, prefixes),
+            "add_us": time_calls(index.add, additions),
+            "megabytes": index.stats()["bytes"] / 1024 / 1024})
+
+    return results
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the benchmark's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark name suggestions at several index sizes.")
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, metavar="FRIENDS",
+        default=[10000, 100000, 1000000],
+        help="Index sizes to benchmark.")
+    parser.add_argument(
+        "--suggestions", type=int, default=10000,
+        help="Suggestions to time per index size.")
+    parser.add_argument(
+        "--limit", type=int, default=10,
+        help="Friends to suggest per prefix.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    print("{:>10} {:>11} {:>9} {:>10}".format(
+        "friends", "suggest us", "add us", "MB"))
+    for result in run(arguments.sizes, arguments.suggestions,
+                      arguments.limit):
+        print("{friends:>10} {suggest_us:>11.1f} {add_us:>9.1f} "
+              "{megabytes:>10.1f}".format(**result))
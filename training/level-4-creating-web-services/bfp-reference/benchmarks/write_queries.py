@@ -0,0 +1,120 @@
+"""
+Count the queries issued per friend write, with and without the
+existence check that used to precede every write.
+
+The "pre-read" variant replays the old request flow -- get_friend()
+followed by the write -- while the "single statement" variant calls the
+write function alone, which now detects a missing or duplicate friend
+itself.  Statements are counted with a trace callback, as the SQL traces
+of requests count them (see tracing.QueryTrace); BEGIN/COMMIT are
+reported separately since both variants issue them.
+
+    python -m benchmarks.write_queries --writes 5000
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from bfp_friends_api import datastore
+from bfp_friends_api import migrations
+from bfp_friends_api import tracing
+
+
+def friend_entry(number: int, first_name: str="First") -> dict:
+    """Return a friend representation as the API receives it."""
+    return {"id": "Friend-{}".format(number),
+            "firstName": first_name,
+            "lastName": "Last",
+            "telephone": "555-0100",
+            "email": "friend{}@example.com".format(number),
+            "notes": "Benchmarked."}
+
+
+def run_writes(ds_connection: sqlite3.Connection, writes: int,
+               pre_read: bool) -> dict:
+    """
+    Create, update and delete `writes` friends and return the number of
+    queries and the time taken per write for each operation.
+    """
+    # Counted the way request traces count them: SQLite also reports the
+    # statements its triggers run (e.g. to maintain the full-text index)
+    # and reports a statement again for every trigger it fires, none of
+    # which are extra round trips.
+    trace = tracing.QueryTrace()
+    ds_connection.set_trace_callback(trace.record_statement)
+
+    operations = [
+        ("create", lambda number: datastore.add_friend(
+            ds_connection, friend_entry(number))),
+        ("update", lambda number: datastore.fully_update_friend(
+            ds_connection, "Friend-{}".format(number),
+            friend_entry(number, "Updated"))),
+        ("delete", lambda number: datastore.delete_friend(
+            ds_connection, "Friend-{}".format(number))),
+    ]
+
+    results = dict()
+    for name, operation in operations:
+        del trace.statements[:]
+        started = time.perf_counter()
+        for number in range(writes):
+            if pre_read:
+                datastore.get_friend(ds_connection, "Friend-{}".format(number))
+            operation(number)
+        elapsed = time.perf_counter() - started
+
+        keywords = [statement.split()[0].upper()
+                    for statement in trace.statements]
+        transaction_statements = sum(
+            1 for keyword in keywords if keyword in {"BEGIN", "COMMIT"})
+        results[name] = {
+            "queries_per_write":
+                (len(keywords) - transaction_statements) / writes,
+            "transaction_statements_per_write":
+                transaction_statements / writes,
+            "us_per_write": elapsed / writes * 1000000}
+
+    ds_connection.set_trace_callback(None)
+    return results
+
+
+def run(writes: int) -> dict:
+    """Benchmark both variants against scratch datastores."""
+    # Every pre-read must reach SQLite, as it did before the cache.
+    datastore.friend_cache.max_size = 0
+
+    results = dict()
+    for variant, pre_read in [("pre-read", True), ("single statement", False)]:
+        with tempfile.TemporaryDirectory() as directory:
+            ds_connection = sqlite3.connect(
+                os.path.join(directory, "friends.db"))
+            migrations.migrate(ds_connection)
+            results[variant] = run_writes(ds_connection, writes, pre_read)
+            ds_connection.close()
+
+    return results
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the benchmark's command line options."""
+    parser = argparse.ArgumentParser(
+        description="Count the queries issued per friend write.")
+    parser.add_argument(
+        "--writes", type=int, default=2000,
+        help="Friends to create, update and delete per variant.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    print("{:<18} {:<8} {:>9} {:>13} {:>10}".format(
+        "variant", "write", "queries", "begin/commit", "us"))
+    for variant, operations in run(arguments.writes).items():
+        for name, result in operations.items():
+            print("{:<18} {:<8} {queries_per_write:>9.1f} "
+                  "{transaction_statements_per_write:>13.1f} "
+                  "{us_per_write:>10.1f}".format(variant, name, **result))
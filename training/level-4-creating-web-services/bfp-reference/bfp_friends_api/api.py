@@ -2,36 +2,520 @@
 Provides a Flask API to interact with Friendship data.
 """
 
-import sqlite3
+import concurrent.futures
+import threading
+import time
 
-from flask import Flask, jsonify, make_response, request, g
+from flask import (Flask, Response, jsonify, make_response, request, g,
+                   stream_with_context, url_for)
 
 from bfp_friends_api import datastore
 from bfp_friends_api import api_helpers
+from bfp_friends_api import compression
+from bfp_friends_api import events
+from bfp_friends_api import metrics
+from bfp_friends_api import migrations
+from bfp_friends_api import snapshot
+from bfp_friends_api import tracing
+from bfp_friends_api import writer
+from bfp_friends_api.cache import LRUCache
+from bfp_friends_api.pool import ConnectionPool
 
 app = Flask(__name__)
+app.config.update(
+    DATASTORE_PATH="/tmp/friends.db",
+    DATASTORE_POOL_SIZE=5,
+    DATASTORE_POOL_TIMEOUT=5.0,
+    DATASTORE_POOL_HEALTH_CHECK_INTERVAL=30.0,
+    DATASTORE_PROFILE="default",
+    DATASTORE_PROFILE_OVERRIDES={},
+    DATASTORE_WRITE_TIMEOUT=10.0,
+    READ_SNAPSHOT_ENABLED=False,
+    READ_SNAPSHOT_MAX_STALENESS=1.0,
+    READ_SNAPSHOT_MIN_INTERVAL=0.25,
+    # Streaming sends GET /api/v1/friends in chunks as rows are read,
+    # with flat memory use, so it takes precedence over (and bypasses)
+    # FRIENDS_COLLECTION_CACHE, which holds whole encoded bodies.
+    FRIENDS_COLLECTION_STREAMING=False,
+    FRIENDS_COLLECTION_BATCH_SIZE=500,
+    FRIENDS_PAGE_SIZE=100,
+    FRIENDS_MAX_PAGE_SIZE=1000,
+    FRIENDS_SUGGEST_LIMIT=10,
+    FRIENDS_SUGGEST_MAX_LIMIT=100,
+    FRIEND_CACHE_SIZE=1024,
+    FRIEND_CACHE_TTL=60.0,
+    FRIENDS_COLLECTION_CACHE=True,
+    COMPRESSION_ENABLED=True,
+    COMPRESSION_MIN_SIZE=1024,
+    COMPRESSION_GZIP_LEVEL=6,
+    COMPRESSION_BROTLI_QUALITY=5,
+    COMPRESSION_CACHE_SIZE=32,
+    EVENTS_RING_SIZE=1000,
+    EVENTS_QUEUE_SIZE=100,
+    # Each open event stream is served by a thread of its own for up to
+    # EVENTS_STREAM_TIMEOUT seconds.  The ASGI wrapper (see asgi.py)
+    # keeps exactly this many stream threads apart from its handlers;
+    # under a WSGI server with a fixed number of threads, keep this
+    # well below that number so that other requests are still served.
+    EVENTS_MAX_SUBSCRIBERS=100,
+    EVENTS_HEARTBEAT_INTERVAL=15.0,
+    EVENTS_STREAM_TIMEOUT=300.0,
+    METRICS_ENABLED=True,
+    SQL_TRACE_ENABLED=False,
+    SQL_TRACE_QUERY_BUDGET=10,
+    SQL_TRACE_REPEAT_THRESHOLD=3,
+    ASGI_EXECUTOR_WORKERS=None)
 
 FRIEND_RESOURCE_ELEMENTS = {"id", "firstName", "lastName",
                             "telephone", "email", "notes"}
 
+# Endpoints that never touch the datastore.
+IN_MEMORY_ENDPOINTS = {"suggest_friends", "get_metrics", "friend_events"}
+
+# Endpoints other than GETs that only read from the datastore.
+READ_ONLY_ENDPOINTS = {"lookup_friends"}
+
+# The WSGI environ key of a list that a server may provide, to which
+# streaming endpoints add functions that end their stream.  The server
+# calls them as soon as the client disconnects; otherwise a stream only
+# notices when its next write fails.
+DISCONNECT_CALLBACKS = 'bfp_friends_api.disconnect_callbacks'
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+_group_commit_writer = None
+_read_snapshot = None
+
+# Encoded GET /api/v1/friends bodies keyed on generation.
+_collection_cache = LRUCache(max_size=4)
+
+# Compressed response bodies keyed on (path and query, ETag, encoding).
+_compressed_cache = LRUCache(max_size=32)
+
+# Latency and payload sizes of the requests handled, for GET /metrics.
+request_metrics = metrics.RequestMetrics()
+
+# Committed changes to friends, for GET /api/v1/friends/events.
+event_broker = events.EventBroker()
+
+
+def connection_pool() -> ConnectionPool:
+    """
+    Return the pool of datastore connections, creating it from the
+    `DATASTORE_*` settings in app.config the first time it is needed.
+
+    Connections are configured by the DATASTORE_PROFILE (see
+    writer.PROFILES), and if the profile asks for group commits the
+    writer thread is started alongside the pool.
+
+    The datastore's schema is brought up to date, the datastore's
+    friend cache, the compressed response cache and the event broker
+    are sized from `FRIEND_CACHE_*`, COMPRESSION_CACHE_SIZE and
+    `EVENTS_*`, and the name index used for suggestions is loaded when
+    the pool is created.
+
+    With READ_SNAPSHOT_ENABLED the read tier (see snapshot.ReadSnapshot)
+    is started alongside the pool, with as many in-memory copies as the
+    pool has connections.
+    """
+    global _connection_pool, _group_commit_writer, _read_snapshot
+
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                settings = writer.profile_settings(
+                    app.config['DATASTORE_PROFILE'],
+                    app.config['DATASTORE_PROFILE_OVERRIDES'])
+
+                def configure_connection(ds_connection):
+                    writer.apply_pragmas(ds_connection, settings)
+
+                pool = ConnectionPool(
+                    app.config['DATASTORE_PATH'],
+                    max_size=app.config['DATASTORE_POOL_SIZE'],
+                    timeout=app.config['DATASTORE_POOL_TIMEOUT'],
+                    health_check_interval=app.config[
+                        'DATASTORE_POOL_HEALTH_CHECK_INTERVAL'],
+                    on_connect=configure_connection)
+
+                with pool.connection() as ds_connection:
+                    applied = migrations.migrate(ds_connection)
+                    datastore.name_index.load(
+                        datastore.iter_friends(ds_connection))
+                app.logger.info(migrations.describe_migration(
+                    app.config['DATASTORE_PATH'], applied))
+                app.logger.info(
+                    "Loaded {friends} friends into the name index "
+                    "({bytes} bytes).".format(**datastore.name_index.stats()))
+
+                datastore.friend_cache.max_size = app.config[
+                    'FRIEND_CACHE_SIZE']
+                datastore.friend_cache.ttl = app.config['FRIEND_CACHE_TTL']
+                _compressed_cache.max_size = app.config[
+                    'COMPRESSION_CACHE_SIZE']
+                event_broker.ring_size = app.config['EVENTS_RING_SIZE']
+                event_broker.queue_size = app.config['EVENTS_QUEUE_SIZE']
+                event_broker.max_subscribers = app.config[
+                    'EVENTS_MAX_SUBSCRIBERS']
+
+                if settings['group_commit']:
+                    _group_commit_writer = writer.GroupCommitWriter(
+                        app.config['DATASTORE_PATH'],
+                        window=settings['group_commit_window'],
+                        max_batch=settings['group_commit_max_batch'],
+                        on_connect=configure_connection)
+
+                if app.config['READ_SNAPSHOT_ENABLED']:
+                    _read_snapshot = snapshot.ReadSnapshot(
+                        app.config['DATASTORE_PATH'],
+                        max_size=app.config['DATASTORE_POOL_SIZE'],
+                        timeout=app.config['DATASTORE_POOL_TIMEOUT'],
+                        max_staleness=app.config[
+                            'READ_SNAPSHOT_MAX_STALENESS'],
+                        min_interval=app.config['READ_SNAPSHOT_MIN_INTERVAL'],
+                        on_connect=configure_connection,
+                        on_refresh=datastore.friend_cache.clear)
+                    _read_snapshot.start()
+
+                _connection_pool = pool
+
+    return _connection_pool
+
+
+def publish_changes(changes: list):
+    """
+    Publish the changes of a commit to the change feed.  Registered as
+    one of the datastore's commit_listeners.
+
+    Args:
+        changes (list): (change, id, entry_data) tuples, as passed to
+            datastore._finish_write().
+    """
+    for change, id, entry_data in changes:
+        if entry_data is None:
+            data = {"id": id}
+        else:
+            data = {column: entry_data[element] for element, column
+                    in datastore.FRIEND_COLUMNS.items()}
+        event_broker.publish(change, data)
+
+
+datastore.commit_listeners.append(publish_changes)
+
+
+def write(function, *args):
+    """
+    Perform a datastore write function for the current request.
+
+    With group commits enabled the write is handed to the writer thread
+    and this waits, up to DATASTORE_WRITE_TIMEOUT seconds, until the
+    transaction containing it has committed; otherwise it runs and
+    commits on the request's own connection.
+
+    Args:
+        function: One of the datastore write functions.
+        *args: The arguments to pass after the connection.
+
+    Returns:
+        Whatever `function` returns.  Exceptions it raises propagate.
+
+    Raises:
+        TimeoutError: If the writer thread didn't commit the write in
+            time (answered with a 503 by datastore_unavailable()).
+    """
+    if _group_commit_writer is None:
+        result = function(g.datastore, *args)
+    else:
+        future = _group_commit_writer.submit(function, *args)
+        try:
+            result = future.result(
+                timeout=app.config['DATASTORE_WRITE_TIMEOUT'])
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                raise TimeoutError(
+                    "The datastore writer didn't start the write within "
+                    "{} seconds.  It was not applied.".format(
+                        app.config['DATASTORE_WRITE_TIMEOUT']))
+            raise TimeoutError(
+                "The datastore writer didn't commit the write within {} "
+                "seconds.  It may still be applied.".format(
+                    app.config['DATASTORE_WRITE_TIMEOUT']))
+
+    if _read_snapshot is not None:
+        _read_snapshot.notify()
+    return result
+
+
+@app.before_request
+def start_request_metrics():
+    """
+    Note when each request started and count it as in flight.
+
+    Registered ahead of connect_to_datastore() so that waiting for a
+    pooled connection counts towards the request's latency.
+    """
+    if app.config['METRICS_ENABLED']:
+        g.request_started = time.perf_counter()
+        request_metrics.started()
+
 
 @app.before_request
 def connect_to_datastore():
     """
-    Establish a connection to the store for each request.
+    Check out a pooled connection to the store for each request.
 
     Make the connection available on Flask's special 'g' object.
+    Endpoints that are answered from memory don't check one out.
+
+    With READ_SNAPSHOT_ENABLED, GET requests (and READ_ONLY_ENDPOINTS)
+    are given an in-memory copy of the datastore instead, which may be up to about
+    READ_SNAPSHOT_MAX_STALENESS seconds behind the latest writes (a
+    write made through this API shows up within
+    READ_SNAPSHOT_MIN_INTERVAL seconds plus the time a refresh takes).
+    While the copy is older than that, they read the datastore itself.
+
+    With SQL_TRACE_ENABLED the statements run on the connection and the
+    time spent in datastore functions are traced (see tracing.QueryTrace)
+    until the request ends.
     """
-    g.datastore = sqlite3.connect("/tmp/friends.db")
+    pool = connection_pool()
+    if request.endpoint in IN_MEMORY_ENDPOINTS:
+        pass
+    elif (_read_snapshot is not None and
+          (request.method in ('GET', 'HEAD') or
+           request.endpoint in READ_ONLY_ENDPOINTS) and
+          _read_snapshot.is_fresh()):
+        g.datastore = _read_snapshot.acquire()
+        g.datastore_source = _read_snapshot
+    else:
+        g.datastore = pool.acquire()
+        g.datastore_source = pool
+
+    if app.config['SQL_TRACE_ENABLED']:
+        g.query_trace = tracing.start(getattr(g, 'datastore', None))
+
+
+def _switch_to_connection_pool():
+    """
+    Hand the request's read snapshot connection back and check out a
+    pooled connection to the datastore itself in its place.
+    """
+    query_trace = getattr(g, 'query_trace', None)
+    if query_trace is not None:
+        g.datastore.set_trace_callback(None)
+    g.datastore_source.release(g.datastore)
+    g.datastore = None
+
+    pool = connection_pool()
+    g.datastore = pool.acquire()
+    g.datastore_source = pool
+    if query_trace is not None:
+        g.datastore.set_trace_callback(query_trace.record_statement)
+
 
 @app.teardown_request
 def disconnect_from_datastore(exception):
     """
-    Close the connection to the datastore after each request.
+    Return the request's connection to the pool (or read snapshot) it
+    came from after each request, ending and logging its SQL trace, if
+    it has one.
     """
-    datastore = getattr(g, 'datastore', None)
+    # Popped, because stream_with_context() runs the teardown functions
+    # again once a streamed response has been sent.
+    datastore = g.pop('datastore', None)
+    datastore_source = g.pop('datastore_source', None)
+    query_trace = g.pop('query_trace', None)
+    if query_trace is not None:
+        tracing.stop(datastore)
+        _log_query_trace(query_trace)
+
     if datastore is not None:
-        datastore.close()
+        datastore_source.release(datastore)
+
+
+def _log_query_trace(query_trace: tracing.QueryTrace):
+    """
+    Log a one line summary of a request's SQL trace.
+
+    Requests that ran more than SQL_TRACE_QUERY_BUDGET statements, or
+    ran the same statement (give or take its parameters)
+    SQL_TRACE_REPEAT_THRESHOLD or more times, are logged as warnings
+    along with the statements they ran.
+
+    Writes handed to the group commit writer run on its connection, so
+    they aren't part of the trace.
+    """
+    message = "{} {}: {}".format(request.method, request.full_path,
+                                 query_trace.summary())
+    repeated = query_trace.repeated_statements(
+        app.config['SQL_TRACE_REPEAT_THRESHOLD'])
+    over_budget = (query_trace.query_count >
+                   app.config['SQL_TRACE_QUERY_BUDGET'])
+
+    if not (over_budget or repeated):
+        app.logger.info(message)
+        return
+
+    if over_budget:
+        message += "; over the budget of {} queries".format(
+            app.config['SQL_TRACE_QUERY_BUDGET'])
+    for shape, count in repeated:
+        message += "; ran {} times: {}".format(count, shape)
+    message += "\n" + "\n".join(query_trace.statements)
+    app.logger.warning(message)
+
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    """
+    Stop counting each request as in flight once it is done.
+
+    stream_with_context() runs the teardown functions a second time
+    once a streamed response is sent, so the start time is popped and
+    the request is only counted as finished the first time.
+    """
+    if g.pop('request_started', None) is not None:
+        request_metrics.finished()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Record each request's latency and payload sizes against the route
+    that matched it, its method and its response status.
+
+    Registered ahead of compress_response() so that it runs after it
+    (Flask runs after_request functions in reverse) and records the
+    size of the body actually sent.  Streamed responses have no
+    Content-Length, so their size isn't recorded.
+    """
+    started = getattr(g, 'request_started', None)
+    if started is None:
+        return response
+
+    route = '<unmatched>'
+    if request.url_rule is not None:
+        route = request.url_rule.rule
+
+    request_metrics.observe(route, request.method, response.status_code,
+                            time.perf_counter() - started,
+                            request.content_length or 0,
+                            response.content_length)
+    return response
+
+
+@app.after_request
+def report_query_trace(response):
+    """
+    Summarize the request's SQL trace, if it has one, in an X-Query-Count
+    header and a `db` Server-Timing metric.
+
+    A streamed collection takes its trace along with its connection, as
+    its statements run after the headers are sent, so they are only in
+    the log line (see _log_query_trace()).
+    """
+    query_trace = getattr(g, 'query_trace', None)
+    if query_trace is not None:
+        response.headers['X-Query-Count'] = str(query_trace.query_count)
+        response.headers['Server-Timing'] = (
+            'db;dur={:.3f};desc="{} queries"'.format(
+                query_trace.query_seconds * 1000, query_trace.query_count))
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress response bodies with the best content coding the client
+    accepts (see compression.negotiate()).
+
+    Only complete (not streamed) 200 responses of a compressible type
+    and at least COMPRESSION_MIN_SIZE bytes are compressed, at
+    COMPRESSION_GZIP_LEVEL or COMPRESSION_BROTLI_QUALITY.
+
+    Responses with an ETag are cacheable: their compressed bodies are
+    kept, keyed on the request's path and query, the ETag and the
+    coding, so a repeat of the same response isn't compressed again.
+    ETags are weak, so they stay valid across codings.
+    """
+    if (not app.config['COMPRESSION_ENABLED'] or
+            response.status_code != 200 or
+            response.is_streamed or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in compression.COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    content_encoding = compression.negotiate(request.accept_encodings)
+    if (content_encoding == 'identity' or
+            len(response.get_data()) < app.config['COMPRESSION_MIN_SIZE']):
+        return response
+
+    etag, _ = response.get_etag()
+    cache_key = None
+    body = None
+    if etag is not None:
+        cache_key = (request.full_path, etag, content_encoding)
+        body = _compressed_cache.get(cache_key)
+
+    if body is None:
+        level = app.config['COMPRESSION_GZIP_LEVEL']
+        if content_encoding == 'br':
+            level = app.config['COMPRESSION_BROTLI_QUALITY']
+        body = compression.compress(response.get_data(), content_encoding,
+                                    level)
+        if cache_key is not None:
+            _compressed_cache.put(cache_key, body)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = content_encoding
+    return response
+
+
+@app.errorhandler(TimeoutError)
+def datastore_unavailable(error):
+    """Report an exhausted connection pool as a temporary outage."""
+    return make_response(jsonify({"error": str(error)}), 503)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Return the request metrics and the statistics of the connection
+    pool, the caches, the name index, the group commit writer, the read
+    snapshot and the change feed in the Prometheus text exposition
+    format.
+    """
+    gauges = dict()
+    gauges.update(metrics.stats_gauges(
+        'datastore_pool', connection_pool().stats(),
+        "Datastore connection pool"))
+    gauges.update(metrics.stats_gauges(
+        'friend_cache', datastore.friend_cache.stats(),
+        "Cache of friend representations"))
+    gauges.update(metrics.stats_gauges(
+        'collection_cache', _collection_cache.stats(),
+        "Cache of encoded friends collections"))
+    gauges.update(metrics.stats_gauges(
+        'compressed_cache', _compressed_cache.stats(),
+        "Cache of compressed response bodies"))
+    gauges.update(metrics.stats_gauges(
+        'name_index', datastore.name_index.stats(),
+        "Name index used for suggestions"))
+    if _group_commit_writer is not None:
+        gauges.update(metrics.stats_gauges(
+            'group_commit', _group_commit_writer.stats(),
+            "Group commit writer"))
+    if _read_snapshot is not None:
+        gauges.update(metrics.stats_gauges(
+            'read_snapshot', _read_snapshot.stats(),
+            "In-memory read snapshot"))
+    gauges.update(metrics.stats_gauges(
+        'events', event_broker.stats(), "Change feed"))
+
+    return Response(request_metrics.exposition(gauges),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 """
@@ -39,9 +523,526 @@ Operations for the Friends Resource Collection
 """
 @app.route('/api/v1/friends', methods=['GET'])
 def get_friends():
-    """Return a representation of the collection of friend resources."""
-    friends_collection = datastore.get_friends(g.datastore)
-    return jsonify({"friends": friends_collection})
+    """
+    Return a representation of the collection of friend resources.
+
+    Passing a `limit` and/or `cursor` query parameter returns a single
+    page of the collection along with a `next` link (and Link header)
+    for the following page, if there is one.
+
+    When FRIENDS_COLLECTION_STREAMING is enabled the representation is
+    encoded and sent in chunks as rows are read from the datastore, so
+    memory use doesn't grow with the size of the collection.
+
+    Otherwise, when FRIENDS_COLLECTION_CACHE is enabled the encoded
+    representation is cached against the datastore's write generation
+    and reused until the next write.  (Compressed copies of it are
+    cached by compress_response().)
+
+    Passing a `fields` query parameter (e.g. `fields=id,firstName`)
+    limits each representation to those elements, plus `id`.  Only
+    their columns are read from the datastore.  Such representations
+    aren't cached.
+
+    Passing a `since` query parameter returns only the changes made
+    after that version (see _get_friends_changes()), and passing an
+    `ids` query parameter (e.g. `ids=bfp,dDuck`) returns only those
+    friends (see _get_friends_by_id()).
+
+    Every response carries an ETag derived from the datastore's write
+    generation.  If the client already holds it (If-None-Match), a 304
+    is returned before any rows are read.
+    """
+    try:
+        columns = _requested_columns()
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    if 'since' in request.args:
+        return _get_friends_changes(columns)
+    if 'ids' in request.args:
+        return _get_friends_by_id(
+            [id.strip() for id in request.args['ids'].split(',')], columns)
+
+    generation = datastore.generation(g.datastore)
+    paged = 'limit' in request.args or 'cursor' in request.args
+    streamed = app.config['FRIENDS_COLLECTION_STREAMING']
+    cached = (app.config['FRIENDS_COLLECTION_CACHE'] and not streamed and
+              columns is None)
+
+    etag = _generation_etag(generation)
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+
+    if paged:
+        response = _get_friends_page(columns)
+    elif cached:
+        response = _get_cached_friends_collection(generation)
+    elif streamed:
+        # The body is read after the request's teardown, so the stream
+        # takes the request's connection (and SQL trace) with it.
+        ds_connection = g.pop('datastore')
+        encoded_friends = datastore.iter_encoded_friends(
+            ds_connection, app.config['FRIENDS_COLLECTION_BATCH_SIZE'],
+            columns)
+        chunks = _stream_from_connection(
+            _encode_friends_collection(
+                encoded_friends, app.config['FRIENDS_COLLECTION_BATCH_SIZE']),
+            ds_connection, g.pop('datastore_source'),
+            g.pop('query_trace', None))
+        response = Response(stream_with_context(chunks),
+                            mimetype='application/json')
+    else:
+        encoded_friends = datastore.iter_encoded_friends(
+            g.datastore, app.config['FRIENDS_COLLECTION_BATCH_SIZE'],
+            columns)
+        response = Response(
+            b''.join(_encode_friends_collection(
+                encoded_friends,
+                app.config['FRIENDS_COLLECTION_BATCH_SIZE'])),
+            mimetype='application/json')
+
+    if response.status_code == 200:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _requested_columns():
+    """
+    Return the datastore columns holding the elements named by the
+    request's `fields` query parameter, or None if it has none.
+
+    Raises:
+        ValueError: If `fields` names an unknown element.
+    """
+    fields = api_helpers.requested_fields(request.args,
+                                          FRIEND_RESOURCE_ELEMENTS)
+    if fields is None:
+        return None
+
+    return [datastore.FRIEND_COLUMNS[field] for field in fields]
+
+
+def _generation_etag(generation: int):
+    """
+    Return the ETag of a representation read at a given write generation.
+
+    It is sent as a weak ETag: the representation is the same whichever
+    content coding compress_response() applies to it.
+    """
+    return 'g{}'.format(generation)
+
+
+def _version_etag(version: int):
+    """
+    Return the ETag of a friend's representation read at a given row
+    version (see datastore.get_versioned_friend()).  Weak, like
+    _generation_etag().
+    """
+    return 'v{}'.format(version)
+
+
+def _not_modified(etag: str):
+    """Return an empty 304 response confirming the client's ETag."""
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _get_cached_friends_collection(generation: int):
+    """
+    Return the collection of friend resources from the cache of encoded
+    responses, encoding and caching it first if the datastore has been
+    written to since it was last cached.
+
+    Args:
+        generation (int): The datastore's write generation, read before
+            any rows so that a concurrent write can only make the cached
+            body newer than its key, never older.
+    """
+    body = _collection_cache.get(generation)
+    if body is None:
+        body = b''.join(_encode_friends_collection(
+            datastore.iter_encoded_friends(
+                g.datastore, app.config['FRIENDS_COLLECTION_BATCH_SIZE']),
+            app.config['FRIENDS_COLLECTION_BATCH_SIZE']))
+        _collection_cache.put(generation, body)
+
+    return Response(body, mimetype='application/json')
+
+
+def _get_friends_page(columns: list=None):
+    """
+    Return one page of the collection of friend resources.
+
+    Args:
+        columns (list): The columns to represent, or None for all.
+    """
+    try:
+        limit = api_helpers.page_limit(
+            request.args, default=app.config['FRIENDS_PAGE_SIZE'],
+            maximum=app.config['FRIENDS_MAX_PAGE_SIZE'])
+        after = None
+        if 'cursor' in request.args:
+            after = api_helpers.decode_cursor(request.args['cursor'])
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    # Ask for one extra row to find out whether there is a next page.
+    friends_page = datastore.get_friends_page(g.datastore, limit + 1, after,
+                                              columns)
+
+    next_page = None
+    if len(friends_page) > limit:
+        friends_page = friends_page[:limit]
+        next_page = url_for(
+            'get_friends', limit=limit,
+            cursor=api_helpers.encode_cursor(friends_page[-1]['id']),
+            fields=request.args.get('fields'))
+
+    response = jsonify({"friends": friends_page, "next": next_page})
+    if next_page:
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_page)
+    return response
+
+
+def _get_friends_changes(columns: list=None):
+    """
+    Return the friend resources created, updated or deleted since the
+    version in the `since` query parameter, for clients that keep a
+    copy of the collection (delta sync).
+
+    A client starts with `since=0`, which returns every friend, and
+    then passes the `version` of each response as `since` to get only
+    what has changed since.  Deleted friends are listed by id.  The
+    cost depends on how much has changed, not on the size of the
+    collection.  Changes are paged by `limit`: while there are more,
+    `next` (and a Link header) points at the following page.
+
+    Args:
+        columns (list): The columns to represent, or None for all.
+
+    A `since` beyond the datastore's current version means the
+    datastore isn't the one the client synced with (it was restored
+    from a backup or recreated), so the client's copy can't be brought
+    up to date by a delta and it has to start over from `since=0`.
+
+    Returns
+        HTTP Response (200): {"friends": [...], "deleted": [ids],
+            "version": int, "next": url or null}
+        HTTP Response (400): A bad `since` or `limit`.
+        HTTP Response (410): `since` is a version the datastore hasn't
+            reached.
+    """
+    try:
+        since = api_helpers.since_version(request.args)
+        limit = api_helpers.page_limit(
+            request.args, default=app.config['FRIENDS_MAX_PAGE_SIZE'],
+            maximum=app.config['FRIENDS_MAX_PAGE_SIZE'])
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    generation = datastore.generation(g.datastore)
+    if since > generation and g.datastore_source is _read_snapshot:
+        # The copy may just not have caught up with the version the
+        # client last synced to.
+        _switch_to_connection_pool()
+        generation = datastore.generation(g.datastore)
+    if since > generation:
+        error_response = make_response(jsonify({
+            "error": "Version {} is ahead of the datastore's current "
+                     "version, {}.  Discard your copy and sync again "
+                     "with since=0.".format(since, generation)}), 410)
+        return error_response
+
+    etag = _generation_etag(generation)
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+
+    friends, deleted_ids, version = datastore.get_changes(
+        g.datastore, since, generation, limit, columns)
+
+    next_page = None
+    if version < generation:
+        next_page = url_for('get_friends', since=version, limit=limit,
+                            fields=request.args.get('fields'))
+
+    response = jsonify({"friends": friends, "deleted": deleted_ids,
+                        "version": version, "next": next_page})
+    if next_page:
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_page)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def _get_friends_by_id(ids, columns: list=None, conditional: bool=True):
+    """
+    Return the friend resources with the given ids, in the order
+    requested, along with the ids that don't exist, looked up with a
+    single query (see datastore.get_friends_by_id()).
+
+    Args:
+        ids: The requested ids, validated here.
+        columns (list): The columns to represent, or None for all.
+        conditional (bool): Whether the response gets a generation ETag
+            (and is a 304 when the client already holds it).
+
+    Returns
+        HTTP Response (200): {"friends": [...], "missing": [ids]}
+        HTTP Response (400): No ids, too many, or ids that aren't
+            strings.
+    """
+    try:
+        ids = api_helpers.requested_ids(
+            ids, maximum=app.config['FRIENDS_MAX_PAGE_SIZE'])
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    etag = None
+    if conditional:
+        etag = _generation_etag(datastore.generation(g.datastore))
+        if request.if_none_match.contains_weak(etag):
+            return _not_modified(etag)
+
+    friends, missing_ids = datastore.get_friends_by_id(g.datastore, ids,
+                                                       columns)
+
+    response = jsonify({"friends": friends, "missing": missing_ids})
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _stream_from_connection(chunks, ds_connection, source,
+                            query_trace: tracing.QueryTrace=None):
+    """
+    Return an iterator over the chunks of a streamed response that reads
+    from a request's connection, which afterwards ends the connection's
+    SQL trace, if it has one, and returns the connection to the pool (or
+    read snapshot) it came from.
+
+    The generator is started before it is returned, so that closing it
+    releases the connection even if no chunk was sent.
+    """
+    def generate():
+        try:
+            yield None
+            yield from chunks
+        finally:
+            if query_trace is not None:
+                tracing.stop(ds_connection)
+                _log_query_trace(query_trace)
+            source.release(ds_connection)
+
+    generator = generate()
+    next(generator)
+    return generator
+
+
+def _encode_friends_collection(encoded_friends, batch_size: int):
+    """
+    Yield the JSON encoding of {"friends": [...]} one chunk at a time,
+    with each chunk holding up to `batch_size` friends.
+
+    Args:
+        encoded_friends: An iterable of the friends' JSON encodings, as
+            yielded by datastore.iter_encoded_friends().
+        batch_size (int): The number of friends per chunk.
+    """
+    yield b'{"friends": ['
+
+    chunk = list()
+    separator = ''
+    for encoded_friend in encoded_friends:
+        chunk.append(separator)
+        chunk.append(encoded_friend)
+        separator = ', '
+        if len(chunk) >= batch_size * 2:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = list()
+
+    chunk.append(']}')
+    yield ''.join(chunk).encode('utf-8')
+
+
+@app.route('/api/v1/friends/search', methods=['GET'])
+def search_friends():
+    """
+    Return the friends whose names, email or notes match the words in
+    the `q` query parameter, best matches first.
+
+    Every word must match, as a prefix, a word in one of those fields.
+    Results are paged: pass `limit` for the page size and follow the
+    `next` link (and Link header) for the following page.
+
+    Returns
+        HTTP Response (200): {"friends": [...], "next": url or null}
+        HTTP Response (400): A missing or empty query, or a bad `limit`
+            or `cursor`.
+    """
+    try:
+        query = api_helpers.search_query(request.args.get('q', ''))
+        limit = api_helpers.page_limit(
+            request.args, default=app.config['FRIENDS_PAGE_SIZE'],
+            maximum=app.config['FRIENDS_MAX_PAGE_SIZE'])
+        offset = 0
+        if 'cursor' in request.args:
+            offset = api_helpers.decode_cursor(request.args['cursor'])
+            if not offset.isdigit():
+                raise ValueError("The `cursor` parameter is not valid.  Use "
+                                 "the `next` link of a previous page.")
+            offset = int(offset)
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    etag = _generation_etag(datastore.generation(g.datastore))
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+
+    # Ask for one extra row to find out whether there is a next page.
+    try:
+        friends_page = datastore.search_friends(g.datastore, query,
+                                                limit + 1, offset)
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    next_page = None
+    if len(friends_page) > limit:
+        friends_page = friends_page[:limit]
+        next_page = url_for(
+            'search_friends', q=request.args['q'], limit=limit,
+            cursor=api_helpers.encode_cursor(str(offset + limit)))
+
+    response = jsonify({"friends": friends_page, "next": next_page})
+    if next_page:
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_page)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+@app.route('/api/v1/friends/suggest', methods=['GET'])
+def suggest_friends():
+    """
+    Return the friends whose first, last or full name starts with the
+    `prefix` query parameter, for autocomplete.
+
+    Suggestions come from an in-memory index of names (see
+    datastore.name_index), without a datastore query.  Pass `limit` to
+    change the number of suggestions.
+
+    Returns
+        HTTP Response (200): {"friends": [{"id", "first_name",
+            "last_name"}, ...]}
+        HTTP Response (400): A missing `prefix` or a bad `limit`.
+    """
+    try:
+        # A trailing space is kept: "john " should suggest John Smith
+        # but not Johnny.
+        prefix = request.args.get('prefix', '').lstrip()
+        if not prefix.strip():
+            raise ValueError("The `prefix` parameter must contain the "
+                             "start of a name.")
+        limit = api_helpers.page_limit(
+            request.args, default=app.config['FRIENDS_SUGGEST_LIMIT'],
+            maximum=app.config['FRIENDS_SUGGEST_MAX_LIMIT'])
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    return jsonify({"friends": datastore.name_index.suggest(prefix, limit)})
+
+
+@app.route('/api/v1/friends/events', methods=['GET'])
+def friend_events():
+    """
+    Stream the creation, update and deletion of friends as Server-Sent
+    Events.
+
+    Each event's id resumes the stream: a reconnecting EventSource sends
+    the last one it saw in a Last-Event-ID header (or pass it as the
+    `lastEventId` query parameter), and the events published since are
+    sent first.  If they are no longer all known, a `resync` event is
+    sent first instead, and the client should reload the collection.
+    To miss nothing, subscribe before loading the collection.
+
+    Events are published after the writes made by this process commit,
+    from a ring of the last EVENTS_RING_SIZE.  A client that falls
+    EVENTS_QUEUE_SIZE events behind is disconnected, and every stream
+    ends after EVENTS_STREAM_TIMEOUT seconds, so that the threads
+    serving them are handed back; clients simply reconnect.  A stream
+    also ends once its client disconnects: straight away under the ASGI
+    wrapper, or at the next event or keep-alive under a WSGI server.
+
+    Returns
+        HTTP Response (200): A text/event-stream of `created` and
+            `updated` events carrying the friend's representation, and
+            `deleted` events carrying its id.
+        HTTP Response (503): Too many subscribers already.
+    """
+    last_event_id = request.headers.get(
+        'Last-Event-ID', request.args.get('lastEventId'))
+    try:
+        subscription = event_broker.subscribe(last_event_id)
+    except OverflowError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 503)
+        return error_response
+
+    request.environ.get(DISCONNECT_CALLBACKS, list()).append(
+        subscription.close)
+    response = Response(
+        _event_stream(subscription,
+                      app.config['EVENTS_HEARTBEAT_INTERVAL'],
+                      app.config['EVENTS_STREAM_TIMEOUT']),
+        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop proxies such as nginx from buffering the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _event_stream(subscription: events.Subscription, heartbeat: float,
+                  timeout: float):
+    """
+    Yield a subscription's events in the text/event-stream format, after
+    an opening comment and with another every `heartbeat` seconds
+    without events to keep the connection open, until `timeout` seconds
+    have passed or the subscription is dropped or closed.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        # WSGI servers send the headers along with the first chunk, and
+        # an EventSource only opens once it has them.
+        yield ': connected\n\n'
+        if subscription.resync:
+            yield 'event: resync\ndata: {}\n\n'
+        for event in subscription.replay:
+            yield _format_event(event)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            event = subscription.get(min(heartbeat, remaining))
+            if event is not None:
+                yield _format_event(event)
+            elif subscription.dropped or subscription.closed:
+                break
+            else:
+                yield ': keep-alive\n\n'
+    finally:
+        subscription.close()
+
+
+def _format_event(event: dict) -> str:
+    """Format an event published by the EventBroker for the stream."""
+    return 'id: {id}\nevent: {event}\ndata: {data}\n\n'.format(**event)
 
 
 @app.route('/api/v1/friends', methods=['POST'])
@@ -58,38 +1059,196 @@ def create_friend():
         api_helpers.verify_required_data_present(
             request_payload=json_payload,
             required_elements=FRIEND_RESOURCE_ELEMENTS)
+        api_helpers.verify_string_elements(json_payload,
+                                           FRIEND_RESOURCE_ELEMENTS)
     except ValueError as error:
         error_response = make_response(jsonify({"error": str(error)}), 400)
         return error_response
 
-    if datastore.get_friend(g.datastore, id=json_payload['id']):
-        error_response = make_response(
-            jsonify(
-                {"error": "An friend resource already exists with the "
-                          "given id: {}".format(json_payload['id'])}),
-            400)
+    try:
+        write(datastore.add_friend, json_payload)
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
         return error_response
 
-    datastore.add_friend(g.datastore, json_payload)
     response = make_response(jsonify({"message": "Friend resource created."}),
                              201)
     return response
 
 
+@app.route('/api/v1/friends:batch', methods=['POST'])
+def create_friends():
+    """
+    Create many new friend resources in one request.
+
+    Accepts either a JSON array of friend representations or, with a
+    `content-type` of application/x-ndjson, one representation per line.
+    Every item is validated up front and all of the valid ones are
+    created in a single transaction.
+
+    Returns
+        HTTP Response (200): With a result for each item, in order.
+        HTTP Response (400): No payload, bad syntax, or not a list.
+    """
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            request_payload = api_helpers.ndjson_payload(request)
+        else:
+            request_payload = api_helpers.json_payload(request)
+            if not isinstance(request_payload, list):
+                raise ValueError("The JSON payload must be an array of "
+                                 "friend resources.")
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    results = list()
+    valid_entries = list()
+    seen_ids = set()
+    for entry in request_payload:
+        try:
+            if not isinstance(entry, dict):
+                raise ValueError("Each friend resource must be a JSON object.")
+            api_helpers.verify_required_data_present(
+                request_payload=entry,
+                required_elements=FRIEND_RESOURCE_ELEMENTS)
+            api_helpers.verify_string_elements(entry,
+                                               FRIEND_RESOURCE_ELEMENTS)
+            if entry['id'].lower() in seen_ids:
+                raise ValueError("The id {} appears more than once in this "
+                                 "batch.".format(entry['id']))
+        except ValueError as error:
+            results.append({"status": 400, "error": str(error)})
+            continue
+
+        seen_ids.add(entry['id'].lower())
+        valid_entries.append(entry)
+        results.append(None)
+
+    existing_ids = set()
+    if valid_entries:
+        existing_ids = write(datastore.add_friends, valid_entries)
+
+    valid_entries = iter(valid_entries)
+    for index, result in enumerate(results):
+        if result is not None:
+            continue
+        entry = next(valid_entries)
+        if entry['id'] in existing_ids:
+            results[index] = {
+                "id": entry['id'], "status": 400,
+                "error": "An friend resource already exists with the "
+                         "given id: {}".format(entry['id'])}
+        else:
+            results[index] = {"id": entry['id'], "status": 201,
+                              "message": "Friend resource created."}
+
+    return jsonify({"results": results})
+
+
+@app.route('/api/v1/friends', methods=['PATCH'])
+def partially_update_friends():
+    """
+    Update some elements of many friend resources in one request, all or
+    nothing.
+
+    Accepts either a JSON array of partial representations, each with
+    the `id` of the friend to update and the elements to change, or,
+    with a `content-type` of application/json-patch+json, an RFC 6902
+    JSON Patch of the collection whose operations `replace` elements
+    addressed as /<id>/<element>.  The whole payload is validated up
+    front and every update is applied in a single transaction: if any
+    friend doesn't exist, none are updated.
+
+    Returns
+        HTTP Response (200): With the updated friend resources.
+        HTTP Response (400): No payload, bad syntax, or an invalid
+            update.
+        HTTP Response (404): A friend to update doesn't exist.
+    """
+    try:
+        request_payload = api_helpers.json_payload(request)
+        if request.mimetype == 'application/json-patch+json':
+            updates = api_helpers.json_patch_updates(
+                request_payload, FRIEND_RESOURCE_ELEMENTS)
+        else:
+            updates = api_helpers.partial_updates(
+                request_payload, FRIEND_RESOURCE_ELEMENTS)
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    try:
+        friends = write(datastore.update_friends, updates)
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 404)
+        return error_response
+
+    return jsonify({"message": "Friend resources updated.",
+                    "friends": friends})
+
+
+@app.route('/api/v1/friends:lookup', methods=['POST'])
+def lookup_friends():
+    """
+    Return the friend resources whose ids are listed in a JSON array,
+    like GET /api/v1/friends?ids=..., for lists of ids too long for a
+    URL.  A `fields` query parameter limits the representations as it
+    does there.
+
+    Returns
+        HTTP Response (200): {"friends": [...], "missing": [ids]}, with
+            the friends in the order requested.
+        HTTP Response (400): No payload, bad syntax, or not a list of
+            between 1 and FRIENDS_MAX_PAGE_SIZE ids.
+    """
+    try:
+        request_payload = api_helpers.json_payload(request)
+        columns = _requested_columns()
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    return _get_friends_by_id(request_payload, columns, conditional=False)
+
+
 """
 Operations for Individual Friend Resources
 """
 @app.route('/api/v1/friends/<id>', methods=['GET'])
 def get_friend(id: str):
-    """Return a representation of a specific friend or an error."""
+    """
+    Return a representation of a specific friend or an error.
+
+    Passing a `fields` query parameter (e.g. `fields=firstName,email`)
+    limits the representation to those elements, plus `id`.
 
+    The response carries an ETag derived from the version of the row
+    the representation was read from, which the friend cache keeps
+    with it, so the ETag always matches the body.  If the client already
+    holds it (If-None-Match), a 304 is returned.
+    """
     try:
-        return jsonify(datastore.get_friend(g.datastore, id))
-    except TypeError:
+        columns = _requested_columns()
+    except ValueError as error:
+        error_response = make_response(jsonify({"error": str(error)}), 400)
+        return error_response
+
+    friend, version = datastore.get_versioned_friend(g.datastore, id,
+                                                     columns)
+    if friend is None:
         error_response = make_response(
             jsonify({"error": "No such friend exists."}), 404)
         return error_response
 
+    etag = _version_etag(version)
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+
+    response = jsonify(friend)
+    response.set_etag(etag, weak=True)
+    return response
+
 
 @app.route('/api/v1/friends/<id>', methods=['PUT'])
 def fully_update_friend(id: str):
@@ -97,34 +1256,39 @@ def fully_update_friend(id: str):
     Update all aspects of a specific friend or return an error.
 
     Use a JSON representation to fully update an existing friend
-    resource.
+    resource.  The friend updated is the one named in the URL, and the
+    representation's `id` must match it (ignoring case).
 
     Returns
         HTTP Response (200): If an existing resource is successfully updated.
-        HTTP Response (400): No JSON payload, bad syntax, or missing data.
+        HTTP Response (400): No JSON payload, bad syntax, missing data, or
+            an `id` that doesn't match the URL.
         HTTP Response (404): No matching existing resource to update.
     """
     try:
         request_payload = api_helpers.json_payload(request)
         api_helpers.verify_required_data_present(
             request_payload, FRIEND_RESOURCE_ELEMENTS)
+        api_helpers.verify_string_elements(request_payload,
+                                           FRIEND_RESOURCE_ELEMENTS)
+        api_helpers.verify_matching_id(request_payload, id)
     except ValueError as error:
         error_response = make_response(jsonify({"error": str(error)}), 400)
         return error_response
 
-    existing_friend = datastore.get_friend(g.datastore, id)
-    if existing_friend:
-        datastore.fully_update_friend(g.datastore, request_payload)
-        response = make_response(
-            jsonify({"message": "Friend resource updated."}), 201)
-        return response
+    try:
+        write(datastore.fully_update_friend, id, request_payload)
+    except ValueError:
+        error_response = make_response(
+            jsonify(
+                {"error": "No friend resource exists that matches "
+                          "the given id: {}".format(id)}),
+            404)
+        return error_response
 
-    error_response = make_response(
-        jsonify(
-            {"error": "No friend resource exists that matches "
-                      "the given id: {}".format(id)}),
-        404)
-    return error_response
+    response = make_response(
+        jsonify({"message": "Friend resource updated."}), 201)
+    return response
 
 
 @app.route('/api/v1/friends/<id>', methods=['DELETE'])
@@ -137,7 +1301,7 @@ def destroy_friend(id: str):
         HTTP Response (404): No matching existing resource to update.
     """
     try:
-        datastore.delete_friend(g.datastore, id)
+        write(datastore.delete_friend, id)
     except ValueError:
         error_response = make_response(
             jsonify({"error": "No such friend exists."}), 404)
@@ -3,6 +3,10 @@ This module provides functions that are commonly used by various
 members of the api.py module.
 """
 
+import base64
+import binascii
+import json
+
 from werkzeug.exceptions import BadRequest
 
 
@@ -34,6 +38,33 @@ def json_payload(request) -> dict:
     return request_payload
 
 
+def ndjson_payload(request) -> list:
+    """
+    Parse a flask.request object whose payload is newline delimited
+    JSON (one JSON document per line) and return the documents.
+
+    Args:
+        request (flask.request): A request object with an NDJSON payload.
+
+    Raises:
+        ValueError: If any non-blank line of the payload is not valid JSON.
+    """
+    request_payload = list()
+
+    lines = request.get_data().splitlines()
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            request_payload.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+            raise ValueError("Line {} of the NDJSON payload contains syntax "
+                             "errors. Please fix and try "
+                             "again.".format(line_number))
+
+    return request_payload
+
+
 def verify_required_data_present(request_payload: dict, required_elements: set):
     """
     Verify that a request_payload has all the keys indicated
@@ -55,3 +86,324 @@ def verify_required_data_present(request_payload: dict, required_elements: set):
             "The following elements are "
             "required: {}".format(required_elements))
 
+
+def verify_string_elements(request_payload: dict, elements: set):
+    """
+    Verify that the elements of a request_payload that are present are
+    strings, as the datastore and the in-memory indexes of friends
+    expect.
+
+    Args:
+        request_payload (dict): A set of request_payload to evaluate.
+        elements (set): The names of keys whose values must be strings.
+
+    Raises:
+        ValueError: If any of them holds another JSON type (including
+            null).
+    """
+    invalid_elements = sorted(
+        element for element in elements
+        if element in request_payload and
+        not isinstance(request_payload[element], str))
+
+    if invalid_elements:
+        raise ValueError("Payload elements must be strings: {}".format(
+            ", ".join(invalid_elements)))
+
+
+def verify_matching_id(request_payload: dict, id: str):
+    """
+    Verify that a resource representation's `id` names the resource in
+    the request's URL, ignoring case.
+
+    Args:
+        request_payload (dict): The representation in the request.
+        id (str): The id in the request's URL.
+
+    Raises:
+        ValueError: If the ids don't match.
+    """
+    payload_id = request_payload['id']
+    if not isinstance(payload_id, str) or payload_id.lower() != id.lower():
+        raise ValueError("The id in the payload ({}) doesn't match the id "
+                         "in the URL ({}).".format(payload_id, id))
+
+
+def json_patch_updates(operations, available_elements: set) -> list:
+    """
+    Turn an RFC 6902 JSON Patch of a resource collection into the
+    partial updates it makes (see partial_updates()).
+
+    The collection is patched as an object of resources keyed on their
+    ids, so each operation addresses one element of one resource,
+    e.g. {"op": "replace", "path": "/bfp/email", "value": "..."}.  Only
+    `replace` operations, and `add` operations (which replace an element
+    that is present, as every element of a resource is), are supported.
+
+    Args:
+        operations: The decoded JSON Patch document.
+        available_elements (set): The names of the elements that may be
+            updated.  `id` can't be.
+
+    Raises:
+        ValueError: If the document isn't a list of supported
+            operations on available elements, with string values.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("A JSON Patch must be an array of at least one "
+                         "operation.")
+
+    updates = list()
+    for position, operation in enumerate(operations, start=1):
+        if not isinstance(operation, dict):
+            raise ValueError("Operation {}: each operation must be a JSON "
+                             "object.".format(position))
+        if operation.get('op') not in ('replace', 'add'):
+            raise ValueError("Operation {}: only `replace` and `add` "
+                             "operations are supported.".format(position))
+        if not isinstance(operation.get('path'), str):
+            raise ValueError("Operation {}: `path` must be a JSON "
+                             "Pointer.".format(position))
+        if 'value' not in operation:
+            raise ValueError("Operation {}: `value` is required.".format(
+                position))
+
+        tokens = operation['path'].split('/')
+        if len(tokens) != 3 or tokens[0] or not tokens[1]:
+            raise ValueError("Operation {}: `path` must address an element "
+                             "of a resource, e.g. /<id>/<element>.".format(
+                                 position))
+        id, element = [token.replace('~1', '/').replace('~0', '~')
+                       for token in tokens[1:]]
+        updates.append((position, id, {element: operation['value']}))
+
+    return _merge_updates(updates, available_elements, "Operation")
+
+
+def partial_updates(entries, available_elements: set) -> list:
+    """
+    Validate a list of partial resource representations, each holding an
+    `id` and the elements to update, and merge those addressed to the
+    same resource.
+
+    Args:
+        entries: The decoded JSON payload.
+        available_elements (set): The names of the elements that may be
+            updated.  `id` identifies the resource and can't be.
+
+    Returns:
+        A list of (id, {element: value}) tuples, one per resource (ids
+        are compared case-insensitively), in the order the resources
+        were first mentioned.
+
+    Raises:
+        ValueError: If the payload isn't a list of objects that each
+            have an `id` and update at least one available element with
+            a string value.
+    """
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("The JSON payload must be an array of at least one "
+                         "partial friend resource.")
+
+    updates = list()
+    for position, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict) or not isinstance(entry.get('id'),
+                                                         str):
+            raise ValueError("Update {}: each update must be a JSON object "
+                             "with an `id`.".format(position))
+        changes = {element: value for element, value in entry.items()
+                   if element != 'id'}
+        if not changes:
+            raise ValueError("Update {}: no elements to update.".format(
+                position))
+        updates.append((position, entry['id'], changes))
+
+    return _merge_updates(updates, available_elements, "Update")
+
+
+def _merge_updates(updates: list, available_elements: set,
+                   description: str) -> list:
+    """
+    Check the (position, id, changes) tuples gathered by
+    json_patch_updates() or partial_updates() and merge them into
+    (id, changes) tuples, one per resource, later changes winning.
+    """
+    merged = dict()
+    for position, id, changes in updates:
+        for element, value in changes.items():
+            if element not in available_elements or element == 'id':
+                raise ValueError(
+                    "{} {}: {} can't be updated.  Only these elements "
+                    "can: {}".format(description, position, element,
+                                     sorted(available_elements - {'id'})))
+            if not isinstance(value, str):
+                raise ValueError("{} {}: the value of {} must be a "
+                                 "string.".format(description, position,
+                                                  element))
+        merged.setdefault(id.lower(), (id, dict()))[1].update(changes)
+
+    return list(merged.values())
+
+
+def page_limit(request_args, default: int, maximum: int) -> int:
+    """
+    Return the page size requested through a `limit` query parameter.
+
+    Args:
+        request_args (werkzeug.datastructures.MultiDict): The query
+            parameters of a request, i.e. flask.request.args.
+        default (int): The page size to use if `limit` is absent.
+        maximum (int): The largest page size a client may request.
+
+    Raises:
+        ValueError: If `limit` isn't an integer between 1 and `maximum`.
+    """
+    limit = request_args.get('limit', default)
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+
+    if not 1 <= limit <= maximum:
+        raise ValueError("The `limit` parameter must be an integer "
+                         "between 1 and {}.".format(maximum))
+
+    return limit
+
+
+def since_version(request_args) -> int:
+    """
+    Return the version requested through a `since` query parameter: the
+    `version` of a previous delta sync response, or 0 to start one.
+
+    Args:
+        request_args (werkzeug.datastructures.MultiDict): The query
+            parameters of a request, i.e. flask.request.args.
+
+    Raises:
+        ValueError: If `since` isn't a non-negative integer.
+    """
+    since = request_args.get('since', '')
+
+    try:
+        since = int(since)
+    except ValueError:
+        since = -1
+
+    if since < 0:
+        raise ValueError("The `since` parameter must be the version of a "
+                         "previous sync, or 0 to sync every friend.")
+
+    return since
+
+
+def requested_ids(ids, maximum: int) -> list:
+    """
+    Validate a list of friend ids requested in one go, e.g. the `ids`
+    query parameter split on commas, and drop repeats of an id (ids are
+    compared case-insensitively) while keeping the order of the rest.
+
+    Args:
+        ids: The requested ids, as decoded from the request.
+        maximum (int): The largest number of ids a client may request.
+
+    Raises:
+        ValueError: If `ids` isn't a list of between 1 and `maximum`
+            non-empty strings.
+    """
+    if (not isinstance(ids, list) or
+            not all(isinstance(id, str) and id for id in ids) or
+            not 1 <= len(ids) <= maximum):
+        raise ValueError("Between 1 and {} friend ids must be requested, "
+                         "as a list of non-empty strings.".format(maximum))
+
+    unique_ids = list()
+    seen_ids = set()
+    for id in ids:
+        if id.lower() not in seen_ids:
+            seen_ids.add(id.lower())
+            unique_ids.append(id)
+    return unique_ids
+
+
+def requested_fields(request_args, available_elements: set) -> list:
+    """
+    Return the resource elements requested through a `fields` query
+    parameter: a comma separated list such as `fields=id,firstName`.
+
+    Args:
+        request_args (werkzeug.datastructures.MultiDict): The query
+            parameters of a request, i.e. flask.request.args.
+        available_elements (set): The names of the elements that a
+            representation may include.
+
+    Returns:
+        A list of element names, or None if `fields` is absent and the
+        whole representation is wanted.
+
+    Raises:
+        ValueError: If `fields` is empty or names an unknown element.
+    """
+    if 'fields' not in request_args:
+        return None
+
+    fields = [field.strip() for field in request_args['fields'].split(',')
+              if field.strip()]
+    unknown_fields = [field for field in fields
+                      if field not in available_elements]
+
+    if not fields or unknown_fields:
+        raise ValueError("The `fields` parameter must be a comma separated "
+                         "list of any of: {}".format(
+                             sorted(available_elements)))
+
+    return fields
+
+
+def encode_cursor(position: str) -> str:
+    """
+    Wrap the position of the last item on a page in an opaque cursor
+    that clients pass back to request the next page.
+    """
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> str:
+    """
+    Recover the position wrapped by encode_cursor().
+
+    Raises:
+        ValueError: If `cursor` wasn't produced by encode_cursor().
+    """
+    try:
+        position = base64.b64decode(cursor.encode('ascii'), altchars=b'-_',
+                                    validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeError):
+        position = None
+
+    if not position:
+        raise ValueError("The `cursor` parameter is not valid.  Use the "
+                         "`next` link of a previous page.")
+
+    return position
+
+
+def search_query(terms: str) -> str:
+    """
+    Turn the words a user typed into an FTS5 query that matches friends
+    containing every word, each as a prefix (so "jo smi" finds John
+    Smith).
+
+    Each word is quoted, so FTS5 operators and punctuation in the input
+    are searched for literally instead of being interpreted.
+
+    Raises:
+        ValueError: If `terms` doesn't contain any words.
+    """
+    words = terms.split()
+    if not words:
+        raise ValueError("The `q` parameter must contain at least one word "
+                         "to search for.")
+
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in words)
@@ -0,0 +1,300 @@
+"""
+Provides an ASGI entry point to the Friends API.
+
+The Flask app in api.py is synchronous: under a WSGI server every
+connection, including idle keep-alive ones, ties up a worker thread for
+as long as it is being served.  Here an ASGI server's event loop owns
+the connections instead.  Request bodies are received and responses are
+sent on the loop, and only the handling of a request -- the part that
+talks to the datastore -- is offloaded to a bounded pool of threads.
+
+Server-Sent Events streams wait for events for minutes at a time, so
+they are sent from a separate pool of EVENTS_MAX_SUBSCRIBERS threads
+rather than holding up the handlers, and end as soon as their client
+disconnects.
+
+Requests are dispatched to the very same Flask app, so routes, status
+codes, headers and configuration are identical to the WSGI version.
+
+Serve it with any ASGI server, e.g.:
+
+    uvicorn bfp_friends_api.asgi:app
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import sys
+import threading
+
+from bfp_friends_api import api
+
+
+class FlaskOffloadingApp:
+    """
+    An ASGI application that runs a Flask (WSGI) app's request handling
+    on a bounded ThreadPoolExecutor, and sends text/event-stream
+    responses from a second one sized to EVENTS_MAX_SUBSCRIBERS.
+
+    Args:
+        flask_app (flask.Flask): The app to dispatch requests to.
+        max_workers (int): The number of handler threads.  Defaults to
+            the app's ASGI_EXECUTOR_WORKERS setting or, if that is None,
+            to DATASTORE_POOL_SIZE so that no handler waits for a
+            datastore connection.
+    """
+
+    def __init__(self, flask_app, max_workers: int=None):
+        self.flask_app = flask_app
+        self.max_workers = max_workers
+        self._executor = None
+        self._stream_executor = None
+        self._executor_lock = threading.Lock()
+        # The functions that end each event stream being sent.
+        self._open_streams = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError("Unsupported ASGI scope type: {}".format(
+                scope['type']))
+
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """Return the handler thread pool, creating it if necessary."""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    max_workers = (
+                        self.max_workers or
+                        self.flask_app.config['ASGI_EXECUTOR_WORKERS'] or
+                        self.flask_app.config['DATASTORE_POOL_SIZE'])
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=max_workers,
+                        thread_name_prefix="asgi-handler")
+        return self._executor
+
+    def stream_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """
+        Return the thread pool event streams are sent from, creating it
+        if necessary.  It has a thread for every subscriber the app
+        admits, so a stream never waits for one.
+        """
+        if self._stream_executor is None:
+            with self._executor_lock:
+                if self._stream_executor is None:
+                    self._stream_executor = (
+                        concurrent.futures.ThreadPoolExecutor(
+                            max_workers=self.flask_app.config[
+                                'EVENTS_MAX_SUBSCRIBERS'],
+                            thread_name_prefix="asgi-stream"))
+        return self._stream_executor
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    # Open the pool (and migrate the datastore) up front
+                    # rather than on the first request.
+                    await loop.run_in_executor(self.executor(),
+                                               api.connection_pool)
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for end_stream in list(self._open_streams):
+                    end_stream()
+                # Wait off the loop: threads still sending need it.
+                for executor in (self._stream_executor, self._executor):
+                    if executor is not None:
+                        await loop.run_in_executor(None, executor.shutdown)
+                self._stream_executor = None
+                self._executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = list()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+
+        environ = wsgi_environ(scope, b''.join(body))
+        environ[api.DISCONNECT_CALLBACKS] = list()
+        loop = asyncio.get_running_loop()
+
+        def send_from_handler_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        status, headers, body = await loop.run_in_executor(
+            self.executor(), self._dispatch, environ, send_from_handler_thread)
+
+        if isinstance(body, bytes):
+            await send({'type': 'http.response.start',
+                        'status': status,
+                        'headers': headers})
+            await send({'type': 'http.response.body', 'body': body})
+        elif body is not None:
+            await self._send_event_stream(
+                status, headers, body, environ[api.DISCONNECT_CALLBACKS],
+                receive, send, send_from_handler_thread)
+        # Otherwise the response was already streamed from the handler
+        # thread.
+
+    async def _send_event_stream(self, status: int, headers: list, app_iter,
+                                 disconnect_callbacks: list, receive, send,
+                                 send_from_stream_thread):
+        """
+        Send an event stream's chunks from a stream thread while waiting
+        on the loop for the client to disconnect, which ends the stream.
+        """
+        loop = asyncio.get_running_loop()
+        disconnected = threading.Event()
+
+        def end_stream():
+            disconnected.set()
+            for callback in disconnect_callbacks:
+                callback()
+
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            end_stream()
+
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': headers})
+        self._open_streams.add(end_stream)
+        watcher = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await loop.run_in_executor(
+                self.stream_executor(), self._send_chunks, app_iter,
+                disconnected, send_from_stream_thread)
+        finally:
+            watcher.cancel()
+            self._open_streams.discard(end_stream)
+
+    def _dispatch(self, environ: dict, send_from_handler_thread):
+        """
+        Run the Flask app for one request on a handler thread.
+
+        Buffered responses (those with a Content-Length) are returned as
+        (status, headers, body) to be sent from the event loop.  Event
+        streams are returned as (status, headers, response iterable), to
+        be sent from a stream thread.  Other streamed responses (which
+        may hold the request context) have to be iterated on the thread
+        that started them, so their chunks are sent from here and
+        (None, None, None) is returned.
+        """
+        response_start = dict()
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+
+        app_iter = self.flask_app(environ, start_response)
+        closed_elsewhere = False
+        try:
+            status = response_start['status']
+            headers = response_start['headers']
+
+            if any(name == b'content-length' for name, _ in headers):
+                return status, headers, b''.join(app_iter)
+
+            if any(name == b'content-type' and
+                   value.startswith(b'text/event-stream')
+                   for name, value in headers):
+                closed_elsewhere = True
+                return status, headers, app_iter
+
+            send_from_handler_thread({'type': 'http.response.start',
+                                      'status': status,
+                                      'headers': headers})
+            closed_elsewhere = True
+            self._send_chunks(app_iter, threading.Event(),
+                              send_from_handler_thread)
+            return None, None, None
+        finally:
+            if not closed_elsewhere and hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    @staticmethod
+    def _send_chunks(app_iter, disconnected: threading.Event,
+                     send_from_thread):
+        """
+        Send a response iterable's chunks and then the end of the body,
+        or stop once the client has `disconnected`, and close it.
+        """
+        try:
+            for chunk in app_iter:
+                if disconnected.is_set():
+                    return
+                if chunk:
+                    send_from_thread({'type': 'http.response.body',
+                                      'body': chunk,
+                                      'more_body': True})
+            if not disconnected.is_set():
+                send_from_thread({'type': 'http.response.body',
+                                  'body': b''})
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def wsgi_environ(scope: dict, body: bytes) -> dict:
+    """
+    Translate an ASGI HTTP connection scope and request body into a
+    WSGI environ dictionary.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode(
+            'utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope['http_version']),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+
+    return environ
+
+
+app = FlaskOffloadingApp(api.app)
@@ -0,0 +1,273 @@
+"""
+Import friends into the datastore from CSV or NDJSON, or export them,
+without going through the API.
+
+    python -m bfp_friends_api.bulk import friends.csv
+    python -m bfp_friends_api.bulk import friends.ndjson --chunk-size 50000
+    python -m bfp_friends_api.bulk export friends.ndjson
+    python -m bfp_friends_api.bulk export - --format csv > friends.csv
+
+Both directions stream: an import holds one chunk of friends in memory
+at a time and commits each chunk in its own transaction, and an export
+reads the table in batches.  Files use the API's representation of a
+friend (id, firstName, lastName, telephone, email, notes), as CSV
+columns or as one JSON object per line, so an export can be imported
+again.
+
+Imported friends are validated as the API validates them.  Invalid
+friends are reported, with their line number, and skipped, as are
+friends whose id is already in the datastore.  A running API loads the
+imported names into its name index when it is restarted.
+"""
+
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+
+from bfp_friends_api import api_helpers
+from bfp_friends_api import datastore
+from bfp_friends_api import migrations
+from bfp_friends_api import writer
+
+FORMATS = ["csv", "ndjson"]
+
+# The elements of a friend, in the order they are exported.
+FRIEND_ELEMENTS = list(datastore.FRIEND_COLUMNS)
+
+
+def file_format(path: str, format: str=None) -> str:
+    """
+    Return the format of a file: `format` if given, otherwise the one
+    its extension names.
+
+    Raises:
+        ValueError: If neither names a known format.
+    """
+    if format is None:
+        format = path.rpartition('.')[2].lower()
+    if format not in FORMATS:
+        raise ValueError("Can't tell the format of {}.  Pass --format "
+                         "with one of: {}".format(path, ", ".join(FORMATS)))
+    return format
+
+
+def read_csv(source):
+    """
+    Yield a (line number, entry, error) tuple for each row of a CSV file
+    with a header row.  `error` is None unless the row can't be read.
+    """
+    reader = csv.DictReader(source)
+    for row in reader:
+        # Short rows fill missing columns with None, and long rows put
+        # the extra values under None.  Either way, drop them.
+        yield (reader.line_num,
+               {key: value for key, value in row.items()
+                if key is not None and value is not None},
+               None)
+
+
+def read_ndjson(source):
+    """
+    Yield a (line number, entry, error) tuple for each non-blank line of
+    an NDJSON file.  `error` is None unless the line can't be read.
+    """
+    for line_number, line in enumerate(source, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line), None
+        except ValueError:
+            yield line_number, None, "Line contains JSON syntax errors."
+
+
+def validate_entry(entry):
+    """
+    Check that an imported entry is a complete friend representation,
+    as the API requires.
+
+    Raises:
+        ValueError: If it isn't.
+    """
+    if not isinstance(entry, dict):
+        raise ValueError("Each friend resource must be a JSON object.")
+    api_helpers.verify_required_data_present(
+        request_payload=entry,
+        required_elements=set(FRIEND_ELEMENTS))
+    api_helpers.verify_string_elements(entry, set(FRIEND_ELEMENTS))
+
+
+def connect(database: str, profile: str) -> sqlite3.Connection:
+    """
+    Connect to a datastore, configured by a datastore profile (see
+    writer.PROFILES), and bring its schema up to date.
+    """
+    ds_connection = sqlite3.connect(database)
+    writer.apply_pragmas(ds_connection, writer.profile_settings(profile))
+    migrations.migrate(ds_connection)
+    return ds_connection
+
+
+def import_friends(ds_connection: sqlite3.Connection, source, format: str,
+                   chunk_size: int=10000, errors=sys.stderr) -> dict:
+    """
+    Import the friends in a file, `chunk_size` at a time.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        source: The open file to import.
+        format (str): One of FORMATS.
+        chunk_size (int): The number of friends inserted and committed
+            per transaction.
+        errors: Where to report invalid friends and progress.
+
+    Returns
+        A JSON ready dictionary of counts and throughput.
+    """
+    read = read_csv if format == "csv" else read_ndjson
+    report = {"rows": 0, "imported": 0, "skipped": 0, "rejected": 0}
+    started = time.perf_counter()
+
+    def flush(chunk):
+        existing_ids = datastore.import_friends(ds_connection, chunk)
+        report["imported"] += len(chunk) - len(existing_ids)
+        report["skipped"] += len(existing_ids)
+        print("{rows} rows read, {imported} imported".format(**report),
+              file=errors)
+
+    chunk = list()
+    chunk_ids = set()
+    for line_number, entry, error in read(source):
+        report["rows"] += 1
+        try:
+            if error is not None:
+                raise ValueError(error)
+            validate_entry(entry)
+        except ValueError as error:
+            report["rejected"] += 1
+            print("Line {}: {}".format(line_number, error), file=errors)
+            continue
+
+        # A later chunk finds an id already imported by an earlier one
+        # in the datastore; within a chunk it has to be caught here.
+        if entry['id'].lower() in chunk_ids:
+            report["skipped"] += 1
+            continue
+
+        chunk.append(entry)
+        chunk_ids.add(entry['id'].lower())
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = list()
+            chunk_ids = set()
+
+    if chunk:
+        flush(chunk)
+
+    report["seconds"] = time.perf_counter() - started
+    report["rows_per_second"] = (report["rows"] / report["seconds"]
+                                 if report["seconds"] else 0.0)
+    return report
+
+
+def export_friends(ds_connection: sqlite3.Connection, destination,
+                   format: str, batch_size: int=10000) -> dict:
+    """
+    Export every friend to a file.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        destination: The open file to write to.
+        format (str): One of FORMATS.
+        batch_size (int): The number of rows to fetch per round trip.
+
+    Returns
+        A JSON ready dictionary of counts and throughput.
+    """
+    elements = [(element, datastore.FRIEND_COLUMNS[element])
+                for element in FRIEND_ELEMENTS]
+    rows = 0
+    started = time.perf_counter()
+
+    if format == "csv":
+        csv_writer = csv.writer(destination)
+        csv_writer.writerow(FRIEND_ELEMENTS)
+        for friend in datastore.iter_friends(ds_connection, batch_size):
+            csv_writer.writerow([friend[column] for _, column in elements])
+            rows += 1
+    else:
+        for friend in datastore.iter_friends(ds_connection, batch_size):
+            destination.write(json.dumps(
+                {element: friend[column] for element, column in elements}))
+            destination.write('\n')
+            rows += 1
+
+    seconds = time.perf_counter() - started
+    return {"rows": rows, "seconds": seconds,
+            "rows_per_second": rows / seconds if seconds else 0.0}
+
+
+def process_user_input() -> argparse.Namespace:
+    """Parse the command line options."""
+    parser = argparse.ArgumentParser(
+        description="Import friends from, or export them to, CSV or NDJSON.")
+    parser.add_argument(
+        "command", choices=["import", "export"],
+        help="Whether to import or export friends.")
+    parser.add_argument(
+        "path",
+        help="The file to import or export.  '-' means stdin or stdout.")
+    parser.add_argument(
+        "--format", choices=FORMATS,
+        help="The file's format.  By default, its extension.")
+    parser.add_argument(
+        "--database", default="/tmp/friends.db",
+        help="Path of the datastore.")
+    parser.add_argument(
+        "--profile", default="default",
+        help="The datastore profile to connect with (see writer.PROFILES).")
+    parser.add_argument(
+        "--chunk-size", type=int, default=10000,
+        help="Friends per transaction when importing, or per fetch when "
+             "exporting.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = process_user_input()
+
+    try:
+        format = file_format(arguments.path, arguments.format)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    ds_connection = connect(arguments.database, arguments.profile)
+    if arguments.command == "import":
+        if arguments.path == '-':
+            report = import_friends(ds_connection, sys.stdin, format,
+                                    arguments.chunk_size)
+        else:
+            with open(arguments.path, newline='', encoding='utf-8') as source:
+                report = import_friends(ds_connection, source, format,
+                                        arguments.chunk_size)
+        print("Imported {imported} of {rows} friends ({skipped} already "
+              "present, {rejected} invalid) in {seconds:.1f} s: "
+              "{rows_per_second:.0f} rows/s.".format(**report),
+              file=sys.stderr)
+    else:
+        if arguments.path == '-':
+            report = export_friends(ds_connection, sys.stdout, format,
+                                    arguments.chunk_size)
+        else:
+            with open(arguments.path, 'w', newline='',
+                      encoding='utf-8') as destination:
+                report = export_friends(ds_connection, destination, format,
+                                        arguments.chunk_size)
+        print("Exported {rows} friends in {seconds:.1f} s: "
+              "{rows_per_second:.0f} rows/s.".format(**report),
+              file=sys.stderr)
+    ds_connection.close()
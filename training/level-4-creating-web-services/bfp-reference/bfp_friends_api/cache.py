@@ -0,0 +1,119 @@
+"""
+This module provides a small in-process cache for datastore lookups.
+"""
+
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """
+    A thread-safe, size bounded cache that evicts the least recently
+    used entry when full and optionally expires entries after `ttl`
+    seconds.
+
+    Readers that load a value from the datastore should take a token()
+    before the load and pass it to put().  If any entry is invalidated
+    in between, the put() is ignored, so a value read before a write
+    committed can't be cached after that write invalidated it.
+
+    Args:
+        max_size (int): The maximum number of entries.  0 disables the
+            cache.
+        ttl (float): The number of seconds an entry stays valid, or
+            None for no expiry.
+    """
+
+    def __init__(self, max_size: int=1024, ttl: float=None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._invalidations = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        """
+        Return the value cached for `key`, or None if there isn't one.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def token(self) -> int:
+        """Return a token to pass to put() after loading a value."""
+        return self._invalidations
+
+    def put(self, key, value, token: int=None):
+        """
+        Cache `value` under `key`, evicting the least recently used
+        entries if the cache is full.
+
+        Args:
+            key: The cache key.
+            value: The value to cache.
+            token (int): The result of token() taken before `value` was
+                loaded.  If anything was invalidated since, `value` may
+                be stale and is not cached.
+        """
+        with self._lock:
+            if self.max_size < 1:
+                return
+            if token is not None and token != self._invalidations:
+                return
+
+            expires = None
+            if self.ttl is not None:
+                expires = time.monotonic() + self.ttl
+
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, *keys):
+        """Remove the entries for `keys`, whether or not they are cached."""
+        with self._lock:
+            self._invalidations += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Return the cache's size and hit/miss/eviction counters.
+
+        Returns:
+            A JSON ready dictionary of counters.
+        """
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "size": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions}
@@ -0,0 +1,76 @@
+"""
+This module negotiates and applies the content coding of responses.
+
+gzip is always available.  Brotli, which compresses JSON noticeably
+better, is offered as well when the optional `brotli` package is
+installed (pip install brotli).
+"""
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing.  Everything else we serve is either
+# tiny or already compressed.
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson",
+                          "text/plain", "text/html"}
+
+
+def available_encodings() -> list:
+    """
+    Return the content codings that can be applied, most preferred
+    first.
+    """
+    if brotli is None:
+        return ["gzip"]
+    return ["br", "gzip"]
+
+
+def negotiate(accept_encodings) -> str:
+    """
+    Choose the content coding for a response.
+
+    Args:
+        accept_encodings (werkzeug.datastructures.Accept): The parsed
+            Accept-Encoding header, i.e. flask.request.accept_encodings.
+
+    Returns:
+        The available coding with the highest quality that the client
+        accepts (ties go to the preferred one), or 'identity'.
+    """
+    content_encoding = 'identity'
+    best_quality = 0
+
+    for encoding in available_encodings():
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            content_encoding = encoding
+            best_quality = quality
+
+    return content_encoding
+
+
+def compress(body: bytes, content_encoding: str, level: int) -> bytes:
+    """
+    Apply a content coding to a response body.
+
+    Args:
+        body (bytes): The uncompressed body.
+        content_encoding (str): 'gzip' or, if available, 'br'.
+        level (int): The gzip compression level (1-9) or the brotli
+            quality (0-11).
+
+    Raises:
+        ValueError: If the content coding isn't available.
+    """
+    if content_encoding == 'gzip':
+        # A fixed mtime keeps the output identical for identical input.
+        return gzip.compress(body, level, mtime=0)
+    if content_encoding == 'br' and brotli is not None:
+        return brotli.compress(body, quality=level)
+
+    raise ValueError("Unavailable content coding: {}".format(
+        content_encoding))
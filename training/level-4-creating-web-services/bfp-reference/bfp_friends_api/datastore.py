@@ -2,38 +2,433 @@
 This modules provides functions to interact with our SQLite datastore.
 """
 
+import json
+import logging
 import sqlite3
+import threading
 
+from bfp_friends_api import encoding
+from bfp_friends_api import tracing
+from bfp_friends_api.cache import LRUCache
+from bfp_friends_api.prefix_index import PrefixIndex
 
-def get_friends(ds_connection: sqlite3.Connection) -> dict:
+logger = logging.getLogger(__name__)
+
+# The column that holds each element of a friend resource, in the order
+# that representations list them.
+FRIEND_COLUMNS = {"id": "id",
+                  "firstName": "first_name",
+                  "lastName": "last_name",
+                  "telephone": "telephone",
+                  "email": "email",
+                  "notes": "notes"}
+
+# Representations of individual friends keyed on their lowercased id.
+# Every write path below invalidates the entries it touches once its
+# changes are committed.
+friend_cache = LRUCache(max_size=1024, ttl=60.0)
+
+# Friend names for autocomplete.  It is loaded when the API starts and
+# every write path below updates it once its changes are committed.
+name_index = PrefixIndex()
+
+# Functions called with the changes of every commit, once the caches
+# above are up to date: a list of (change, id, entry_data) tuples (see
+# _finish_write()).  They run on the thread that committed, so they
+# must be quick.  Anything they raise is logged and otherwise ignored:
+# the changes are already committed.
+commit_listeners = list()
+
+# Changes made through connections whose commit was deferred by passing
+# `commit=False`, to be applied to the caches by commit().
+_uncommitted_changes = dict()
+_uncommitted_changes_lock = threading.Lock()
+
+
+@tracing.timed
+def commit(ds_connection: sqlite3.Connection):
+    """
+    Commit the writes made with `commit=False` on a connection and
+    bring the cached friends and names they touched up to date.
+
+    Args:
+        ds_connection (sqllite3.Connection): The connection the writes
+            were made on.
+    """
+    ds_connection.commit()
+    with _uncommitted_changes_lock:
+        changes = _uncommitted_changes.pop(ds_connection, ())
+    _apply_committed_changes(changes)
+
+
+@tracing.timed
+def rollback(ds_connection: sqlite3.Connection):
+    """
+    Roll back the writes made with `commit=False` on a connection.
+
+    Args:
+        ds_connection (sqllite3.Connection): The connection the writes
+            were made on.
+    """
+    ds_connection.rollback()
+    with _uncommitted_changes_lock:
+        _uncommitted_changes.pop(ds_connection, None)
+
+
+def _finish_write(ds_connection: sqlite3.Connection, changes: list,
+                  commit: bool):
+    """
+    Commit a write and apply its changes to the caches, or leave both
+    to a later commit() if `commit` is False.
+
+    Args:
+        changes (list): A (change, id, entry_data) tuple for every
+            friend written, where change is 'created', 'updated' or
+            'deleted' and entry_data is None for a deleted friend.
+    """
+    if commit:
+        ds_connection.commit()
+        _apply_committed_changes(changes)
+    else:
+        with _uncommitted_changes_lock:
+            _uncommitted_changes.setdefault(
+                ds_connection, list()).extend(changes)
+
+
+def _apply_committed_changes(changes):
+    """
+    Invalidate the cached representations of the friends written,
+    update their entries in the name index and tell the
+    commit_listeners.
+
+    The changes are already committed, so a failure here is logged
+    rather than raised: raising would report a write that succeeded as
+    failed to whoever made it.
+    """
+    friend_cache.invalidate(*[id.lower() for _, id, _ in changes])
+
+    for _, id, entry_data in changes:
+        try:
+            if entry_data is None:
+                name_index.remove(id)
+            else:
+                name_index.add(entry_data['id'], entry_data['firstName'],
+                               entry_data['lastName'])
+        except Exception:
+            logger.exception("Updating the name index for friend %s "
+                             "failed.", id)
+
+    if changes:
+        for listener in commit_listeners:
+            try:
+                listener(changes)
+            except Exception:
+                logger.exception("Commit listener %r failed.", listener)
+
+
+@tracing.timed
+def generation(ds_connection: sqlite3.Connection) -> int:
+    """
+    Return the store-wide write generation.
+
+    Triggers on the friends table bump the generation for every row
+    written, in the same transaction as the write, so it changes
+    whenever the table's contents may have changed -- whichever process
+    made the change.  Anything derived from the table can be cached
+    against the generation it was read at.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+    """
+    cursor = ds_connection.execute(
+        'select generation from store_generation')
+    return cursor.fetchone()[0]
+
+
+def selected_columns(columns: list=None) -> list:
+    """
+    Return the friends table columns to select, in table order.
+
+    Args:
+        columns (list): Values of FRIEND_COLUMNS, or None for all of
+            them.  `id` is always selected, first.
+
+    Raises:
+        ValueError: If any of the columns isn't one of FRIEND_COLUMNS.
+    """
+    if columns is None:
+        return list(FRIEND_COLUMNS.values())
+
+    unknown_columns = set(columns) - set(FRIEND_COLUMNS.values())
+    if unknown_columns:
+        raise ValueError("Unknown friends columns: {}".format(
+            sorted(unknown_columns)))
+
+    # Only known column names reach the SQL, so formatting them into
+    # statements is safe.
+    return [column for column in FRIEND_COLUMNS.values()
+            if column == 'id' or column in columns]
+
+
+@tracing.timed
+def get_friends(ds_connection: sqlite3.Connection,
+                columns: list=None) -> dict:
     """
     Return a representation of all rows in the friends table.
 
     Args:
         ds_connection (sqllite3.Connection): An active connection to a
             sqllite datastore containing a friends table.
+        columns (list): The columns to read and represent (see
+            selected_columns()), or None for all of them.
 
     Returns
         A JSON ready dictionary representing all rows of the friends table.
     """
+    return list(iter_friends(ds_connection, columns=columns))
+
+
+@tracing.timed
+def iter_friends(ds_connection: sqlite3.Connection, batch_size: int=500,
+                 columns: list=None):
+    """
+    Lazily yield a representation of each row in the friends table.
+
+    Rows are pulled from SQLite `batch_size` at a time, so only one
+    batch is held in memory no matter how large the table is.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        batch_size (int): The number of rows to fetch per round trip.
+        columns (list): The columns to read and represent (see
+            selected_columns()), or None for all of them.
+
+    Yields
+        A JSON ready dictionary for each row of the friends table.
+    """
+    keys = selected_columns(columns)
+    cursor = ds_connection.execute(
+        'select {} from friends'.format(', '.join(keys)))
+
+    try:
+        friend_rows = cursor.fetchmany(batch_size)
+        while friend_rows:
+            for friend_row in friend_rows:
+                yield dict(zip(keys, friend_row))
+            friend_rows = cursor.fetchmany(batch_size)
+    finally:
+        cursor.close()
+
+
+@tracing.timed
+def iter_encoded_friends(ds_connection: sqlite3.Connection,
+                         batch_size: int=500, columns: list=None):
+    """
+    Lazily yield the JSON encoding of each row in the friends table.
+
+    Like iter_friends(), but each row is encoded by a row factory as it
+    is fetched (see encoding.friend_row_encoder()), so no dictionary is
+    built for it.  The encoding is the one json.dumps() gives the row's
+    representation with `sort_keys=True`.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        batch_size (int): The number of rows to fetch per round trip.
+        columns (list): The columns to read and represent (see
+            selected_columns()), or None for all of them.
+
+    Yields
+        A str of JSON for each row of the friends table.
+    """
+    keys = sorted(selected_columns(columns))
+    cursor = ds_connection.cursor()
+    cursor.row_factory = encoding.friend_row_encoder(keys)
+    cursor.execute('select {} from friends'.format(', '.join(keys)))
+
+    try:
+        encoded_friends = cursor.fetchmany(batch_size)
+        while encoded_friends:
+            yield from encoded_friends
+            encoded_friends = cursor.fetchmany(batch_size)
+    finally:
+        cursor.close()
+
+
+@tracing.timed
+def get_friends_page(ds_connection: sqlite3.Connection, limit: int,
+                     after: str=None, columns: list=None) -> list:
+    """
+    Return a representation of one page of rows in the friends table.
+
+    Rows are ordered case-insensitively by `id` and the page starts
+    right after the `after` id (keyset pagination), so every page costs
+    the same index seek no matter how deep into the table it is.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        limit (int): The maximum number of rows to return.
+        after (str): The `id` of the last row of the previous page, or
+            None for the first page.
+        columns (list): The columns to read and represent (see
+            selected_columns()), or None for all of them.
+
+    Returns
+        A list of JSON ready dictionaries representing up to `limit`
+        rows of the friends table.
+    """
+    keys = selected_columns(columns)
+    selected = ', '.join(keys)
+    if after is None:
+        cursor = ds_connection.execute(
+            'select {} from friends order by id collate nocase '
+            'limit ?'.format(selected),
+            [limit])
+    else:
+        cursor = ds_connection.execute(
+            'select {} from friends where id > ? collate nocase '
+            'order by id collate nocase limit ?'.format(selected),
+            [after, limit])
+
+    return [dict(zip(keys, friend_row)) for friend_row in cursor.fetchall()]
+
+
+@tracing.timed
+def get_changes(ds_connection: sqlite3.Connection, since: int, until: int,
+                limit: int, columns: list=None) -> tuple:
+    """
+    Return the friends changed and deleted after one version and up to
+    another, oldest change first.
+
+    Every write stamps the rows it creates or updates with a new
+    version (the write generation it brings the datastore to), and
+    leaves a tombstone carrying a new version for each row it deletes.
+    Both are indexed on their version, so this costs the same however
+    many friends haven't changed.
+
+    Pass the write generation read before calling this as `until`: rows
+    written after it are then left for the next call rather than seen
+    half way through.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        since (int): The version returned by the previous call, or 0 for
+            every friend.
+        until (int): The version to return changes up to, e.g. the
+            result of generation().
+        limit (int): The maximum number of changes to return.
+        columns (list): The columns to read and represent (see
+            selected_columns()), or None for all of them.
+
+    Returns
+        A (friends, deleted_ids, version) tuple: JSON ready dictionaries
+        representing the rows changed, the ids of the rows deleted and
+        the version to pass as `since` to get the changes that follow.
+        If it is less than `until`, more than `limit` changes were made
+        and there are more to get.
+    """
+    keys = selected_columns(columns)
+
+    # Tombstones take the friends' columns as nulls, with the id last so
+    # that deleted rows can be told apart.
     cursor = ds_connection.execute(
-        'select id, first_name, last_name, telephone, email, notes '
-        'from friends')
+        'select version, {}, null from friends '
+        'where version > ? and version <= ? '
+        'union all '
+        'select version, {}, id from friends_tombstones '
+        'where version > ? and version <= ? '
+        'order by version limit ?'.format(
+            ', '.join(keys), ', '.join(['null'] * len(keys))),
+        [since, until, since, until, limit + 1])
+    change_rows = cursor.fetchall()
+
+    version = until
+    if len(change_rows) > limit:
+        change_rows = change_rows[:limit]
+        version = change_rows[-1][0]
+
+    friends = list()
+    deleted_ids = list()
+    for change_row in change_rows:
+        if change_row[-1] is None:
+            friends.append(dict(zip(keys, change_row[1:-1])))
+        else:
+            deleted_ids.append(change_row[-1])
+
+    return friends, deleted_ids, version
+
+
+@tracing.timed
+def search_friends(ds_connection: sqlite3.Connection, query: str,
+                   limit: int, offset: int=0) -> list:
+    """
+    Return a representation of the friends matching a full-text query,
+    best matches first.
+
+    The friends_search index covers first_name, last_name, email and
+    notes, and matches are ranked with bm25.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        query (str): An FTS5 query expression, e.g. the result of
+            api_helpers.search_query().
+        limit (int): The maximum number of rows to return.
+        offset (int): The number of best matches to skip.
+
+    Returns
+        A list of JSON ready dictionaries representing up to `limit`
+        rows of the friends table.
 
-    friends_collection = list()
-    for friend_row in cursor.fetchall():
-        friends_collection.append(
-            {"id": friend_row[0],
+    Raises:
+        ValueError: If `query` isn't a valid FTS5 query expression.
+    """
+    try:
+        cursor = ds_connection.execute(
+            'select friends.id, friends.first_name, friends.last_name, '
+            'friends.telephone, friends.email, friends.notes '
+            'from friends_search '
+            'join friends on friends.rowid = friends_search.rowid '
+            'where friends_search match ? '
+            'order by friends_search.rank limit ? offset ?',
+            [query, limit, offset])
+        friend_rows = cursor.fetchall()
+    except sqlite3.OperationalError as error:
+        raise ValueError("Invalid search query: {}".format(error))
+
+    return [{"id": friend_row[0],
              "first_name": friend_row[1],
              "last_name": friend_row[2],
              "telephone": friend_row[3],
              "email": friend_row[4],
-             "notes": friend_row[5]})
+             "notes": friend_row[5]}
+            for friend_row in friend_rows]
+
 
-    return friends_collection
+@tracing.timed
+def rebuild_search_index(ds_connection: sqlite3.Connection):
+    """
+    Rebuild the friends_search index from the friends table.
+
+    Needed after a VACUUM, which may renumber the rowids that the index
+    uses to refer to friends.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+    """
+    ds_connection.execute(
+        "insert into friends_search (friends_search) values ('rebuild')")
+    ds_connection.commit()
 
 
-def get_friend(ds_connection: sqlite3.Connection, id: str) -> dict:
+@tracing.timed
+def get_friend(ds_connection: sqlite3.Connection, id: str,
+               columns: list=None) -> dict:
     """
     Obtain a specific friend record and return a representation of it.
 
@@ -42,29 +437,113 @@ def get_friend(ds_connection: sqlite3.Connection, id: str) -> dict:
             sqllite datastore containing a friends table.
         id (str): An `id` value which will be used to find a specific
             datastore row.
+        columns (list): The columns to read and represent (see
+            selected_columns()), or None for all of them.
 
     Returns
         A JSON ready dictionary representing a specific
         row of the friends table.
     """
+    return get_versioned_friend(ds_connection, id, columns)[0]
+
+
+@tracing.timed
+def get_versioned_friend(ds_connection: sqlite3.Connection, id: str,
+                         columns: list=None) -> tuple:
+    """
+    Obtain a specific friend record and return a representation of it
+    along with the row's version (see get_changes()).
+
+    The version is read with the row, or cached with it, so it always
+    describes the representation returned even when the friend cache
+    holds a copy that another process has since changed.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        id (str): An `id` value which will be used to find a specific
+            datastore row.
+        columns (list): The columns to read and represent (see
+            selected_columns()), or None for all of them.  Only complete
+            representations are cached, but a cached one also answers
+            for a subset of its columns.
+
+    Returns
+        A (friend, version) tuple: a JSON ready dictionary representing
+        a specific row of the friends table and its version, or
+        (None, None) if no row matches.
+    """
+    keys = selected_columns(columns)
+
+    # Cached entries hold the row's version alongside its columns.
+    cached_friend = friend_cache.get(id.lower())
+    if cached_friend is not None:
+        return ({key: cached_friend[key] for key in keys},
+                cached_friend['version'])
+
+    cache_token = friend_cache.token()
     cursor = ds_connection.execute(
-        'select id, first_name, last_name, telephone, email, notes '
-        'from friends where lower(id) = ?',
-        [id.lower()])
+        'select {}, version from friends where id = ? collate nocase'.format(
+            ', '.join(keys)),
+        [id])
 
     friend_row = cursor.fetchone()
+    if not friend_row:
+        return None, None
+
+    friend = dict(zip(keys, friend_row))
+    if columns is None:
+        friend_cache.put(id.lower(), dict(friend, version=friend_row[-1]),
+                         cache_token)
+    return friend, friend_row[-1]
+
+
+@tracing.timed
+def get_friends_by_id(ds_connection: sqlite3.Connection, ids: list,
+                      columns: list=None) -> tuple:
+    """
+    Obtain many specific friend records at once.
 
-    if friend_row:
-        return {
-            "id": friend_row[0],
-            "first_name": friend_row[1],
-            "last_name": friend_row[2],
-            "telephone": friend_row[3],
-            "email": friend_row[4],
-            "notes": friend_row[5]}
+    The ids are passed to SQLite as one JSON array and joined against
+    the friends table, so however many are requested it costs a single
+    query and an index seek per id.
 
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        ids (list): The `id` values of the rows to find, without
+            repeats (see api_helpers.requested_ids()).
+        columns (list): The columns to read and represent (see
+            selected_columns()), or None for all of them.
 
-def add_friend(ds_connection: sqlite3.Connection, entry_data: dict):
+    Returns
+        A (friends, missing_ids) tuple: JSON ready dictionaries
+        representing the rows found, in the order of `ids`, and the ids
+        that matched no row, also in that order.
+    """
+    keys = selected_columns(columns)
+    cursor = ds_connection.execute(
+        'select requested.key, {} from json_each(?) as requested '
+        'join friends on friends.id = requested.value collate nocase '
+        'order by requested.key'.format(
+            ', '.join('friends.{}'.format(key) for key in keys)),
+        [json.dumps(ids)])
+
+    friends = list()
+    found = set()
+    for friend_row in cursor:
+        if friend_row[0] not in found:
+            found.add(friend_row[0])
+            friends.append(dict(zip(keys, friend_row[1:])))
+
+    missing_ids = [id for position, id in enumerate(ids)
+                   if position not in found]
+    return friends, missing_ids
+
+
+@tracing.timed
+def add_friend(ds_connection: sqlite3.Connection, entry_data: dict,
+               commit: bool=True):
     """
     Create a new row in the friends table.
 
@@ -72,45 +551,260 @@ def add_friend(ds_connection: sqlite3.Connection, entry_data: dict):
         ds_connection (sqllite3.Connection): An active connection to a
             sqllite datastore containing a friends table.
         entry_data (dict): The data needed to created a new entry.
+        commit (bool): Pass False to leave committing to the caller
+            (see commit()).
+
+    Raises:
+        ValueError: If a row with the same `id` already exists.
     """
-    ds_connection.execute(
+    # A single statement checks for an existing row and inserts, so
+    # there is no window for another writer to slip in between.
+    cursor = ds_connection.execute(
         "insert into friends (id, first_name, last_name, telephone, email, notes) "
-        "values (?, ?, ?, ?, ?, ?)",
+        "select ?, ?, ?, ?, ?, ? "
+        "where not exists (select 1 from friends where id = ? collate nocase)",
         [entry_data['id'],
          entry_data['firstName'],
          entry_data['lastName'],
          entry_data['telephone'],
          entry_data['email'],
-         entry_data['notes']])
+         entry_data['notes'],
+         entry_data['id']])
+
+    if not cursor.rowcount:
+        if commit:
+            ds_connection.rollback()
+        raise ValueError("An friend resource already exists with the "
+                         "given id: {}".format(entry_data['id']))
+
+    _finish_write(ds_connection,
+                  [('created', entry_data['id'], entry_data)], commit)
+
+
+@tracing.timed
+def add_friends(ds_connection: sqlite3.Connection, entries: list,
+                commit: bool=True) -> set:
+    """
+    Create new rows in the friends table for many entries at once.
+
+    All of the rows are inserted with a single statement inside one
+    transaction, so the whole batch costs one commit.  Entries whose `id`
+    already exists in the table are skipped.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        entries (list): The data needed to create each new entry.
+        commit (bool): Pass False to insert within the caller's
+            transaction and leave committing to the caller (see commit()).
+
+    Returns
+        The set of `id` values from `entries` that already existed and
+        were therefore not inserted.
+    """
+    if commit:
+        ds_connection.execute('begin immediate')
+    try:
+        existing_ids = _insert_friends(ds_connection, entries)
+    except Exception:
+        if commit:
+            ds_connection.rollback()
+        raise
+
+    _finish_write(ds_connection,
+                  [('created', entry['id'], entry) for entry in entries
+                   if entry['id'] not in existing_ids],
+                  commit)
+    return existing_ids
+
+
+@tracing.timed
+def import_friends(ds_connection: sqlite3.Connection, entries: list) -> set:
+    """
+    Create new rows in the friends table for one chunk of a bulk import
+    and commit them.
+
+    Like add_friends(), but the friend cache and name index aren't
+    updated: a bulk import runs in its own process (see bulk), and
+    holding every imported name in memory would defeat streaming it.
+    A running API loads the imported names when it is restarted.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        entries (list): The data needed to create each new entry.  Ids
+            must be unique within the chunk.
+
+    Returns
+        The set of `id` values from `entries` that already existed and
+        were therefore not inserted.
+    """
+    ds_connection.execute('begin immediate')
+    try:
+        existing_ids = _insert_friends(ds_connection, entries)
+    except Exception:
+        ds_connection.rollback()
+        raise
+
     ds_connection.commit()
+    return existing_ids
+
+
+def _insert_friends(ds_connection: sqlite3.Connection, entries: list) -> set:
+    """
+    Insert the entries whose `id` isn't in the friends table yet, within
+    the caller's transaction, and return the ids that were.
+    """
+    cursor = ds_connection.execute(
+        'select requested.value from json_each(?) as requested '
+        'where exists (select 1 from friends '
+        'where friends.id = requested.value collate nocase)',
+        [json.dumps([entry['id'] for entry in entries])])
+    existing_ids = {row[0] for row in cursor}
+
+    # One insert ... select statement rather than an executemany() of
+    # single row inserts: the full-text index trigger is several times
+    # cheaper per row when its rows arrive in a single statement.
+    ds_connection.execute(
+        "insert into friends (id, first_name, last_name, telephone, email, notes) "
+        "select json_extract(value, '$[0]'), json_extract(value, '$[1]'), "
+        "json_extract(value, '$[2]'), json_extract(value, '$[3]'), "
+        "json_extract(value, '$[4]'), json_extract(value, '$[5]') "
+        "from json_each(?)",
+        [json.dumps([[entry_data['id'],
+                      entry_data['firstName'],
+                      entry_data['lastName'],
+                      entry_data['telephone'],
+                      entry_data['email'],
+                      entry_data['notes']]
+                     for entry_data in entries
+                     if entry_data['id'] not in existing_ids])])
 
+    return existing_ids
 
-def fully_update_friend(ds_connection: sqlite3.Connection, entry_data: dict):
+
+@tracing.timed
+def fully_update_friend(ds_connection: sqlite3.Connection, id: str,
+                        entry_data: dict, commit: bool=True):
     """
     Update all aspects of given row in the friends table.
 
     Args:
         ds_connection (sqllite3.Connection): An active connection to a
             sqllite datastore containing a friends table.
-        entry_data (dict): The data needed to update a given entry.  The
-            `id` value of this dictionary is used to identify the entry
-            to update.
+        id (str): An `id` value which will be used to find the specific
+            datastore row to update, e.g. the one in the request's URL.
+        entry_data (dict): The data needed to update a given entry.  Its
+            `id` replaces the row's, so callers should check that it
+            only differs from `id` in case.
+        commit (bool): Pass False to leave committing to the caller
+            (see commit()).
+
+    Raises:
+        ValueError: If no row matches `id`.
     """
-    ds_connection.execute(
+    cursor = ds_connection.execute(
         "UPDATE friends "
         "SET id=?, first_name=?, last_name=?, telephone=?, email=?, notes=? "
-        "WHERE lower(id) = ?",
+        "WHERE id = ? COLLATE NOCASE",
         [entry_data['id'],
          entry_data['firstName'],
          entry_data['lastName'],
          entry_data['telephone'],
          entry_data['email'],
          entry_data['notes'],
-         entry_data['id'].lower()])
-    ds_connection.commit()
+         id])
 
+    if not cursor.rowcount:
+        if commit:
+            ds_connection.rollback()
+        raise ValueError("No friend resource exists that matches "
+                         "the given id: {}".format(id))
+
+    _finish_write(ds_connection,
+                  [('updated', entry_data['id'], entry_data)], commit)
 
-def delete_friend(ds_connection: sqlite3.Connection, id: str) -> dict:
+
+@tracing.timed
+def update_friends(ds_connection: sqlite3.Connection, updates: list,
+                   commit: bool=True) -> list:
+    """
+    Update some elements of many rows in the friends table, all or
+    nothing.
+
+    Every update is applied within one transaction.  Updates that
+    change the same set of elements are applied together with
+    executemany(), so a batch costs one statement per distinct set of
+    elements rather than one per row.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore containing a friends table.
+        updates (list): An (id, {element: value}) tuple for each row to
+            update, as returned by api_helpers.partial_updates().  Each
+            element is a key of FRIEND_COLUMNS other than `id`.
+        commit (bool): Pass False to update within the caller's
+            transaction and leave committing to the caller (see commit()).
+
+    Returns
+        A JSON ready dictionary representing each updated row, in the
+        order of `updates`.
+
+    Raises:
+        ValueError: If any `id` matches no row (nothing is updated), or
+            an element is unknown.
+    """
+    ids = [id for id, _ in updates]
+    statements = dict()
+    for id, changes in updates:
+        # Only known column names reach the SQL.
+        elements = tuple(element for element in FRIEND_COLUMNS
+                         if element in changes and element != 'id')
+        if len(elements) != len(changes):
+            raise ValueError("Unknown or read-only friend elements: "
+                             "{}".format(sorted(set(changes) -
+                                                set(elements))))
+        statements.setdefault(elements, list()).append(
+            [changes[element] for element in elements] + [id])
+
+    if commit:
+        ds_connection.execute('begin immediate')
+    try:
+        cursor = ds_connection.execute(
+            'select requested.value from json_each(?) as requested '
+            'where not exists (select 1 from friends '
+            'where friends.id = requested.value collate nocase)',
+            [json.dumps(ids)])
+        missing_ids = [row[0] for row in cursor]
+        if missing_ids:
+            raise ValueError("No friend resource exists that matches the "
+                             "given ids: {}".format(", ".join(missing_ids)))
+
+        for elements, parameters in statements.items():
+            ds_connection.executemany(
+                'update friends set {} where id = ? collate nocase'.format(
+                    ', '.join('{} = ?'.format(FRIEND_COLUMNS[element])
+                              for element in elements)),
+                parameters)
+
+        friends, _ = get_friends_by_id(ds_connection, ids)
+    except Exception:
+        if commit:
+            ds_connection.rollback()
+        raise
+
+    _finish_write(ds_connection,
+                  [('updated', friend['id'],
+                    {element: friend[column]
+                     for element, column in FRIEND_COLUMNS.items()})
+                   for friend in friends],
+                  commit)
+    return friends
+
+
+@tracing.timed
+def delete_friend(ds_connection: sqlite3.Connection, id: str,
+                  commit: bool=True) -> dict:
     """
     Delete a given entry from the friends table in a given SQLite connection.
 
@@ -119,13 +813,20 @@ def delete_friend(ds_connection: sqlite3.Connection, id: str) -> dict:
             sqllite datastore containing a friends table.
         id (str): An `id` value which will be used to find a specific
             datastore row to delete.
+        commit (bool): Pass False to leave committing to the caller
+            (see commit()).
+
+    Raises:
+        ValueError: If no row matches `id`.
     """
     cursor = ds_connection.execute(
         'DELETE  '
-        'from friends where lower(id) = ?',
-        [id.lower()])
+        'from friends where id = ? collate nocase',
+        [id])
 
     if not cursor.rowcount:
-        raise ValueError()
+        if commit:
+            ds_connection.rollback()
+        raise ValueError("No such friend exists.")
 
-    ds_connection.commit()
\ No newline at end of file
+    _finish_write(ds_connection, [('deleted', id, None)], commit)
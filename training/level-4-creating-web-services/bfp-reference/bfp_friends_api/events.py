@@ -0,0 +1,209 @@
+"""
+This module fans events out to subscribers in the same process, for the
+Server-Sent Events change feed.
+
+Publishing never blocks: each subscriber has a bounded queue, and a
+subscriber that falls so far behind that its queue fills up is dropped
+rather than allowed to hold up the writer or use unbounded memory.  It
+can reconnect and resume from the last event it saw, which is replayed
+from a ring buffer of recent events.
+"""
+
+import collections
+import json
+import queue
+import threading
+import time
+
+
+class Subscription:
+    """
+    One subscriber's view of an EventBroker's events.  Obtained from
+    EventBroker.subscribe() and must be closed with close(), which may
+    be called from any thread, e.g. when the subscriber disconnects.
+
+    Attributes:
+        replay (list): Events published before the subscription that
+            followed the subscriber's last seen event, oldest first.
+        resync (bool): True if the subscriber's last seen event is no
+            longer known (it was pushed out of the ring buffer, or
+            published before the process started), so it may have
+            missed events and should reload what it holds.
+    """
+
+    def __init__(self, broker, queue_size: int, replay: list, resync: bool):
+        self.replay = replay
+        self.resync = resync
+        self.dropped = False
+        self.closed = False
+        self._broker = broker
+        self._queue_size = queue_size
+        # One slot more than queue_size, for the None that wakes the
+        # subscriber when it is dropped or closed.
+        self._queue = queue.Queue(maxsize=queue_size + 1)
+
+    def get(self, timeout: float):
+        """
+        Return the next event, or None if none was published within
+        `timeout` seconds or the subscription was dropped or closed (see
+        `dropped` and `closed`).
+        """
+        if self.closed:
+            return None
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """Stop receiving events, waking a get() that is waiting."""
+        self._broker._unsubscribe(self)
+        if not self.closed:
+            self.closed = True
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                # get() won't wait for an event then.
+                pass
+
+    def _offer(self, event: dict) -> bool:
+        """
+        Queue an event, or drop the subscription if its queue is full.
+        Only called by the broker, under its lock.
+        """
+        if self._queue.qsize() >= self._queue_size:
+            self.dropped = True
+            self._queue.put_nowait(None)
+            return False
+        self._queue.put_nowait(event)
+        return True
+
+
+class EventBroker:
+    """
+    Publishes events to every current subscriber and keeps the most
+    recent ones for subscribers resuming after a disconnect.
+
+    Event ids are `<epoch>-<sequence>`: the epoch changes every time a
+    broker is created, so an id from before a restart is recognized as
+    unknown instead of being mistaken for a recent one.
+
+    Args:
+        ring_size (int): The number of recent events kept for replay.
+        queue_size (int): The number of events each subscriber may fall
+            behind by before it is dropped.
+        max_subscribers (int): The maximum number of subscribers.
+    """
+
+    def __init__(self, ring_size: int=1000, queue_size: int=100,
+                 max_subscribers: int=100):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+
+        self._epoch = '{:x}'.format(time.time_ns())
+        self._sequence = 0
+        self._ring = collections.deque(maxlen=ring_size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+        self._published = 0
+        self._dropped = 0
+
+    @property
+    def ring_size(self) -> int:
+        return self._ring.maxlen
+
+    @ring_size.setter
+    def ring_size(self, ring_size: int):
+        with self._lock:
+            self._ring = collections.deque(self._ring, maxlen=ring_size)
+
+    def publish(self, event_type: str, data: dict) -> dict:
+        """
+        Publish an event to every subscriber.
+
+        Args:
+            event_type (str): The event's name, e.g. 'created'.
+            data (dict): The event's JSON ready payload.
+
+        Returns:
+            The event: a dictionary of its `id`, `event` and `data`,
+            which is already encoded as JSON.
+        """
+        with self._lock:
+            self._sequence += 1
+            event = {"id": "{}-{}".format(self._epoch, self._sequence),
+                     "event": event_type,
+                     "data": json.dumps(data, sort_keys=True)}
+            self._ring.append((self._sequence, event))
+            self._published += 1
+
+            for subscription in list(self._subscribers):
+                if not subscription._offer(event):
+                    self._subscribers.discard(subscription)
+                    self._dropped += 1
+
+        return event
+
+    def subscribe(self, last_event_id: str=None) -> Subscription:
+        """
+        Start receiving events.
+
+        Args:
+            last_event_id (str): The id of the last event the subscriber
+                received before it disconnected, if any.  The events
+                published since are replayed.
+
+        Raises:
+            OverflowError: If there are already `max_subscribers`.
+        """
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise OverflowError(
+                    "There are already {} subscribers to the change "
+                    "feed.".format(self.max_subscribers))
+
+            replay = list()
+            resync = False
+            if last_event_id is not None:
+                last_sequence = self._sequence_of(last_event_id)
+                oldest_sequence = (self._ring[0][0] if self._ring
+                                   else self._sequence + 1)
+                if (last_sequence is None or
+                        last_sequence > self._sequence or
+                        last_sequence < oldest_sequence - 1):
+                    resync = True
+                else:
+                    replay = [event for sequence, event in self._ring
+                              if sequence > last_sequence]
+
+            subscription = Subscription(self, self.queue_size, replay,
+                                        resync)
+            self._subscribers.add(subscription)
+            return subscription
+
+    def stats(self) -> dict:
+        """
+        Return the broker's subscriber and event counters.
+
+        Returns:
+            A JSON ready dictionary of counters.
+        """
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "max_subscribers": self.max_subscribers,
+                "published": self._published,
+                "dropped_subscribers": self._dropped,
+                "ring_events": len(self._ring)}
+
+    def _sequence_of(self, event_id: str):
+        """Return the sequence of one of this broker's event ids, or None."""
+        epoch, _, sequence = event_id.partition('-')
+        if epoch != self._epoch or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def _unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
@@ -0,0 +1,180 @@
+"""
+This module records request metrics and renders them in the Prometheus
+text exposition format.
+
+Recording a request costs one uncontended lock acquisition, three
+bisects into fixed bucket bounds and a handful of integer additions.
+Cumulative bucket counts are only worked out when the metrics are
+scraped.
+"""
+
+import bisect
+import threading
+
+# Upper bounds of the latency buckets, in seconds.
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the payload size buckets, in bytes.
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Histogram:
+    """
+    Counts observations into buckets.  Not thread safe on its own: the
+    RequestMetrics that owns it serializes access.
+    """
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # One count per bucket plus one for +Inf, not cumulative.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str) -> list:
+        """Return the histogram's exposition lines."""
+        lines = list()
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                name, labels, bound, cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels.rstrip(','),
+                                               self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels.rstrip(','),
+                                                 self.count))
+        return lines
+
+
+class RequestMetrics:
+    """
+    Latency and payload size histograms per route, method and status,
+    plus the number of requests in flight.
+
+    Args:
+        prefix (str): The prefix of every metric name.
+    """
+
+    def __init__(self, prefix: str="friends_api"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # (route, method, status) -> (duration, request size,
+        #                             response size) histograms
+        self._series = dict()
+
+    def started(self):
+        """Count a request as in flight."""
+        with self._lock:
+            self._in_flight += 1
+
+    def finished(self):
+        """Count a request as no longer in flight."""
+        with self._lock:
+            self._in_flight -= 1
+
+    def observe(self, route: str, method: str, status: int,
+                duration: float, request_size: int, response_size: int):
+        """
+        Record a completed request.
+
+        Args:
+            route (str): The URL rule that matched, e.g.
+                '/api/v1/friends/<id>', so friends share one series.
+            method (str): The request method.
+            status (int): The response status code.
+            duration (float): Seconds taken to produce the response.
+            request_size (int): Bytes in the request body.
+            response_size (int): Bytes in the response body, or None if
+                it is streamed and its size isn't known.
+        """
+        key = (route, method, status)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = (Histogram(DURATION_BUCKETS),
+                                              Histogram(SIZE_BUCKETS),
+                                              Histogram(SIZE_BUCKETS))
+            series[0].observe(duration)
+            series[1].observe(request_size)
+            if response_size is not None:
+                series[2].observe(response_size)
+
+    def exposition(self, gauges: dict=None) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Args:
+            gauges (dict): Extra values to expose, such as cache and
+                pool statistics: {name: (help text, value)}.  Names get
+                the metrics' prefix.
+        """
+        with self._lock:
+            in_flight = self._in_flight
+            series = [(key, tuple(_copy(histogram) for histogram in value))
+                      for key, value in sorted(self._series.items(),
+                                               key=lambda item: str(item[0]))]
+
+        lines = [
+            '# HELP {}_requests_in_flight Requests being handled.'.format(
+                self.prefix),
+            '# TYPE {}_requests_in_flight gauge'.format(self.prefix),
+            '{}_requests_in_flight {}'.format(self.prefix, in_flight)]
+
+        histograms = [
+            ('request_duration_seconds',
+             'Time taken to produce a response.'),
+            ('request_size_bytes', 'Size of request bodies.'),
+            ('response_size_bytes', 'Size of response bodies.')]
+        for index, (name, help) in enumerate(histograms):
+            name = '{}_{}'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} histogram'.format(name))
+            for (route, method, status), value in series:
+                labels = 'route="{}",method="{}",status="{}",'.format(
+                    _escape(route), _escape(method), status)
+                lines.extend(value[index].samples(name, labels))
+
+        for name, (help, value) in sorted((gauges or {}).items()):
+            name = '{}_{}'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def stats_gauges(subsystem: str, stats: dict, description: str) -> dict:
+    """
+    Turn the counters returned by one of the stats() methods (e.g.
+    ConnectionPool.stats()) into gauges for RequestMetrics.exposition().
+
+    Args:
+        subsystem (str): Prefixes the name of each gauge.
+        stats (dict): The counters, by name.
+        description (str): What the counters describe, for the help text.
+    """
+    return {"{}_{}".format(subsystem, name): (
+                "{}: {}.".format(description, name.replace('_', ' ')), value)
+            for name, value in stats.items()}
+
+
+def _copy(histogram: Histogram) -> Histogram:
+    """Return a snapshot of a histogram.  The lock must be held."""
+    snapshot = Histogram(histogram.buckets)
+    snapshot.counts = list(histogram.counts)
+    snapshot.sum = histogram.sum
+    snapshot.count = histogram.count
+    return snapshot
+
+
+def _escape(label_value: str) -> str:
+    """Escape a label value for the exposition format."""
+    return (label_value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
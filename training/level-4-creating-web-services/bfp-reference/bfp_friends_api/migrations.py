@@ -0,0 +1,233 @@
+"""
+This module keeps the schema of our SQLite datastore up to date.
+
+Each migration is applied once, in order, and the number of the last
+one applied is recorded in the database's `user_version` pragma.
+
+Run it directly to upgrade an existing datastore by hand:
+
+    python -m bfp_friends_api.migrations /tmp/friends.db
+"""
+
+import sqlite3
+import sys
+
+# The columns of the friends table that migration 1 creates.
+FRIENDS_COLUMNS = {"id", "first_name", "last_name", "telephone", "email",
+                   "notes"}
+
+# (version, description, statements)
+MIGRATIONS = [
+    (1, "Create the friends table.",
+     ["create table if not exists friends ("
+      "id text not null, "
+      "first_name text not null, "
+      "last_name text not null, "
+      "telephone text not null, "
+      "email text not null, "
+      "notes text not null)"]),
+    (2, "Index friends.id case-insensitively.",
+     ["create index if not exists friends_id_nocase "
+      "on friends (id collate nocase)"]),
+    (3, "Count writes to the friends table in store_generation.",
+     ["create table store_generation ("
+      "singleton integer primary key check (singleton = 0), "
+      "generation integer not null)",
+      "insert into store_generation (singleton, generation) values (0, 0)",
+      "create trigger friends_insert_generation after insert on friends "
+      "begin update store_generation set generation = generation + 1; end",
+      "create trigger friends_update_generation after update on friends "
+      "begin update store_generation set generation = generation + 1; end",
+      "create trigger friends_delete_generation after delete on friends "
+      "begin update store_generation set generation = generation + 1; end"]),
+    (4, "Index friend names, emails and notes for full-text search.",
+     # An external content table: the index refers to friends by rowid
+     # instead of holding a second copy of the text.  VACUUM may
+     # renumber those rowids, so run datastore.rebuild_search_index()
+     # after vacuuming.
+     ["create virtual table friends_search using fts5("
+      "first_name, last_name, email, notes, "
+      "content='friends', content_rowid='rowid', "
+      "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+      "insert into friends_search (friends_search) values ('rebuild')",
+      # Rank matches on a name above matches on an email, and both
+      # above matches in the notes.
+      "insert into friends_search (friends_search, rank) "
+      "values ('rank', 'bm25(10.0, 10.0, 5.0, 1.0)')",
+      "create trigger friends_insert_search after insert on friends begin "
+      "insert into friends_search (rowid, first_name, last_name, email, "
+      "notes) values (new.rowid, new.first_name, new.last_name, new.email, "
+      "new.notes); end",
+      "create trigger friends_delete_search after delete on friends begin "
+      "insert into friends_search (friends_search, rowid, first_name, "
+      "last_name, email, notes) values ('delete', old.rowid, "
+      "old.first_name, old.last_name, old.email, old.notes); end",
+      "create trigger friends_update_search "
+      "after update of first_name, last_name, email, notes on friends begin "
+      "insert into friends_search (friends_search, rowid, first_name, "
+      "last_name, email, notes) values ('delete', old.rowid, "
+      "old.first_name, old.last_name, old.email, old.notes); "
+      "insert into friends_search (rowid, first_name, last_name, email, "
+      "notes) values (new.rowid, new.first_name, new.last_name, new.email, "
+      "new.notes); end"]),
+    (5, "Version friends and keep tombstones of deleted ones for delta "
+        "sync.",
+     # A row's version is the write generation its last change brought
+     # the datastore to, so versions are unique and increase with every
+     # change.  The generation triggers of migration 3 are replaced by
+     # ones that also stamp the version, so that the two always agree
+     # whatever order SQLite fires triggers in.
+     ["drop trigger friends_insert_generation",
+      "drop trigger friends_update_generation",
+      "drop trigger friends_delete_generation",
+      "alter table friends add column version integer not null default 0",
+      # Number existing friends after the current generation, by rowid,
+      # and move the generation past them.
+      "update friends set version = "
+      "(select generation from store_generation) + rowid",
+      "update store_generation set generation = "
+      "generation + (select ifnull(max(rowid), 0) from friends)",
+      "create index friends_version on friends (version)",
+      "create table friends_tombstones ("
+      "id text primary key collate nocase, "
+      "version integer not null)",
+      "create index friends_tombstones_version "
+      "on friends_tombstones (version)",
+      "create trigger friends_insert_version after insert on friends begin "
+      "update store_generation set generation = generation + 1; "
+      "update friends set version = "
+      "(select generation from store_generation) where rowid = new.rowid; "
+      "delete from friends_tombstones where id = new.id; end",
+      # Only changes to a friend's elements count: stamping the version
+      # mustn't fire this again.
+      "create trigger friends_update_version "
+      "after update of id, first_name, last_name, telephone, email, notes "
+      "on friends begin "
+      "update store_generation set generation = generation + 1; "
+      "update friends set version = "
+      "(select generation from store_generation) where rowid = new.rowid; "
+      "end",
+      "create trigger friends_delete_version after delete on friends begin "
+      "update store_generation set generation = generation + 1; "
+      "insert or replace into friends_tombstones (id, version) "
+      "select old.id, generation from store_generation; end"]),
+]
+
+
+def check_friends_table(ds_connection: sqlite3.Connection):
+    """
+    Make sure that a friends table which already exists before the first
+    migration has the columns the migrations build on, rather than
+    adopting an incompatible one such as the camelCase table that
+    datastore_setup.sql creates for the exercises.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore.
+
+    Raises:
+        ValueError: If the friends table lacks any of the columns.
+    """
+    columns = {row[1] for row
+               in ds_connection.execute('pragma table_info(friends)')}
+    missing_columns = FRIENDS_COLUMNS - columns
+    if columns and missing_columns:
+        raise ValueError(
+            "The datastore's friends table has the columns {} and is "
+            "missing {}, so it can't be migrated.  It may have been created "
+            "by datastore_setup.sql for the exercises: use another datastore "
+            "file, or drop the table.".format(
+                sorted(columns), sorted(missing_columns)))
+
+
+# Checks run before a migration's statements, by version.
+PRECONDITIONS = {1: check_friends_table}
+
+
+def schema_version(ds_connection: sqlite3.Connection) -> int:
+    """
+    Return the number of the last migration applied to a datastore.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore.
+    """
+    return ds_connection.execute('pragma user_version').fetchone()[0]
+
+
+def migrate(ds_connection: sqlite3.Connection) -> list:
+    """
+    Apply every migration that a datastore hasn't seen yet.
+
+    Each migration runs in its own transaction along with the update
+    of `user_version`, so a failed migration leaves the datastore at
+    the previous version.  So does one whose PRECONDITIONS aren't met.
+
+    Args:
+        ds_connection (sqllite3.Connection): An active connection to a
+            sqllite datastore.
+
+    Returns:
+        A list of (version, description) tuples for the migrations that
+        were applied.  An empty list means the datastore was already
+        up to date.
+
+    Raises:
+        ValueError: If the datastore holds a friends table that the
+            migrations can't build on (see check_friends_table()).
+    """
+    applied = list()
+
+    for version, description, statements in MIGRATIONS:
+        if schema_version(ds_connection) >= version:
+            continue
+
+        ds_connection.execute('begin immediate')
+        try:
+            # Another process may have migrated while we were waiting
+            # for the write lock.
+            if schema_version(ds_connection) >= version:
+                ds_connection.rollback()
+                continue
+
+            if version in PRECONDITIONS:
+                PRECONDITIONS[version](ds_connection)
+            for statement in statements:
+                ds_connection.execute(statement)
+            ds_connection.execute('pragma user_version = {:d}'.format(version))
+        except Exception:
+            ds_connection.rollback()
+            raise
+
+        ds_connection.commit()
+        applied.append((version, description))
+
+    return applied
+
+
+def describe_migration(database: str, applied: list) -> str:
+    """
+    Summarize the result of migrate() as a human readable sentence.
+
+    Args:
+        database (str): The path of the migrated datastore.
+        applied (list): The return value of migrate().
+    """
+    if not applied:
+        return "{} is up to date at schema version {}.".format(
+            database, MIGRATIONS[-1][0])
+
+    return "Upgraded {} from schema version {} to {}: {}".format(
+        database, applied[0][0] - 1, applied[-1][0],
+        " ".join(description for _, description in applied))
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else "/tmp/friends.db"
+    connection = sqlite3.connect(database)
+    try:
+        print(describe_migration(database, migrate(connection)))
+    except ValueError as error:
+        sys.exit(str(error))
+    finally:
+        connection.close()
@@ -0,0 +1,231 @@
+"""
+This module provides a bounded pool of SQLite connections that can be
+shared by the threads serving requests.
+"""
+
+import contextlib
+import sqlite3
+import threading
+import time
+
+
+class ConnectionPool:
+    """
+    Hands out SQLite connections to callers and takes them back when
+    they are done, so that connections are reused between requests
+    instead of being opened and closed every time.
+
+    Connections are opened lazily, up to `max_size` of them.  When all
+    of them are checked out, callers wait up to `timeout` seconds for
+    one to be released before a TimeoutError is raised.
+
+    Args:
+        database (str): The path of the SQLite database file.
+        max_size (int): The maximum number of open connections.
+        timeout (float): The number of seconds to wait for a free
+            connection before giving up.
+        health_check_interval (float): Connections that have been idle
+            for longer than this many seconds are checked with a trivial
+            query before being handed out.  Broken ones are replaced.
+        on_connect (callable): An optional function that is called with
+            every newly opened connection, e.g. to set pragmas.
+    """
+
+    def __init__(self, database: str, max_size: int=5, timeout: float=5.0,
+                 health_check_interval: float=30.0, on_connect=None):
+        if max_size < 1:
+            raise ValueError("A connection pool needs a max_size of at "
+                             "least 1, not {}.".format(max_size))
+
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.on_connect = on_connect
+
+        # (connection, last used) pairs, used as a stack so that the most
+        # recently used (and least likely to be stale) connection is
+        # handed out first.  Waiting callers are notified through
+        # _available whenever a connection is released or a slot for a
+        # new one is freed.
+        self._idle = list()
+        self._checked_out = set()
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._open_connections = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._health_check_failures = 0
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Check out a connection from the pool.
+
+        Returns:
+            A sqlite3.Connection which must be handed back with release().
+
+        Raises:
+            TimeoutError: If no connection became available within
+                `timeout` seconds.
+        """
+        if self._closed:
+            raise ValueError("Cannot acquire a connection from a closed pool.")
+
+        started = time.perf_counter()
+        waited = False
+
+        while True:
+            with self._available:
+                while not self._idle and (self._open_connections >=
+                                          self.max_size):
+                    waited = True
+                    remaining = self.timeout - (time.perf_counter() - started)
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            "No datastore connection became available "
+                            "within {} seconds.".format(self.timeout))
+                    self._available.wait(remaining)
+
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                else:
+                    # Reserve the slot before connecting outside the lock.
+                    self._open_connections += 1
+                    connection = None
+
+            if connection is None:
+                connection = self._connect()
+                last_used = time.monotonic()
+
+            if self._is_healthy(connection, last_used):
+                break
+
+        wait_seconds = time.perf_counter() - started
+        with self._lock:
+            self._checked_out.add(connection)
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+                self._wait_seconds += wait_seconds
+                self._max_wait_seconds = max(self._max_wait_seconds,
+                                             wait_seconds)
+
+        return connection
+
+    def release(self, connection: sqlite3.Connection):
+        """
+        Return a connection previously obtained from acquire().
+
+        Any transaction left open by the caller is rolled back so the
+        next user of the connection starts from a clean slate.
+
+        Raises:
+            ValueError: If the connection isn't checked out from this
+                pool, e.g. because it was already released.  Pooling it
+                again would hand it to two callers at once.
+        """
+        with self._lock:
+            if connection not in self._checked_out:
+                raise ValueError("Cannot release a connection that isn't "
+                                 "checked out from this pool.")
+            self._checked_out.discard(connection)
+
+        if self._closed:
+            self._discard(connection)
+            return
+
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except sqlite3.Error:
+            self._discard(connection)
+            return
+
+        with self._available:
+            self._idle.append((connection, time.monotonic()))
+            self._available.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a `with` block.
+
+        Usage:
+            with pool.connection() as ds_connection:
+                datastore.get_friends(ds_connection)
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        """Close every idle connection and refuse further checkouts."""
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, list()
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the pool's size and checkout metrics.
+
+        Returns:
+            A JSON ready dictionary of counters.
+        """
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "open": self._open_connections,
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_seconds_total": self._wait_seconds,
+                "wait_seconds_max": self._max_wait_seconds,
+                "health_check_failures": self._health_check_failures}
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection in a slot reserved by acquire()."""
+        try:
+            connection = sqlite3.connect(self.database,
+                                         check_same_thread=False)
+            if self.on_connect is not None:
+                self.on_connect(connection)
+        except Exception:
+            with self._available:
+                self._open_connections -= 1
+                self._available.notify()
+            raise
+
+        return connection
+
+    def _is_healthy(self, connection: sqlite3.Connection,
+                    last_used: float) -> bool:
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            connection.execute('select 1').fetchone()
+        except sqlite3.Error:
+            with self._lock:
+                self._health_check_failures += 1
+            self._discard(connection)
+            return False
+
+        return True
+
+    def _discard(self, connection: sqlite3.Connection):
+        # Freeing the slot lets a waiting caller open a new connection.
+        with self._available:
+            self._open_connections -= 1
+            self._available.notify()
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
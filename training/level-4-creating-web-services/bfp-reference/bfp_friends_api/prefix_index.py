@@ -0,0 +1,163 @@
+"""
+This module provides an in-process index of friend names for
+autocomplete, so suggestions can be answered without a datastore query.
+"""
+
+import bisect
+import sys
+import threading
+
+
+class PrefixIndex:
+    """
+    A sorted array of lowercased names that is searched with bisect.
+
+    Each friend is indexed under their first name, their last name and
+    their full name, so "jo", "smi" and "john sm" all suggest John Smith.
+    The names and the ids they belong to are kept in two parallel lists
+    rather than a list of tuples, which saves a 56 byte tuple per entry.
+
+    Adding or removing a friend shifts the tail of the lists.  That is a
+    memmove of tens of megabytes (around 10ms) at a million friends --
+    paid by writes, while a suggestion stays a bisect plus a short scan.
+
+    The index only knows about writes made by this process, so it
+    assumes a single process writes to the datastore.
+    """
+
+    def __init__(self):
+        self._keys = list()
+        self._ids = list()
+        # Lowercased id -> (id, first_name, last_name)
+        self._friends = dict()
+        self._key_bytes = 0
+        self._lock = threading.Lock()
+
+    def load(self, friends):
+        """
+        Replace the contents of the index.
+
+        Args:
+            friends: An iterable of friend representations, such as
+                datastore.iter_friends() yields.
+        """
+        indexed_friends = dict()
+        entries = list()
+        for friend in friends:
+            key = friend['id'].lower()
+            first_name = str(friend['first_name'])
+            last_name = str(friend['last_name'])
+            indexed_friends[key] = (friend['id'], first_name, last_name)
+            entries.extend((name, key) for name in self._names(
+                first_name, last_name))
+        entries.sort()
+
+        keys = [name for name, _ in entries]
+        ids = [key for _, key in entries]
+        key_bytes = sum(sys.getsizeof(name) for name in keys)
+
+        with self._lock:
+            self._keys = keys
+            self._ids = ids
+            self._friends = indexed_friends
+            self._key_bytes = key_bytes
+
+    def add(self, id: str, first_name: str, last_name: str):
+        """
+        Index a friend, replacing any entries they already had.  Names
+        that aren't strings are indexed as text, as SQLite stores them.
+        """
+        key = id.lower()
+        first_name, last_name = str(first_name), str(last_name)
+        with self._lock:
+            self._remove(key)
+            self._friends[key] = (id, first_name, last_name)
+            for name in self._names(first_name, last_name):
+                position = bisect.bisect_right(self._keys, name)
+                self._keys.insert(position, name)
+                self._ids.insert(position, key)
+                self._key_bytes += sys.getsizeof(name)
+
+    def remove(self, id: str):
+        """
+        Remove a friend from the index.  Unknown ids are ignored.
+        """
+        with self._lock:
+            self._remove(id.lower())
+
+    def suggest(self, prefix: str, limit: int=10) -> list:
+        """
+        Return the friends with a first, last or full name that starts
+        with `prefix`, ignoring case, in alphabetical order of the
+        matching name.
+
+        Args:
+            prefix (str): The text typed so far.
+            limit (int): The maximum number of friends to return.
+
+        Returns
+            A list of up to `limit` JSON ready dictionaries holding the
+            id, first_name and last_name of each friend.
+        """
+        prefix = prefix.lower()
+        suggestions = list()
+        seen = set()
+
+        with self._lock:
+            position = bisect.bisect_left(self._keys, prefix)
+            while (len(suggestions) < limit and
+                   position < len(self._keys) and
+                   self._keys[position].startswith(prefix)):
+                key = self._ids[position]
+                if key not in seen:
+                    seen.add(key)
+                    id, first_name, last_name = self._friends[key]
+                    suggestions.append({"id": id,
+                                        "first_name": first_name,
+                                        "last_name": last_name})
+                position += 1
+
+        return suggestions
+
+    def stats(self) -> dict:
+        """
+        Return the size of the index.  `bytes` approximates the memory
+        it holds: the two lists, the names in them and the dictionary of
+        friends (not counting the id and name strings it shares with the
+        friends' representations elsewhere).
+
+        Returns:
+            A JSON ready dictionary of counters.
+        """
+        with self._lock:
+            return {
+                "friends": len(self._friends),
+                "entries": len(self._keys),
+                "bytes": (sys.getsizeof(self._keys) +
+                          sys.getsizeof(self._ids) +
+                          self._key_bytes +
+                          sys.getsizeof(self._friends) +
+                          len(self._friends) * sys.getsizeof((0, 0, 0)))}
+
+    @staticmethod
+    def _names(first_name: str, last_name: str) -> set:
+        """Return the lowercased names a friend is indexed under."""
+        return {first_name.lower(), last_name.lower(),
+                "{} {}".format(first_name, last_name).lower()}
+
+    def _remove(self, key: str):
+        """Remove a friend's entries.  The lock must be held."""
+        friend = self._friends.pop(key, None)
+        if friend is None:
+            return
+
+        for name in self._names(friend[1], friend[2]):
+            position = bisect.bisect_left(self._keys, name)
+            while (position < len(self._keys) and
+                   self._keys[position] == name):
+                if self._ids[position] == key:
+                    del self._keys[position]
+                    del self._ids[position]
+                    self._key_bytes -= sys.getsizeof(name)
+                    break
+                position += 1
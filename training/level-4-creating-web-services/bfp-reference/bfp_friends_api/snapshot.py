@@ -0,0 +1,321 @@
+"""
+This module provides the optional read tier: a point-in-time, in-memory
+copy of the datastore for answering reads.
+
+Reads from the datastore file share its locks with writers: under the
+default rollback journal a reader waits while a write commits, and
+every read pays for checking whether another connection has changed
+the file.  Reads from an in-memory copy do neither.  The price is the
+memory the copy takes (two copies while one replaces the other) and
+staleness: a write shows up in reads once the copy is refreshed.
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from bfp_friends_api import datastore
+
+logger = logging.getLogger(__name__)
+
+
+class ReadSnapshot:
+    """
+    Hands out read-only connections to an in-memory copy of a datastore,
+    like a ConnectionPool hands out connections to the datastore itself.
+
+    A background thread copies the datastore into a named, shared-cache
+    in-memory database with sqlite3.Connection.backup().  Every
+    connection handed out by acquire() reads that one copy, so the copy
+    costs the same memory however many threads read from it.  When a
+    refresh replaces the copy, connections to the old one are replaced
+    as they are next handed out, and the old copy is freed once the last
+    of them is closed.
+
+    The thread refreshes the copy soon after notify() is called, which
+    should be done whenever a write commits, and otherwise checks every
+    `max_staleness` seconds whether the datastore's write generation has
+    changed, which catches writes made by other processes.  Refreshes
+    are at least `min_interval` seconds apart, so a burst of writes
+    costs one refresh.
+
+    If the copy hasn't been confirmed current for more than
+    `max_staleness` seconds -- the datastore stayed locked, a refresh
+    failed, or one is simply taking long -- is_fresh() says so, and
+    reads should go to the datastore itself until it catches up.
+
+    Args:
+        database (str): The path of the SQLite database file.
+        max_size (int): The maximum number of open connections.
+        timeout (float): The number of seconds to wait for a free
+            connection before giving up.
+        max_staleness (float): How often, in seconds, to check for
+            writes that notify() wasn't called for, and how old the copy
+            may get before it is no longer fresh.
+        min_interval (float): The minimum number of seconds between
+            refreshes.  Keep it below `max_staleness`.
+        on_connect (callable): An optional function that is called with
+            the connection to the database file, e.g. to set pragmas.
+        on_refresh (callable): An optional function that is called after
+            each refresh, e.g. to clear caches filled from older copies.
+    """
+
+    def __init__(self, database: str, max_size: int=5, timeout: float=5.0,
+                 max_staleness: float=1.0, min_interval: float=0.25,
+                 on_connect=None, on_refresh=None):
+        if max_size < 1:
+            raise ValueError("A read snapshot needs a max_size of at "
+                             "least 1, not {}.".format(max_size))
+
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_staleness = max_staleness
+        self.min_interval = min_interval
+        self.on_connect = on_connect
+        self.on_refresh = on_refresh
+
+        # LIFO, like ConnectionPool, of (connection, version) tuples.
+        self._idle = queue.LifoQueue()
+        self._checked_out = dict()
+        self._lock = threading.Lock()
+        self._open_connections = 0
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+
+        # The latest copy: a connection that keeps it alive, its URI and
+        # version (bumped by every refresh), the write generation it was
+        # taken at, its size and when it was last confirmed current.
+        self._copy = None
+        self._uri = None
+        self._version = 0
+        self._generation = None
+        self._bytes = 0
+        self._checked_at = None
+
+        self._refreshes = 0
+        self._refresh_seconds = 0.0
+        self._reconnects = 0
+        self._failures = 0
+        self._stale_checks = 0
+
+    def start(self):
+        """
+        Take the first copy of the datastore and start the thread that
+        keeps it up to date.
+        """
+        source = self._connect_to_source()
+        self._refresh(source)
+        self._thread = threading.Thread(target=self._run, args=(source,),
+                                        name="read-snapshot", daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        """Note that a write has committed, so the copy is stale."""
+        self._wake.set()
+
+    def is_fresh(self) -> bool:
+        """
+        Return whether the copy was confirmed current within the last
+        `max_staleness` seconds, so that it may be read from.
+        """
+        with self._lock:
+            if time.monotonic() - self._checked_at <= self.max_staleness:
+                return True
+            self._stale_checks += 1
+            return False
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Check out a read-only connection to the latest copy.
+
+        Returns:
+            A sqlite3.Connection which must be handed back with release().
+
+        Raises:
+            TimeoutError: If no connection became available within
+                `timeout` seconds.
+        """
+        if self._closed:
+            raise ValueError("Cannot acquire a connection from a closed "
+                             "snapshot.")
+
+        try:
+            connection, version = self._idle.get_nowait()
+        except queue.Empty:
+            connection, version = self._open_if_below_max_size()
+            if version is None:
+                try:
+                    connection, version = self._idle.get(
+                        timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(
+                        "No datastore snapshot connection became "
+                        "available within {} seconds.".format(self.timeout))
+
+        with self._lock:
+            uri, latest_version = self._uri, self._version
+        if version != latest_version:
+            if connection is not None:
+                connection.close()
+            connection = self._connect_to_copy(uri)
+            version = latest_version
+            with self._lock:
+                self._reconnects += 1
+
+        with self._lock:
+            self._checked_out[connection] = version
+        return connection
+
+    def release(self, connection: sqlite3.Connection):
+        """Return a connection previously obtained from acquire()."""
+        with self._lock:
+            version = self._checked_out.pop(connection)
+            if self._closed:
+                self._open_connections -= 1
+
+        if self._closed:
+            connection.close()
+            return
+
+        if connection.in_transaction:
+            connection.rollback()
+        self._idle.put((connection, version))
+
+    def close(self):
+        """
+        Stop refreshing, close every idle connection and refuse further
+        checkouts.
+        """
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._open_connections -= 1
+            connection.close()
+
+        if self._copy is not None:
+            self._copy.close()
+
+    def stats(self) -> dict:
+        """
+        Return the snapshot's size, freshness and refresh counters.
+
+        Returns:
+            A JSON ready dictionary of counters.
+        """
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "open": self._open_connections,
+                "idle": self._idle.qsize(),
+                "version": self._version,
+                "generation": self._generation,
+                "bytes": self._bytes,
+                "staleness_seconds": time.monotonic() - self._checked_at,
+                "refreshes": self._refreshes,
+                "refresh_seconds_total": self._refresh_seconds,
+                "reconnects": self._reconnects,
+                "failures": self._failures,
+                "stale_checks": self._stale_checks}
+
+    def _connect_to_source(self) -> sqlite3.Connection:
+        # Opened by start(), then used by the refresh thread.
+        connection = sqlite3.connect(self.database, check_same_thread=False)
+        if self.on_connect is not None:
+            self.on_connect(connection)
+        return connection
+
+    def _connect_to_copy(self, uri: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        connection.execute('pragma query_only = on')
+        return connection
+
+    def _open_if_below_max_size(self):
+        """
+        Reserve a slot for a new connection.  Returns (None, 0), which
+        acquire() connects to the latest copy since no copy has version
+        0, or (None, None) if the snapshot is at `max_size`.
+        """
+        with self._lock:
+            if self._open_connections >= self.max_size:
+                return None, None
+            self._open_connections += 1
+        return None, 0
+
+    def _run(self, source: sqlite3.Connection):
+        try:
+            while not self._closed:
+                started = time.monotonic()
+                try:
+                    if datastore.generation(source) != self._generation:
+                        self._refresh(source)
+                    else:
+                        with self._lock:
+                            self._checked_at = started
+                except sqlite3.OperationalError:
+                    # The datastore is locked by a writer for longer
+                    # than the busy timeout.  Try again.
+                    self._wake.set()
+                except Exception:
+                    # Keep the thread alive: the copy goes stale, and
+                    # reads fall back to the datastore, until the next
+                    # check succeeds.
+                    logger.exception("Refreshing the read snapshot failed.")
+                    with self._lock:
+                        self._failures += 1
+
+                time.sleep(max(self.min_interval -
+                               (time.monotonic() - started), 0))
+                # Check again `max_staleness` seconds after this check
+                # started, so a quiet copy is confirmed before it counts
+                # as stale, or sooner if notify() is called.
+                self._wake.wait(max(self.max_staleness -
+                                    (time.monotonic() - started), 0))
+                self._wake.clear()
+        finally:
+            source.close()
+
+    def _refresh(self, source: sqlite3.Connection):
+        """Replace the copy with a fresh one."""
+        started = time.monotonic()
+        version = self._version + 1
+        uri = 'file:friends-snapshot-{}-{}?mode=memory&cache=shared'.format(
+            id(self), version)
+
+        # backup() copies every page in one step, under a single read
+        # transaction, so the copy is consistent.
+        copy = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source.backup(copy)
+        generation = datastore.generation(copy)
+        page_count = copy.execute('pragma page_count').fetchone()[0]
+        page_size = copy.execute('pragma page_size').fetchone()[0]
+
+        with self._lock:
+            previous_copy = self._copy
+            self._copy = copy
+            self._uri = uri
+            self._version = version
+            self._generation = generation
+            self._bytes = page_count * page_size
+            self._checked_at = started
+            self._refreshes += 1
+            self._refresh_seconds += time.monotonic() - started
+
+        # Connections still reading the previous copy keep it alive
+        # until they are replaced.
+        if previous_copy is not None:
+            previous_copy.close()
+
+        if self.on_refresh is not None:
+            self.on_refresh()
@@ -0,0 +1,184 @@
+"""
+This module traces the SQL run on behalf of a request.
+
+A QueryTrace collects every statement a connection runs, through
+sqlite3.Connection.set_trace_callback(), along with the time spent in
+each of the datastore functions decorated with timed().  Traces are
+per thread: start() makes one current for the calling thread and stop()
+ends it.  While no trace is current, timed() functions cost a single
+thread-local lookup.
+"""
+
+import collections
+import functools
+import inspect
+import re
+import sqlite3
+import threading
+import time
+
+_current = threading.local()
+
+# Literals replaced when grouping statements by shape.  The trace
+# callback receives statements with their parameters expanded.
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+
+
+class QueryTrace:
+    """
+    The statements run and datastore calls made for one request.
+
+    Attributes:
+        statements (list): The text of every statement run, in order.
+        calls (list): A (function name, seconds) tuple for every
+            datastore call, in the order they finished.
+    """
+
+    def __init__(self):
+        self.statements = list()
+        self.calls = list()
+        self._depth = 0
+
+    def record_statement(self, statement: str):
+        # SQLite reports the statements it runs internally, e.g. to
+        # maintain the full-text index, as comments, and reports a
+        # statement again for every trigger it fires.  Neither is a
+        # query of ours.
+        if statement.startswith('--'):
+            return
+        if self.statements and self.statements[-1] == statement:
+            return
+        self.statements.append(statement)
+
+    def record_call(self, name: str, seconds: float):
+        self.calls.append((name, seconds))
+
+    @property
+    def query_count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def query_seconds(self) -> float:
+        """Seconds spent in datastore calls."""
+        return sum(seconds for _, seconds in self.calls)
+
+    def repeated_statements(self, threshold: int) -> list:
+        """
+        Return the statements run at least `threshold` times once their
+        literals are replaced with `?`, the telltale of a query issued
+        once per item (N+1) instead of once for all of them.
+
+        Returns:
+            A list of (statement shape, times run) tuples, most run
+            first.
+        """
+        shapes = collections.Counter(
+            _NUMBER_LITERAL.sub('?', _STRING_LITERAL.sub('?', statement))
+            for statement in self.statements)
+        return [(shape, count) for shape, count in shapes.most_common()
+                if count >= threshold]
+
+    def summary(self) -> str:
+        return "{} queries in {:.2f} ms over {} datastore calls".format(
+            self.query_count, self.query_seconds * 1000, len(self.calls))
+
+
+def start(ds_connection: sqlite3.Connection=None) -> QueryTrace:
+    """
+    Start a trace for the calling thread.
+
+    Args:
+        ds_connection (sqllite3.Connection): A connection whose
+            statements should be recorded, if any.
+
+    Returns:
+        The new, current QueryTrace.
+    """
+    trace = QueryTrace()
+    _current.trace = trace
+    if ds_connection is not None:
+        ds_connection.set_trace_callback(trace.record_statement)
+    return trace
+
+
+def stop(ds_connection: sqlite3.Connection=None) -> QueryTrace:
+    """
+    End the calling thread's trace.
+
+    Args:
+        ds_connection (sqllite3.Connection): The connection passed to
+            start(), which stops being traced.
+
+    Returns:
+        The trace that was current, or None.
+    """
+    if ds_connection is not None:
+        ds_connection.set_trace_callback(None)
+    trace = getattr(_current, 'trace', None)
+    _current.trace = None
+    return trace
+
+
+def current() -> QueryTrace:
+    """Return the calling thread's trace, or None."""
+    return getattr(_current, 'trace', None)
+
+
+def timed(function):
+    """
+    Decorate a datastore function to record the time spent in it in the
+    current trace.
+
+    Calls made from within another timed() function aren't recorded on
+    their own: their time counts towards the outer call.  The time of a
+    generator function is the time spent producing its items, recorded
+    once it is exhausted or closed.
+    """
+    name = function.__name__
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def timed_generator_function(*args, **kwargs):
+            trace = current()
+            if trace is None or trace._depth:
+                return function(*args, **kwargs)
+            return _timed_iteration(trace, name, function(*args, **kwargs))
+
+        return timed_generator_function
+
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        trace = current()
+        if trace is None or trace._depth:
+            return function(*args, **kwargs)
+
+        trace._depth += 1
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            trace.record_call(name, time.perf_counter() - started)
+            trace._depth -= 1
+
+    return timed_function
+
+
+def _timed_iteration(trace: QueryTrace, name: str, iterator):
+    """Yield from `iterator`, timing each step of it."""
+    seconds = 0.0
+    try:
+        while True:
+            trace._depth += 1
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - started
+                trace._depth -= 1
+            yield item
+    finally:
+        iterator.close()
+        trace.record_call(name, seconds)
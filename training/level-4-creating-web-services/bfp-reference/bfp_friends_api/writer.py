@@ -0,0 +1,267 @@
+"""
+This module provides the opt-in "wal" datastore profile: WAL journaling,
+tunable pragmas and a single writer thread that group-commits writes.
+
+Under the default rollback journal every write pays for its own fsync
+and readers wait behind writers.  In WAL mode readers and the writer
+don't block each other, and funnelling every write through one thread
+lets it commit all the writes that arrive within a few milliseconds of
+each other in a single transaction.
+"""
+
+import concurrent.futures
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from bfp_friends_api import datastore
+
+logger = logging.getLogger(__name__)
+
+# Settings for each datastore profile.  `synchronous` sets the
+# durability of a commit: 'full' survives power loss, 'normal' (in WAL
+# mode) survives an application crash but may lose the last commits on
+# power loss, and 'off' leaves flushing to the operating system.
+PROFILES = {
+    "default": {
+        "journal_mode": None,
+        "synchronous": None,
+        "mmap_size": None,
+        "group_commit": False,
+        "group_commit_window": 0.005,
+        "group_commit_max_batch": 256},
+    "wal": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 256 * 1024 * 1024,
+        "group_commit": True,
+        "group_commit_window": 0.005,
+        "group_commit_max_batch": 256},
+}
+
+JOURNAL_MODES = {"delete", "truncate", "persist", "memory", "wal", "off"}
+SYNCHRONOUS_LEVELS = {"off", "normal", "full", "extra"}
+
+
+def profile_settings(name: str, overrides: dict=None) -> dict:
+    """
+    Return the settings of a datastore profile.
+
+    Args:
+        name (str): A key of PROFILES.
+        overrides (dict): Settings that replace the profile's own.
+
+    Raises:
+        ValueError: If the profile or any of the settings is unknown.
+    """
+    if name not in PROFILES:
+        raise ValueError("Unknown datastore profile {!r}.  Choose one "
+                         "of: {}".format(name, sorted(PROFILES)))
+
+    settings = dict(PROFILES[name])
+    for key, value in (overrides or {}).items():
+        if key not in settings:
+            raise ValueError("Unknown datastore profile setting "
+                             "{!r}.".format(key))
+        settings[key] = value
+
+    if settings['journal_mode'] not in JOURNAL_MODES | {None}:
+        raise ValueError("Unknown journal_mode {!r}.".format(
+            settings['journal_mode']))
+    if settings['synchronous'] not in SYNCHRONOUS_LEVELS | {None}:
+        raise ValueError("Unknown synchronous level {!r}.".format(
+            settings['synchronous']))
+
+    return settings
+
+
+def apply_pragmas(ds_connection: sqlite3.Connection, settings: dict):
+    """
+    Configure a connection according to a profile's settings.  Settings
+    that are None leave SQLite's defaults alone.
+
+    Args:
+        ds_connection (sqllite3.Connection): A newly opened connection.
+        settings (dict): The result of profile_settings().
+    """
+    # The values are checked against fixed sets (or are ints), so it is
+    # safe to format them into the pragmas.
+    if settings['journal_mode'] is not None:
+        ds_connection.execute(
+            'pragma journal_mode = {}'.format(settings['journal_mode']))
+    if settings['synchronous'] is not None:
+        ds_connection.execute(
+            'pragma synchronous = {}'.format(settings['synchronous']))
+    if settings['mmap_size'] is not None:
+        ds_connection.execute(
+            'pragma mmap_size = {:d}'.format(settings['mmap_size']))
+
+
+class GroupCommitWriter:
+    """
+    Performs datastore writes on a single background thread, committing
+    every write that was submitted within `window` seconds of the first
+    pending one in one transaction.
+
+    Each write runs inside its own savepoint, so one that raises is
+    rolled back on its own without affecting the rest of its group.
+    Whatever goes wrong, every submitted write's Future is resolved and
+    the thread carries on with the next group.
+
+    Args:
+        database (str): The path of the SQLite database file.
+        window (float): How long to gather writes before committing.
+        max_batch (int): The most writes to commit in one transaction.
+        on_connect (callable): An optional function that is called with
+            the writer's connection when it is opened.
+    """
+
+    def __init__(self, database: str, window: float=0.005,
+                 max_batch: int=256, on_connect=None):
+        self.database = database
+        self.window = window
+        self.max_batch = max_batch
+        self.on_connect = on_connect
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._writes = 0
+        self._largest_batch = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name="datastore-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, function, *args) -> concurrent.futures.Future:
+        """
+        Queue a call of `function(connection, *args, commit=False)` on
+        the writer thread.
+
+        `function` must be one of the datastore write functions, or
+        anything else that accepts `commit=False` and leaves committing
+        to datastore.commit().
+
+        Returns:
+            A Future that resolves to the function's return value (or
+            exception) once the write has been committed.
+        """
+        future = concurrent.futures.Future()
+        self._queue.put((future, function, args))
+        return future
+
+    def close(self):
+        """Commit any queued writes, then stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> dict:
+        """
+        Return counters describing how writes have been grouped.
+
+        Returns:
+            A JSON ready dictionary of counters.
+        """
+        with self._lock:
+            return {
+                "batches": self._batches,
+                "writes": self._writes,
+                "largest_batch": self._largest_batch,
+                "queued": self._queue.qsize()}
+
+    def _run(self):
+        connection = sqlite3.connect(self.database)
+        if self.on_connect is not None:
+            self.on_connect(connection)
+
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                self._commit_batch(connection, batch)
+            except Exception as error:
+                self._abandon_batch(connection, batch, error)
+
+        connection.close()
+
+    def _abandon_batch(self, connection: sqlite3.Connection, batch: list,
+                       error: Exception):
+        """
+        Roll back a group that failed unexpectedly and fail every write
+        in it that hasn't been resolved yet, so that no caller is left
+        waiting.
+        """
+        logger.error("Group commit of %d writes failed.", len(batch),
+                     exc_info=error)
+        try:
+            if connection.in_transaction:
+                datastore.rollback(connection)
+        except sqlite3.Error:
+            logger.exception("Rolling back the failed group commit failed.")
+
+        for future, _, _ in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def _commit_batch(self, connection: sqlite3.Connection, batch: list):
+        outcomes = list()
+
+        try:
+            connection.execute('begin immediate')
+        except sqlite3.Error as error:
+            for future, _, _ in batch:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+            return
+
+        for future, function, args in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            connection.execute('savepoint group_commit_write')
+            try:
+                result = function(connection, *args, commit=False)
+            except Exception as error:
+                connection.execute('rollback to group_commit_write')
+                connection.execute('release group_commit_write')
+                outcomes.append((future, None, error))
+            else:
+                connection.execute('release group_commit_write')
+                outcomes.append((future, result, None))
+
+        try:
+            datastore.commit(connection)
+        except sqlite3.Error as error:
+            datastore.rollback(connection)
+            for future, _, _ in outcomes:
+                future.set_exception(error)
+            return
+
+        with self._lock:
+            self._batches += 1
+            self._writes += len(outcomes)
+            self._largest_batch = max(self._largest_batch, len(outcomes))
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
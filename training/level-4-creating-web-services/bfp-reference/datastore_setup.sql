@@ -8,6 +8,7 @@ create table friends (
   email text not null,
   notes text not null
 );
+create index friends_id_nocase on friends (id collate nocase);
 
 INSERT INTO friends (id, firstName, lastName, telephone, email, notes)
 VALUES ('BFP', 'Big Fat', 'Panda', '574-213-0726', 'mike@eikonomega.com', 'My bestest friend in all the world.');
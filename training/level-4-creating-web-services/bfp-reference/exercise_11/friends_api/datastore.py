@@ -3,27 +3,70 @@ This modules provides functions for creating, updating, and deleting
 friend records from our database.
 """
 
-import sqlite3
+from bfp_friends_api.cache import LRUCache
+from bfp_friends_api.pool import ConnectionPool
+
+connection_pool = ConnectionPool("/tmp/friends.db")
+
+# Representations of individual friends keyed on their lowercased id.
+friend_cache = LRUCache(max_size=1024, ttl=60.0)
 
 
 class Datastore:
     """
     Provides an interface to an SQLite database and associated methods.
+
+    Args:
+        pool: The ConnectionPool to check a connection out of.  Defaults
+            to the module level `connection_pool`.
+        cache: The LRUCache that friend() reads through.  Defaults to
+            the module level `friend_cache`.
     """
 
-    def __init__(self):
-        self.connection = sqlite3.connect("/tmp/friends.db")
+    def __init__(self, pool: ConnectionPool=None, cache: LRUCache=None):
+        self.pool = pool or connection_pool
+        self.cache = cache or friend_cache
+        self.connection = self.pool.acquire()
+
+    def close(self):
+        """
+        Hand our connection back to the pool.  The Datastore must not be
+        used afterwards.
+        """
+        if self.connection is not None:
+            self.pool.release(self.connection)
+            self.connection = None
 
-    def friends(self) -> dict:
+    def friends(self, limit: int=None, after: str=None) -> dict:
         """
         Return a representation of all rows in the friends table.
 
+        Passing a `limit` returns a single page of rows, ordered by `id`,
+        instead.  The page starts right after the `after` id (keyset
+        pagination) so deep pages cost the same as the first one.
+
+        Args:
+            limit: The maximum number of rows to return, or None for all.
+            after: The `id` of the last row of the previous page.
+
         Returns
             A JSON ready dictionary representing all rows of the friends table.
         """
-        cursor = self.connection.execute(
-            'select id, firstName, lastName, telephone, email, notes '
-            'from friends')
+        if limit is None:
+            cursor = self.connection.execute(
+                'select id, firstName, lastName, telephone, email, notes '
+                'from friends')
+        elif after is None:
+            cursor = self.connection.execute(
+                'select id, firstName, lastName, telephone, email, notes '
+                'from friends order by id collate nocase limit ?',
+                [limit])
+        else:
+            cursor = self.connection.execute(
+                'select id, firstName, lastName, telephone, email, notes '
+                'from friends where id > ? collate nocase '
+                'order by id collate nocase limit ?',
+                [after, limit])
 
         friends_collection = list()
         for friend_row in cursor.fetchall():
@@ -49,21 +92,28 @@ class Datastore:
             A JSON ready dictionary representing a specific
             row of the friends table.
         """
+        cached_friend = self.cache.get(id.lower())
+        if cached_friend is not None:
+            return dict(cached_friend)
+
+        cache_token = self.cache.token()
         cursor = self.connection.execute(
             'select id, firstName, lastName, telephone, email, notes '
-            'from friends where lower(id) = ?',
-            [id.lower()])
+            'from friends where id = ? collate nocase',
+            [id])
 
         friend_row = cursor.fetchone()
 
         if friend_row:
-            return {
+            friend = {
                 "id": friend_row[0],
                 "firstName": friend_row[1],
                 "lastName": friend_row[2],
                 "telephone": friend_row[3],
                 "email": friend_row[4],
                 "notes": friend_row[5]}
+            self.cache.put(id.lower(), friend, cache_token)
+            return dict(friend)
 
     def create_friend(self, data: dict):
         """
@@ -93,21 +143,27 @@ class Datastore:
                              "must be present to create a friend: {}".format(
                 required_elements))
 
-        if self.friend(data['id']):
-            raise ValueError(
-                "A friend already exists with the `id` specified: {}".format(
-                    data['id']))
-
-        self.connection.execute(
+        # Check for an existing friend and insert in a single statement.
+        cursor = self.connection.execute(
             'insert into friends (id, firstName, lastName, telephone, email, notes) '
-            'values (?, ?, ?, ?, ?, ?)',
+            'select ?, ?, ?, ?, ?, ? '
+            'where not exists (select 1 from friends where id = ? collate nocase)',
             [data['id'],
              data['firstName'],
              data['lastName'],
              data['telephone'],
              data['email'],
-             data['notes']])
+             data['notes'],
+             data['id']])
+
+        if not cursor.rowcount:
+            self.connection.rollback()
+            raise ValueError(
+                "A friend already exists with the `id` specified: {}".format(
+                    data['id']))
+
         self.connection.commit()
+        self.cache.invalidate(data['id'].lower())
 
     def update_friend(self, id: str, data: dict):
         """
@@ -118,7 +174,8 @@ class Datastore:
             data: A dictionary of data to update an existing friend entry with.
 
         Raises:
-            ValueError: If data is None or if not matching friend entry is found.
+            ValueError: If data is None, names another friend than `id`
+                or if not matching friend entry is found.
         """
         if data is None:
             raise ValueError(
@@ -134,22 +191,30 @@ class Datastore:
                              "must be present to create a friend: {}".format(
                 required_elements))
 
-        if not self.friend(id):
+        if not isinstance(data['id'], str) or data['id'].lower() != id.lower():
             raise ValueError(
-                "No existing friend was found matching id: {}".format(id))
+                "The id in the payload ({}) doesn't match the id of the "
+                "friend to update ({}).".format(data['id'], id))
 
-        self.connection.execute(
+        cursor = self.connection.execute(
             "UPDATE friends "
             "SET id=?, firstName=?, lastName=?, telephone=?, email=?, notes=? "
-            "WHERE lower(id) = ?",
+            "WHERE id = ? COLLATE NOCASE",
             [data['id'],
              data['firstName'],
              data['lastName'],
              data['telephone'],
              data['email'],
              data['notes'],
-             data['id'].lower()])
+             id])
+
+        if not cursor.rowcount:
+            self.connection.rollback()
+            raise ValueError(
+                "No existing friend was found matching id: {}".format(id))
+
         self.connection.commit()
+        self.cache.invalidate(id.lower(), data['id'].lower())
 
     def destroy_friend(self, id: str):
         """
@@ -163,16 +228,15 @@ class Datastore:
             friend records in our database.
 
         """
-        if self.friend(id):
-            cursor = self.connection.execute(
+        cursor = self.connection.execute(
             'DELETE  '
-            'from friends where lower(id) = ?',
-            [id.lower()])
+            'from friends where id = ? collate nocase',
+            [id])
 
-            if not cursor.rowcount:
-                raise ValueError()
-            else:
-                self.connection.commit()
-        else:
+        if not cursor.rowcount:
+            self.connection.rollback()
             raise ValueError(
                 "No existing friend was found matching id: {}".format(id))
+
+        self.connection.commit()
+        self.cache.invalidate(id.lower())
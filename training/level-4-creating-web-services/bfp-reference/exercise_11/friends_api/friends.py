@@ -1,10 +1,17 @@
-from flask import Flask, jsonify, make_response, request, Response, g
+import base64
+import binascii
+
+from flask import (Flask, jsonify, make_response, request, Response, g,
+                   url_for)
 from werkzeug.exceptions import BadRequest
 
 from friends_api.datastore import Datastore
 
 app = Flask(__name__)
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 
 @app.before_request
 def connect_to_datastore():
@@ -19,9 +26,12 @@ def connect_to_datastore():
 @app.teardown_request
 def disconnect_from_datastore(exception):
     """
-    Close the connection to the datastore after each request.
+    Return the connection to the datastore's pool after each request.
     """
-    del g.datastore
+    datastore = getattr(g, 'datastore', None)
+    if datastore is not None:
+        datastore.close()
+        del g.datastore
 
 
 @app.route('/api/v1/friends', methods=['GET'])
@@ -29,11 +39,48 @@ def friends() -> Response:
     """
     Return a representation of the collection of friend resources.
 
+    If a `limit` or `cursor` query parameter is given, only one page of
+    the collection is returned along with a `next` link to the
+    following page (or null on the last page).
+
     Returns:
         A flask.Response object.
     """
-    friends_list = g.datastore.friends()
-    return jsonify({"friends": friends_list})
+    if 'limit' not in request.args and 'cursor' not in request.args:
+        friends_list = g.datastore.friends()
+        return jsonify({"friends": friends_list})
+
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        after = None
+        if 'cursor' in request.args:
+            after = base64.b64decode(request.args['cursor'], altchars=b'-_',
+                                     validate=True).decode('utf-8')
+    except (ValueError, binascii.Error):
+        limit = after = None
+
+    if limit is None or not 1 <= limit <= MAX_PAGE_SIZE or after == '':
+        response = make_response(
+            jsonify({"error": "`limit` must be an integer between 1 and "
+                              "{} and `cursor` must come from a `next` "
+                              "link.".format(MAX_PAGE_SIZE)}),
+            400)
+        return response
+
+    # Ask for one extra row to find out whether there is a next page.
+    friends_list = g.datastore.friends(limit=limit + 1, after=after)
+
+    next_page = None
+    if len(friends_list) > limit:
+        friends_list = friends_list[:limit]
+        cursor = base64.urlsafe_b64encode(
+            friends_list[-1]['id'].encode('utf-8')).decode('ascii')
+        next_page = url_for('friends', limit=limit, cursor=cursor)
+
+    response = jsonify({"friends": friends_list, "next": next_page})
+    if next_page:
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_page)
+    return response
 
 
 @app.route('/api/v1/friends/<id>', methods=['GET'])
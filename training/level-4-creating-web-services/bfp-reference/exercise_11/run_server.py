@@ -1,3 +1,11 @@
+import os
+import sys
+
+# The connection pool and cache are shared with bfp_friends_api, which
+# lives one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
 from friends_api.friends import app
 
 if __name__ == '__main__':